@@ -1,66 +1,72 @@
 import os
-import json
 import eth_abi
 import asyncio
 import eth_utils
-import websockets
 import aioprocessing
 
 from web3 import Web3
-from typing import List
+from typing import List, Optional
 from functools import partial
 
+from decoders import decode_log
+from rpc import RpcWebsocketClient, rpc_client_session
+from utils import record_message
+
 
 async def stream_1inch_limit_orderbook_events(http_rpc_url: str,
                                               ws_rpc_url: str,
                                               limit_order_contracts: List[str],
                                               event_queue: aioprocessing.AioQueue,
-                                              debug: bool = False):
+                                              debug: bool = False,
+                                              rpc_client: Optional[RpcWebsocketClient] = None):
+    """
+    :param rpc_client: a RpcWebsocketClient shared with the other DEX streams.
+                       A new connection to ws_rpc_url is opened if None
+    """
     
     w3 = Web3(Web3.HTTPProvider(http_rpc_url))
     
     order_canceled_event_selector = w3.keccak(text='OrderCanceled(address,bytes32,uint256)').hex()
     order_filled_event_selector = w3.keccak(text='OrderFilled(address,bytes32,uint256)').hex()
     
-    async with websockets.connect(ws_rpc_url) as ws:
-        subscription = {
-            'json': '2.0',
-            'id': 1,
-            'method': 'eth_subscribe',
-            'params': [
-                'logs',
-                {'topics': [[order_canceled_event_selector, order_filled_event_selector]]}
-            ]
-        }
-
-        await ws.send(json.dumps(subscription))
-        _ = await ws.recv()
+    async with rpc_client_session(ws_rpc_url, rpc_client) as client:
+        subscription = await client.subscribe([
+            'logs',
+            {'topics': [[order_canceled_event_selector, order_filled_event_selector]]}
+        ])
         
-        while True:
-            msg = await asyncio.wait_for(ws.recv(), timeout=60 * 10)
-            event = json.loads(msg)['params']['result']
-            address = event['address'].lower()
-            
-            if address in limit_order_contracts:
-                block_number = int(event['blockNumber'], base=16)
-                topic = event['topics'][0]
-                event_type = 'order_cancel' if topic == order_canceled_event_selector else 'order_filled'
-                maker = eth_abi.decode(['address'], eth_utils.decode_hex(event['topics'][1]))[0]
-                data = eth_abi.decode(['bytes32', 'uint256'], eth_utils.decode_hex(event['data']))
-                order_update = {
-                    'source': 'dex',
-                    'type': event_type,
-                    'block_number': block_number,
-                    'exchange': address,
-                    'maker': maker,
-                    'order_hash': data[0].hex(),
-                    'remaining': data[1],
-                }
+        try:
+            while True:
+                msg = await asyncio.wait_for(subscription.get(), timeout=60 * 10)
+                event = decode_log(msg)
+                if isinstance(event, dict):
+                    # not a logs notification
+                    continue
+                record_message()
+                address = event.address
                 
-                if not debug:
-                    event_queue.put(order_update)
-                else:
-                    print(order_update)
+                if address in limit_order_contracts:
+                    block_number = event.block_number
+                    topic = event.topics[0]
+                    event_type = 'order_cancel' if topic == order_canceled_event_selector else 'order_filled'
+                    maker = eth_abi.decode(['address'], eth_utils.decode_hex(event.topics[1]))[0]
+                    data = eth_abi.decode(['bytes32', 'uint256'], eth_utils.decode_hex(event.data))
+                    order_update = {
+                        'source': 'dex',
+                        'type': event_type,
+                        'block_number': block_number,
+                        'exchange': address,
+                        'maker': maker,
+                        'order_hash': data[0].hex(),
+                        'remaining': data[1],
+                    }
+                    
+                    if not debug:
+                        event_queue.put(order_update)
+                    else:
+                        print(order_update)
+        finally:
+            await subscription.unsubscribe()
                 
             
 if __name__ == '__main__':
@@ -1,7 +1,10 @@
+import heapq
 import aioprocessing
+from bisect import bisect_left
 from decimal import Decimal
+from itertools import accumulate, islice
 from operator import itemgetter
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Optional
 
 
 def aggregate_cex_orderbooks(orderbooks: Dict[str, Dict[str, Any]]) -> Dict[str, List[List[Decimal]]]:
@@ -22,10 +25,211 @@ def aggregate_cex_orderbooks(orderbooks: Dict[str, Dict[str, Any]]) -> Dict[str,
     asks = sorted(asks, key=itemgetter(0))
     
     return {'bids': bids, 'asks': asks}
+
+
+def _tag_levels(levels: List[List[Any]], exchange: str):
+    for level in levels:
+        yield [level[0], level[1], exchange]
+
+
+class MultiOrderbook:
+    """
+    A stateful version of aggregate_cex_orderbooks
+
+    Each exchange keeps its own sorted bids/asks (exchanges already send their
+    depth sorted), and an update only replaces the levels of the exchange that sent it.
+    The merged view is created with a k-way merge of the per-exchange sides,
+    and only when it is requested (bids, asks, to_dict).
+
+    best_bid, best_ask are kept up to date on every update, and are returned in O(1):
+    [price, quantity, exchange]
+
+    executable_price walks the merged depth for a given size. The prefix sums of the merged levels
+    are built on the first query after an update, so repeated size queries are O(log n) bisects.
+    """
+
+    def __init__(self, depth: Optional[int] = None):
+        """
+        :param depth: the number of merged levels to materialize. None will merge all levels
+        """
+        self.depth = depth
+
+        self.orderbooks = {}
+
+        # set by the fixed-point orderbooks (see constants.CEX_SCALES), None for Decimal orderbooks
+        self.price_decimals = None
+        self.quantity_decimals = None
+
+        self._best_bid = None
+        self._best_ask = None
+
+        self._bids = None
+        self._asks = None
+
+        # side --> prefix sums of the merged levels, see _prefix_sums
+        self._prefix = {'bids': None, 'asks': None}
+
+    def update(self, orderbook: Dict[str, Any]):
+        """
+        :param orderbook: events.OrderbookSnapshot, or a dict with the same keys:
+                          {'source': 'cex', 'type': 'orderbook', 'exchange': 'binance', 'bids': [...], 'asks': [...]}
+        """
+        exchange = orderbook['exchange']
+        self.orderbooks[exchange] = (orderbook['bids'], orderbook['asks'])
+        self.price_decimals = orderbook.get('price_decimals')
+        self.quantity_decimals = orderbook.get('quantity_decimals')
+        self._refresh()
+
+    def remove(self, exchange: str):
+        if self.orderbooks.pop(exchange, None) is not None:
+            self._refresh()
+
+    def _refresh(self):
+        best_bid, best_ask = None, None
+
+        for exchange, (bids, asks) in self.orderbooks.items():
+            if bids and (best_bid is None or bids[0][0] > best_bid[0]):
+                best_bid = [bids[0][0], bids[0][1], exchange]
+            if asks and (best_ask is None or asks[0][0] < best_ask[0]):
+                best_ask = [asks[0][0], asks[0][1], exchange]
+
+        self._best_bid = best_bid
+        self._best_ask = best_ask
+
+        # invalidate the merged depth view
+        self._bids = None
+        self._asks = None
+        self._prefix = {'bids': None, 'asks': None}
+
+    def best_bid(self) -> Optional[List[Any]]:
+        return self._best_bid
+
+    def best_ask(self) -> Optional[List[Any]]:
+        return self._best_ask
+
+    def _merge(self, side: int, reverse: bool) -> List[List[Any]]:
+        iterables = [
+            _tag_levels(orderbook[side], exchange)
+            for exchange, orderbook in self.orderbooks.items()
+        ]
+        merged = heapq.merge(*iterables, key=itemgetter(0), reverse=reverse)
+        return list(islice(merged, self.depth))
+
+    @property
+    def bids(self) -> List[List[Any]]:
+        if self._bids is None:
+            self._bids = self._merge(0, True)
+        return self._bids
+
+    @property
+    def asks(self) -> List[List[Any]]:
+        if self._asks is None:
+            self._asks = self._merge(1, False)
+        return self._asks
+
+    def _prefix_sums(self, side: str):
+        """
+        (prices, cumulative quantity, cumulative notional, exchanges, cumulative quantity per exchange)
+        of the merged levels of side
+        """
+        if self._prefix[side] is None:
+            levels = self.bids if side == 'bids' else self.asks
+            prices = [level[0] for level in levels]
+            cum_quantity = list(accumulate(level[1] for level in levels))
+            cum_notional = list(accumulate(level[0] * level[1] for level in levels))
+            exchanges = [level[2] for level in levels]
+            cum_by_exchange = {
+                exchange: list(accumulate(level[1] if level[2] == exchange else 0 for level in levels))
+                for exchange in self.orderbooks
+            }
+            self._prefix[side] = (prices, cum_quantity, cum_notional, exchanges, cum_by_exchange)
+        return self._prefix[side]
+
+    def _book_size(self, size: Any, quote: bool, price: Any) -> Any:
+        """
+        Converts size (int, float or Decimal, in base or quote units) to the number type of the book
+        """
+        if self.quantity_decimals is not None:
+            decimals = self.quantity_decimals + (self.price_decimals if quote else 0)
+            return int(Decimal(str(size)).scaleb(decimals).to_integral_value())
+        if isinstance(price, Decimal) and not isinstance(size, Decimal):
+            return Decimal(str(size))
+        return size
+
+    def executable_price(self, side: str, size: Any, quote: bool = False) -> Optional[Dict[str, Any]]:
+        """
+        Walks the merged levels of side until size is filled
+
+        The results keep the book's number type: Decimal, or fixed-point ints with the vwap in the
+        price scale, filled in the quantity scale and the notional in the price * quantity scale.
+        Fixed-point results are rounded against the taker: the quantity bought with a quote size down,
+        the vwap down for bids and up for asks.
+        If the depth runs out, the whole depth is filled and filled < size.
+
+        :param side: 'bids' to sell into the bids, 'asks' to buy from the asks
+        :param size: in base units, or in quote units if quote is True. A float or Decimal
+                     (ex. an amount from UniswapV2Simulator), converted to the book's number type
+        :return: {'vwap': ..., 'filled': base filled, 'notional': quote filled,
+                  'allocation': {exchange: base filled on the exchange}}, None if the side is empty
+        """
+        prices, cum_quantity, cum_notional, exchanges, cum_by_exchange = self._prefix_sums(side)
+        if not prices:
+            return None
+
+        fixed_point = isinstance(prices[0], int)
+        size = self._book_size(size, quote, prices[0])
+
+        # the first level where the cumulative size reaches size
+        i = bisect_left(cum_notional if quote else cum_quantity, size)
+
+        if i == len(prices):
+            filled, notional = cum_quantity[-1], cum_notional[-1]
+            allocation = {exchange: cum[-1] for exchange, cum in cum_by_exchange.items()}
+        else:
+            quantity_before = cum_quantity[i - 1] if i > 0 else 0
+            notional_before = cum_notional[i - 1] if i > 0 else 0
+            if quote and fixed_point:
+                partial = (size - notional_before) // prices[i]
+            elif quote:
+                partial = (size - notional_before) / prices[i]
+            else:
+                partial = size - quantity_before
+            filled = quantity_before + partial
+            notional = notional_before + partial * prices[i]
+            allocation = {exchange: cum[i - 1] if i > 0 else 0 for exchange, cum in cum_by_exchange.items()}
+            allocation[exchanges[i]] += partial
+
+        if not filled:
+            vwap = prices[0]
+        elif fixed_point:
+            vwap = notional // filled if side == 'bids' else -(-notional // filled)
+        else:
+            vwap = notional / filled
+
+        return {
+            'vwap': vwap,
+            'filled': filled,
+            'notional': notional,
+            'allocation': {exchange: quantity for exchange, quantity in allocation.items() if quantity},
+        }
+
+    def to_dict(self) -> Dict[str, List[List[Any]]]:
+        """
+        Returns the same format as aggregate_cex_orderbooks
+        """
+        return {'bids': self.bids, 'asks': self.asks}
+
+    def __getitem__(self, key: str):
+        # MultiOrderbook can be used in place of the dict from aggregate_cex_orderbooks
+        if key == 'bids':
+            return self.bids
+        if key == 'asks':
+            return self.asks
+        raise KeyError(key)
     
 
 async def event_handler(event_queue: aioprocessing.AioQueue):
-    orderbooks = {}
+    multi_orderbooks = {}
     
     while True:
         data = await event_queue.coro_get()
@@ -33,12 +237,12 @@ async def event_handler(event_queue: aioprocessing.AioQueue):
         symbol = data['symbol']
         
         if data['source'] == 'cex':
-            if symbol not in orderbooks:
-                orderbooks[symbol] = {}
+            if symbol not in multi_orderbooks:
+                multi_orderbooks[symbol] = MultiOrderbook()
                 
-            orderbooks[symbol][data['exchange']] = data
-            multi_orderbook = aggregate_cex_orderbooks(orderbooks[symbol])
-            print(multi_orderbook)
+            multi_orderbook = multi_orderbooks[symbol]
+            multi_orderbook.update(data)
+            print(multi_orderbook.to_dict())
     
     
 if __name__ == '__main__':
@@ -47,6 +251,7 @@ if __name__ == '__main__':
     from functools import partial
     
     from utils import reconnecting_websocket_loop
+    from event_bus import ConflatingQueue
     from cex_streams import stream_binance_usdm_orderbook, stream_okx_usdm_orderbook
     
     nest_asyncio.apply()
@@ -65,11 +270,12 @@ if __name__ == '__main__':
         tag='okx_stream'
     )
     
-    event_handler_loop = event_handler(event_queue)
+    # the handler only sees the newest snapshot per (exchange, symbol) when it falls behind
+    event_handler_loop = event_handler(ConflatingQueue(event_queue))
     
     loop = asyncio.get_event_loop()
     loop.run_until_complete(asyncio.wait([
         binance_stream,
         okx_stream,
         event_handler_loop,
-    ]))
\ No newline at end of file
+    ]))
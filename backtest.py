@@ -0,0 +1,363 @@
+import numpy as np
+
+from typing import Any, Dict, List, Optional
+
+from simulator import UniswapV2Simulator
+from recorder import TickReader, decimal_scales, reserves_from_halves
+from events import EXCHANGES, OrderbookSnapshot
+from constants import CEX_FEES, SWAP_GAS
+
+
+"""
+Vectorized CEX-DEX spread backtests over recorded data (see recorder.py)
+
+Instead of replaying events through the handlers one at a time, the whole time range is
+evaluated with NumPy:
+
+1. CEX top of book per venue: (ts, bid, bid_qty, ask, ask_qty) arrays
+2. V2 reserves per pool: (ts, block_number, reserve0, reserve1) arrays
+3. blocks: (ts, block_number, next_base_fee) arrays
+
+are as-of joined onto one timeline with np.searchsorted: at every timestamp, the latest quote of each venue,
+the latest block, and the pool reserves as of that block. Then for every (CEX venue, pool) pair and
+both directions, the fee-adjusted spread and the executable profit of the closed-form optimal
+trade size (UniswapV2Simulator.get_optimal_amount_in, capped by the top of book quantity) are computed,
+net of the gas cost at the next block's base fee.
+
+Prices are quoted as the CEX symbol, base in quote (ex. ETH/USDT: 1850), and gas costs are converted
+at the CEX mid, so the base token should be ETH.
+"""
+
+def asof_indices(ts: np.ndarray, other_ts: np.ndarray) -> np.ndarray:
+    """
+    For each ts, the index of the last other_ts <= ts, -1 if there isn't any.
+    other_ts should be sorted
+    """
+    return np.searchsorted(other_ts, ts, side='right') - 1
+
+
+def asof_join(ts: np.ndarray, other_ts: np.ndarray, values: np.ndarray, fill: float = np.nan) -> np.ndarray:
+    """
+    The latest values as of each ts, fill where there isn't any yet
+    """
+    idx = asof_indices(ts, other_ts)
+    joined = values[np.maximum(idx, 0)].astype(np.float64)
+    joined[idx < 0] = fill
+    return joined
+
+
+def next_block_base_fees(base_fees: np.ndarray, gas_used: np.ndarray, gas_limits: np.ndarray) -> np.ndarray:
+    """
+    Batch version of utils.next_block_base_fee (without the random wei added to the estimate).
+    The fees are returned in the unit of base_fees, and aren't rounded to wei
+    """
+    base_fees, gas_used, gas_limits = np.broadcast_arrays(np.asarray(base_fees, dtype=np.float64),
+                                                          np.asarray(gas_used, dtype=np.float64),
+                                                          np.asarray(gas_limits, dtype=np.float64))
+    target_gas_used = gas_limits / 2
+    target_gas_used = np.where(target_gas_used == 0, 1, target_gas_used)
+    return base_fees + base_fees * (gas_used - target_gas_used) / target_gas_used / 8
+
+
+def _exchange_symbol(symbol: str) -> str:
+    return symbol.replace('/', '')
+
+
+def load_cex_quotes(reader: TickReader, symbol: str) -> Dict[str, Dict[str, np.ndarray]]:
+    """
+    :param symbol: ETH/USDT
+    :return: {exchange: {'ts': ..., 'bid': ..., 'bid_qty': ..., 'ask': ..., 'ask_qty': ...}}
+    """
+    symbol = _exchange_symbol(symbol)
+    if symbol not in reader.symbols:
+        return {}
+
+    table = reader.table('orderbook')
+    rows = ((table['symbol_id'] == reader.symbols.index(symbol)) &
+            (table['n_bids'] > 0) &
+            (table['n_asks'] > 0))
+
+    quotes = {}
+    for exchange_id in np.unique(table['exchange_id'][rows]):
+        selected = np.flatnonzero(rows & (table['exchange_id'] == exchange_id))
+        levels = table['levels'][selected].astype(np.float64)
+
+        price_decimals = table['price_decimals'][selected].astype(np.float64)
+        quantity_decimals = table['quantity_decimals'][selected].astype(np.float64)
+        price_scale = 10 ** -decimal_scales(price_decimals, reader.version)
+        quantity_scale = 10 ** -decimal_scales(quantity_decimals, reader.version)
+
+        ask = OrderbookSnapshot.DEPTH * 2
+        quotes[EXCHANGES[exchange_id]] = {
+            'ts': np.asarray(table['ts'][selected]),
+            'bid': levels[:, 0] * price_scale,
+            'bid_qty': levels[:, 1] * quantity_scale,
+            'ask': levels[:, ask] * price_scale,
+            'ask_qty': levels[:, ask + 1] * quantity_scale,
+        }
+    return quotes
+
+
+def load_pool_reserves(reader: TickReader) -> Dict[str, Dict[str, Any]]:
+    """
+    :return: {address: {'exchange': ..., 'token0': ..., 'token1': ..., 'decimals0': ..., 'decimals1': ...,
+                        'ts': ..., 'block_number': ..., 'reserve0': ..., 'reserve1': ...}}
+    """
+    table = reader.table('pool_update')
+    pool_ids = table['pool_id']
+
+    pools = {}
+    for pool_id, (exchange, version, address, token0, token1, decimals0, decimals1) in enumerate(reader.pools):
+        selected = np.flatnonzero(pool_ids == pool_id)
+        if version != 2 or len(selected) == 0:
+            continue
+        pools[address] = {
+            'exchange': exchange,
+            'token0': token0,
+            'token1': token1,
+            'decimals0': decimals0,
+            'decimals1': decimals1,
+            'ts': np.asarray(table['ts'][selected]),
+            'block_number': np.asarray(table['block_number'][selected]),
+            'reserve0': reserves_from_halves(table['reserve0_lo'][selected], table['reserve0_hi'][selected]),
+            'reserve1': reserves_from_halves(table['reserve1_lo'][selected], table['reserve1_hi'][selected]),
+        }
+    return pools
+
+
+def load_blocks(reader: TickReader) -> Dict[str, np.ndarray]:
+    """
+    :return: {'ts': ..., 'block_number': ..., 'base_fee': ..., 'next_base_fee': ...}, fees in ETH per gas,
+             the same as the block events of stream_new_blocks
+    """
+    table = reader.table('block')
+    return {column: np.asarray(table[column]) for column in ['ts', 'block_number', 'base_fee', 'next_base_fee']}
+
+
+def _optimal_trade(sim: UniswapV2Simulator,
+                   spread: np.ndarray,
+                   reserve_in: np.ndarray,
+                   reserve_out: np.ndarray,
+                   gamma: float,
+                   fee: int,
+                   rate: np.ndarray,
+                   capacity: np.ndarray):
+    """
+    Vectorized get_optimal_amount_in for a single CEX level:
+    swap amount_in on the pool, and convert the amount_out back at rate (raw in per raw out),
+    at most capacity (raw out).
+    The optimal trade is 0 unless the fee-adjusted spread is positive, so only those rows are simulated
+
+    :return: (amount_in, profit) raw token_in units
+    """
+    amount_in, profit = np.zeros(len(spread)), np.zeros(len(spread))
+
+    rows = np.flatnonzero(spread > 0)
+    if len(rows) == 0:
+        return amount_in, profit
+    reserve_in, reserve_out, rate, capacity = reserve_in[rows], reserve_out[rows], rate[rows], capacity[rows]
+
+    optimal_in = (np.sqrt(rate * gamma * reserve_in * reserve_out) - reserve_in) / gamma
+
+    # the amount_in that takes out exactly the CEX capacity
+    capacity = np.minimum(capacity, reserve_out * 0.999)
+    capacity_in = reserve_in * capacity / (gamma * (reserve_out - capacity))
+
+    optimal_in = np.floor(np.clip(np.minimum(optimal_in, capacity_in), 0, None))
+    # float64 reserves: exact, the same float math as get_amount_out
+    amount_out = sim.get_amounts_out(optimal_in, reserve_in, reserve_out, fee)
+
+    amount_in[rows] = optimal_in
+    profit[rows] = np.where(optimal_in > 0, amount_out * rate - optimal_in, 0)
+    return amount_in, profit
+
+
+def backtest_spreads(cex_quotes: Dict[str, Dict[str, np.ndarray]],
+                     pools: Dict[str, Dict[str, Any]],
+                     base: str,
+                     quote: str,
+                     blocks: Optional[Dict[str, np.ndarray]] = None,
+                     cex_fees: Dict[str, float] = CEX_FEES,
+                     pool_fee: int = 3000,
+                     gas: int = SWAP_GAS,
+                     priority_fee: float = 0,
+                     start: Optional[int] = None,
+                     end: Optional[int] = None) -> Dict[str, Any]:
+    """
+    :param cex_quotes: output of load_cex_quotes, or the same arrays from another source
+    :param pools: output of load_pool_reserves. Pools that don't trade base/quote are skipped
+    :param base, quote: the tokens of the CEX symbol (ex. 'ETH', 'USDT')
+    :param blocks: output of load_blocks. If given, reserves are joined as of the latest block at each timestamp,
+                   and gas is paid at that block's next_base_fee. If it has no next_base_fee,
+                   it's calculated from 'base_fee', 'gas_used', 'gas_limit' with next_block_base_fees
+    :param pool_fee: V2 pool fee in the simulator's format: 3000 (0.3%)
+    :param gas: gas used by the DEX swap
+    :param priority_fee: in gwei
+    :param start, end: only evaluate timestamps within [start, end)
+    :return: {'ts': timeline, 'pairs': [{'cex', 'dex', 'address', 'direction',
+                                        'spread', 'amount_in', 'profit', 'gas_cost', 'net_profit'}, ...]}
+             amount_in is in base (sell_dex) or quote (buy_dex) units, profits and costs in quote units
+    """
+    sim = UniswapV2Simulator()
+    gamma = (1000 - pool_fee // 1000) / 1000
+
+    # the timeline is every update of any of the inputs
+    timestamps = [quotes['ts'] for quotes in cex_quotes.values()] + [pool['ts'] for pool in pools.values()]
+    ts = np.sort(np.concatenate(timestamps)) if timestamps else np.zeros(0, dtype=np.int64)
+    if len(ts):
+        # np.sort + a mask of the changes is much faster than np.unique on int64
+        ts = ts[np.concatenate([[True], ts[1:] != ts[:-1]])]
+    if start is not None:
+        ts = ts[ts >= start]
+    if end is not None:
+        ts = ts[ts < end]
+
+    if blocks is not None and len(blocks['ts']):
+        block_idx = asof_indices(ts, blocks['ts'])
+        block_numbers = np.where(block_idx >= 0, blocks['block_number'][np.maximum(block_idx, 0)], -1)
+        if 'next_base_fee' in blocks:
+            next_base_fees = blocks['next_base_fee']
+        else:
+            next_base_fees = next_block_base_fees(blocks['base_fee'], blocks['gas_used'], blocks['gas_limit'])
+        next_base_fee = asof_join(ts, blocks['ts'], np.asarray(next_base_fees))
+    else:
+        block_numbers = None
+        next_base_fee = np.zeros(len(ts))
+
+    pairs = []
+
+    for address, pool in pools.items():
+        if {pool['token0'], pool['token1']} != {base, quote}:
+            continue
+
+        if block_numbers is not None:
+            idx = np.searchsorted(pool['block_number'], block_numbers, side='right') - 1
+        else:
+            idx = asof_indices(ts, pool['ts'])
+        missing = idx < 0
+        idx = np.maximum(idx, 0)
+
+        if pool['token0'] == base:
+            reserve_base, reserve_quote = pool['reserve0'][idx], pool['reserve1'][idx]
+            decimals_base, decimals_quote = pool['decimals0'], pool['decimals1']
+        else:
+            reserve_base, reserve_quote = pool['reserve1'][idx], pool['reserve0'][idx]
+            decimals_base, decimals_quote = pool['decimals1'], pool['decimals0']
+        reserve_base = np.where(missing, np.nan, reserve_base)
+        reserve_quote = np.where(missing, np.nan, reserve_quote)
+
+        dex_price = reserve_quote / reserve_base * 10 ** (decimals_base - decimals_quote)
+
+        for exchange, quotes in cex_quotes.items():
+            cex_fee = cex_fees.get(exchange, 0)
+
+            quote_idx = asof_indices(ts, quotes['ts'])
+            valid = (quote_idx >= 0) & ~missing
+            quote_idx = np.maximum(quote_idx, 0)
+            bid, bid_qty = quotes['bid'][quote_idx], quotes['bid_qty'][quote_idx]
+            ask, ask_qty = quotes['ask'][quote_idx], quotes['ask_qty'][quote_idx]
+
+            gas_cost = gas * (next_base_fee + priority_fee * 1e-9) * (bid + ask) / 2
+
+            # buy base on the DEX with quote, sell it on the CEX at the bid
+            spread = bid * (1 - cex_fee) / (dex_price / gamma) - 1
+            amount_in, profit = _optimal_trade(sim,
+                                               np.where(valid, spread, np.nan),
+                                               reserve_quote,
+                                               reserve_base,
+                                               gamma,
+                                               pool_fee,
+                                               bid * (1 - cex_fee) * 10 ** (decimals_quote - decimals_base),
+                                               bid_qty * 10 ** decimals_base)
+            pairs.append(_pair_result(exchange, pool['exchange'], address, 'buy_dex', valid, spread,
+                                      amount_in / 10 ** decimals_quote,
+                                      profit / 10 ** decimals_quote,
+                                      gas_cost))
+
+            # sell base on the DEX for quote, buy it back on the CEX at the ask
+            spread = dex_price * gamma / (ask * (1 + cex_fee)) - 1
+            amount_in, profit = _optimal_trade(sim,
+                                               np.where(valid, spread, np.nan),
+                                               reserve_base,
+                                               reserve_quote,
+                                               gamma,
+                                               pool_fee,
+                                               (1 - cex_fee) / ask * 10 ** (decimals_base - decimals_quote),
+                                               ask_qty * ask * 10 ** decimals_quote)
+            pairs.append(_pair_result(exchange, pool['exchange'], address, 'sell_dex', valid, spread,
+                                      amount_in / 10 ** decimals_base,
+                                      profit / 10 ** decimals_base * ask,
+                                      gas_cost))
+
+    return {'ts': ts, 'pairs': pairs}
+
+
+def _pair_result(cex: str,
+                 dex: str,
+                 address: str,
+                 direction: str,
+                 valid: np.ndarray,
+                 spread: np.ndarray,
+                 amount_in: np.ndarray,
+                 profit: np.ndarray,
+                 gas_cost: np.ndarray) -> Dict[str, Any]:
+    """
+    Timestamps before both sides have data are NaN
+    """
+    def _mask(values: np.ndarray) -> np.ndarray:
+        return np.where(valid, values, np.nan)
+
+    return {
+        'cex': cex,
+        'dex': dex,
+        'address': address,
+        'direction': direction,
+        'spread': _mask(spread),
+        'amount_in': _mask(amount_in),
+        'profit': _mask(profit),
+        'gas_cost': _mask(gas_cost),
+        'net_profit': _mask(profit - gas_cost),
+    }
+
+
+def summarize_backtest(result: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    Per pair: how often the spread was positive after fees, and the opportunities profitable after gas
+    """
+    summary = []
+    for pair in result['pairs']:
+        net_profit = pair['net_profit']
+        profitable = net_profit > 0
+        summary.append({
+            'pair': f'{pair["cex"]}/{pair["dex"]} {pair["address"][:10]} {pair["direction"]}',
+            'max_spread': float(np.nanmax(pair['spread'])) if np.any(~np.isnan(pair['spread'])) else None,
+            'positive_spread_ratio': float(np.mean(pair['spread'] > 0)) if len(net_profit) else 0,
+            'opportunities': int(profitable.sum()),
+            'max_net_profit': float(net_profit[profitable].max()) if profitable.any() else 0,
+            'total_net_profit': float(net_profit[profitable].sum()),
+        })
+    return summary
+
+
+if __name__ == '__main__':
+    import time
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Backtest CEX-DEX spreads on a recording (see recorder.py)')
+    parser.add_argument('path')
+    parser.add_argument('--symbol', default='ETH/USDT')
+    args = parser.parse_args()
+
+    base, quote = args.symbol.split('/')
+
+    s = time.time()
+    reader = TickReader(args.path)
+    result = backtest_spreads(load_cex_quotes(reader, args.symbol),
+                              load_pool_reserves(reader),
+                              base,
+                              quote,
+                              load_blocks(reader))
+    print(f'{len(result["ts"])} timestamps, {len(result["pairs"])} pairs: {time.time() - s:.3f} seconds')
+
+    for pair_summary in summarize_backtest(result):
+        print(pair_summary)
@@ -0,0 +1,213 @@
+import time
+import queue
+import asyncio
+import numpy as np
+import multiprocessing
+
+from functools import partial
+from typing import Any, Dict, List
+
+from aggregator import MultiOrderbook
+from constants import TOKENS, POOLS
+from event_bus import create_event_queue
+from replay_server import replay_urls, run_replay_server
+from utils import reconnecting_websocket_loop, get_stream_stats
+from cex_streams import stream_binance_usdm_orderbook, stream_okx_usdm_orderbook
+from dex_streams import PoolStateEngine, stream_new_blocks, stream_uniswap_v2_events
+
+
+"""
+End-to-end throughput/latency benchmark against replay_server.py
+
+The replay server runs in its own process, the streams run on this process' event loop,
+and the handler runs in another process, like in the notebook:
+
+replay server --> streams --> event_queue --> handler (MultiOrderbook + spread calculation)
+
+Latency is measured per orderbook event from the exchange timestamp set by the replay server
+(the time the frame was sent) to the time the handler is done with it.
+"""
+
+
+def _spread_handler(multi_orderbooks: Dict[str, MultiOrderbook],
+                    pool_prices: Dict[str, Dict[str, float]],
+                    event: Any):
+    """
+    The work of the notebook's event handler: update the books and compute the CEX-DEX spreads
+    """
+    symbol = event.get('symbol')
+
+    if event['type'] == 'orderbook':
+        if symbol not in multi_orderbooks:
+            multi_orderbooks[symbol] = MultiOrderbook(depth=5)
+        multi_orderbooks[symbol].update(event)
+
+    elif event['type'] == 'pool_update':
+        reserve0 = event['reserve0'] / 10 ** event['decimals0']
+        reserve1 = event['reserve1'] / 10 ** event['decimals1']
+        pool_prices.setdefault(symbol, {})[event['exchange']] = reserve1 / reserve0
+
+    multi_orderbook = multi_orderbooks.get(symbol)
+    if multi_orderbook is None:
+        return
+
+    best_bid, best_ask = multi_orderbook.best_bid(), multi_orderbook.best_ask()
+    if best_bid is None or best_ask is None:
+        return
+    for price in pool_prices.get(symbol, {}).values():
+        _ = (float(best_bid[0]) / price - 1, price / float(best_ask[0]) - 1)
+
+
+def benchmark_handler(event_queue: Any,
+                      result_queue: multiprocessing.Queue,
+                      stop: multiprocessing.Event,
+                      start: float,
+                      end: float):
+    """
+    Handles events until stop is set, and measures the events handled between start and end.
+    The queue keeps being drained after end, so that the streams never block on a full queue
+    """
+    multi_orderbooks = {}
+    pool_prices = {}
+    latencies = []
+    counts = {}
+
+    while not stop.is_set():
+        try:
+            event = event_queue.get_nowait()
+        except queue.Empty:
+            time.sleep(0.0001)
+            continue
+
+        _spread_handler(multi_orderbooks, pool_prices, event)
+
+        now = time.time()
+        if now < start or now > end:
+            continue
+
+        counts[event['type']] = counts.get(event['type'], 0) + 1
+        if event['type'] == 'orderbook' and event['timestamp'] is not None:
+            latencies.append(now * 1000 - event['timestamp'])
+
+    result_queue.put({'counts': counts, 'latencies': latencies})
+
+
+def summarize(result: Dict[str, Any], duration: float) -> Dict[str, Any]:
+    latencies = np.array(result['latencies']) if result['latencies'] else np.zeros(1)
+    total = sum(result['counts'].values())
+    return {
+        'events': total,
+        'events_per_sec': total / duration,
+        'counts': result['counts'],
+        'latency_ms_p50': float(np.percentile(latencies, 50)),
+        'latency_ms_p99': float(np.percentile(latencies, 99)),
+        'latency_ms_max': float(latencies.max()),
+    }
+
+
+def run_benchmark(duration: float = 30,
+                  speed: float = 10,
+                  symbols: List[str] = ['ETH/USDT'],
+                  queue_kind: str = 'aioprocessing',
+                  port: int = 8765,
+                  dex: bool = True,
+                  recording: str = None) -> Dict[str, Any]:
+    """
+    :param speed: replay rate as a multiple of the real rate
+    :param queue_kind: the event_queue passed to create_event_queue: 'aioprocessing', 'shm'
+    :param dex: also stream new blocks and Sync events
+    """
+    server = multiprocessing.Process(
+        target=run_replay_server,
+        kwargs={'port': port, 'symbols': symbols, 'speed': speed, 'recording': recording},
+        daemon=True,
+    )
+    server.start()
+    time.sleep(1)
+
+    urls = replay_urls('127.0.0.1', port)
+
+    event_queue = create_event_queue(queue_kind)
+    result_queue = multiprocessing.Queue()
+    stop = multiprocessing.Event()
+
+    # the first second is a warm up (connections, bootstrap multicall)
+    start = time.time() + 1
+    end = start + duration
+
+    handler = multiprocessing.Process(target=benchmark_handler,
+                                      args=(event_queue, result_queue, stop, start, end))
+    handler.start()
+
+    async def _streams():
+        streams = [
+            reconnecting_websocket_loop(
+                partial(stream_binance_usdm_orderbook, symbols, event_queue, False, False, urls['binance_ws_url']),
+                tag='binance_stream'
+            ),
+            reconnecting_websocket_loop(
+                partial(stream_okx_usdm_orderbook, symbols, event_queue, False, False,
+                        urls['okx_ws_url'], urls['okx_instruments_url']),
+                tag='okx_stream'
+            ),
+        ]
+        pool_state_engine = None
+        if dex:
+            pool_state_engine = PoolStateEngine(TOKENS, POOLS, event_queue)
+            streams += [
+                reconnecting_websocket_loop(
+                    partial(stream_new_blocks, urls['ws_rpc_url'], event_queue, False, pool_state_engine),
+                    tag='new_blocks_stream'
+                ),
+                reconnecting_websocket_loop(
+                    partial(stream_uniswap_v2_events, urls['http_rpc_url'], urls['ws_rpc_url'],
+                            TOKENS, POOLS, event_queue, False, pool_state_engine),
+                    tag='uniswap_v2_stream'
+                ),
+            ]
+
+        tasks = [asyncio.ensure_future(stream) for stream in streams]
+        await asyncio.sleep(duration + 1)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if pool_state_engine is not None and pool_state_engine.rpc_client is not None:
+            await pool_state_engine.rpc_client.close()
+
+    try:
+        asyncio.run(_streams())
+        stop.set()
+        result = result_queue.get(timeout=30)
+    finally:
+        stop.set()
+        handler.join(timeout=5)
+        server.terminate()
+        server.join()
+        if queue_kind == 'shm':
+            event_queue.close()
+
+    summary = summarize(result, duration)
+    summary['streams'] = get_stream_stats()
+    return summary
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmark the streams, event queue and handler against replay_server.py')
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--speed', type=float, default=10, help='multiple of the real rate')
+    parser.add_argument('--queue', default='aioprocessing', choices=['aioprocessing', 'shm'])
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--no-dex', action='store_true')
+    parser.add_argument('--recording', default=None, help='recorder.py recording directory to replay')
+    args = parser.parse_args()
+
+    summary = run_benchmark(args.duration, args.speed, ['ETH/USDT'], args.queue, args.port,
+                            not args.no_dex, args.recording)
+
+    print(f'events: {summary["events"]} ({summary["events_per_sec"]:.1f}/s) {summary["counts"]}')
+    print(f'latency (ms): p50 {summary["latency_ms_p50"]:.3f}, '
+          f'p99 {summary["latency_ms_p99"]:.3f}, max {summary["latency_ms_max"]:.3f}')
+    for stats in summary['streams'].values():
+        print(stats)
@@ -1,4 +1,5 @@
 import json
+import time
 import asyncio
 import requests
 import websockets
@@ -6,13 +7,41 @@ import aioprocessing
 
 from typing import List
 from decimal import Decimal
+from fractions import Fraction
+
+from utils import to_fixed, record_message
+from metrics import record_received
+from events import OrderbookSnapshot
+from decoders import decode_binance_depth, decode_okx_books
+from constants import CEX_SCALES, DEFAULT_CEX_SCALE
+
+
+BINANCE_USDM_WS_URL = 'wss://fstream.binance.com/ws/'
+OKX_WS_URL = 'wss://ws.okx.com:8443/ws/v5/public'
+OKX_INSTRUMENTS_URL = 'https://www.okx.com/api/v5/public/instruments?instType=SWAP'
+
+
+def _cex_scales(symbols: List[str]):
+    """
+    Returns the fixed-point scales keyed by the exchange symbol format: {'ETHUSDT': [2, 3]}
+    """
+    return {s.replace('/', ''): CEX_SCALES.get(s, DEFAULT_CEX_SCALE) for s in symbols}
 
 
 # Binance USDM-Futures orderbook stream
 async def stream_binance_usdm_orderbook(symbols: List[str],
                                         event_queue: aioprocessing.AioQueue,
-                                        debug: bool = False):
-    async with websockets.connect('wss://fstream.binance.com/ws/') as ws:
+                                        debug: bool = False,
+                                        fixed_point: bool = False,
+                                        ws_url: str = BINANCE_USDM_WS_URL):
+    """
+    :param fixed_point: if True, prices and quantities are published as integers
+                        scaled by the symbol's decimals in constants.CEX_SCALES
+    :param ws_url: override to connect to a replay server (see replay_server.py)
+    """
+    scales = _cex_scales(symbols)
+    
+    async with websockets.connect(ws_url) as ws:
         params = [
             f'{s.replace("/", "").lower()}@depth5@100ms' for s in symbols]
         subscription = {
@@ -25,15 +54,25 @@ async def stream_binance_usdm_orderbook(symbols: List[str],
 
         while True:
             msg = await asyncio.wait_for(ws.recv(), timeout=15)
-            data = json.loads(msg)
-            orderbook = {
-                'source': 'cex',
-                'type': 'orderbook',
-                'exchange': 'binance',
-                'symbol': data['s'],
-                'bids': [[Decimal(d[0]), Decimal(d[1])] for d in data['b']],
-                'asks': [[Decimal(d[0]), Decimal(d[1])] for d in data['a']],
-            }
+            recv_ns = time.monotonic_ns()
+            data = decode_binance_depth(msg)
+            record_message(time.time() - data.event_time / 1000)
+            if fixed_point:
+                price_decimals, quantity_decimals = scales[data.symbol]
+                bids = [[to_fixed(d[0], price_decimals), to_fixed(d[1], quantity_decimals)] for d in data.bids]
+                asks = [[to_fixed(d[0], price_decimals), to_fixed(d[1], quantity_decimals)] for d in data.asks]
+            else:
+                price_decimals, quantity_decimals = None, None
+                bids = [[Decimal(d[0]), Decimal(d[1])] for d in data.bids]
+                asks = [[Decimal(d[0]), Decimal(d[1])] for d in data.asks]
+            orderbook = OrderbookSnapshot('binance',
+                                          data.symbol,
+                                          bids,
+                                          asks,
+                                          price_decimals,
+                                          quantity_decimals,
+                                          data.event_time)
+            record_received('binance', orderbook, recv_ns, data.event_time)
             if not debug:
                 event_queue.put(orderbook)
             else:
@@ -44,14 +83,31 @@ async def stream_binance_usdm_orderbook(symbols: List[str],
 # At OKX, they call perpetuals by the name of swaps.
 async def stream_okx_usdm_orderbook(symbols: List[str],
                                     event_queue: aioprocessing.AioQueue,
-                                    debug: bool = False):
-    instruments = requests.get('https://www.okx.com/api/v5/public/instruments?instType=SWAP').json()
+                                    debug: bool = False,
+                                    fixed_point: bool = False,
+                                    ws_url: str = OKX_WS_URL,
+                                    instruments_url: str = OKX_INSTRUMENTS_URL):
+    """
+    :param fixed_point: if True, prices and quantities are published as integers
+                        scaled by the symbol's decimals in constants.CEX_SCALES
+    :param ws_url, instruments_url: override to connect to a replay server (see replay_server.py)
+    """
+    scales = _cex_scales(symbols)
+    
+    # fetched on a thread, so that the other streams on the event loop are not blocked
+    response = await asyncio.to_thread(requests.get, instruments_url)
+    instruments = response.json()
     multipliers = {
         d['instId'].replace('USD', 'USDT'): Decimal(d['ctMult']) / Decimal(d['ctVal'])
         for d in instruments['data']
     }
+    # the same multipliers as exact fractions, so that sizes can be scaled with integer math only
+    fixed_multipliers = {
+        d['instId'].replace('USD', 'USDT'): Fraction(d['ctMult']) / Fraction(d['ctVal'])
+        for d in instruments['data']
+    }
     
-    async with websockets.connect('wss://ws.okx.com:8443/ws/v5/public') as ws:
+    async with websockets.connect(ws_url) as ws:
         args = [{'channel': 'books5', 'instId': f'{s.replace("/", "-")}-SWAP'} for s in symbols]
         subscription = {
             'op': 'subscribe',
@@ -62,19 +118,31 @@ async def stream_okx_usdm_orderbook(symbols: List[str],
 
         while True:
             msg = await asyncio.wait_for(ws.recv(), timeout=15)
-            data = json.loads(msg)
-            multiplier = multipliers[data['arg']['instId']]
-            symbol = data['arg']['instId'].replace('-SWAP', '').replace('-', '')
-            bids = [[Decimal(d[0]), Decimal(d[1]) * multiplier] for d in data['data'][0]['bids']]
-            asks = [[Decimal(d[0]), Decimal(d[1]) * multiplier] for d in data['data'][0]['asks']]
-            orderbook = {
-                'source': 'cex',
-                'type': 'orderbook',
-                'exchange': 'okx',
-                'symbol': symbol,
-                'bids':  bids,
-                'asks': asks,
-            }
+            recv_ns = time.monotonic_ns()
+            data = decode_okx_books(msg)
+            record_message(time.time() - data.ts / 1000)
+            symbol = data.inst_id.replace('-SWAP', '').replace('-', '')
+            if fixed_point:
+                multiplier = fixed_multipliers[data.inst_id]
+                numerator, denominator = multiplier.numerator, multiplier.denominator
+                price_decimals, quantity_decimals = scales[symbol]
+                bids = [[to_fixed(d[0], price_decimals), to_fixed(d[1], quantity_decimals) * numerator // denominator]
+                        for d in data.bids]
+                asks = [[to_fixed(d[0], price_decimals), to_fixed(d[1], quantity_decimals) * numerator // denominator]
+                        for d in data.asks]
+            else:
+                price_decimals, quantity_decimals = None, None
+                multiplier = multipliers[data.inst_id]
+                bids = [[Decimal(d[0]), Decimal(d[1]) * multiplier] for d in data.bids]
+                asks = [[Decimal(d[0]), Decimal(d[1]) * multiplier] for d in data.asks]
+            orderbook = OrderbookSnapshot('okx',
+                                          symbol,
+                                          bids,
+                                          asks,
+                                          price_decimals,
+                                          quantity_decimals,
+                                          data.ts)
+            record_received('okx', orderbook, recv_ns, data.ts)
             if not debug:
                 event_queue.put(orderbook)
             else:
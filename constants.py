@@ -1,6 +1,7 @@
 TOKENS = {
     'ETH': ['0xC02aaA39b223FE8D0A0e5C4F27eAD9083C756Cc2', 18],
     'USDT': ['0xdAC17F958D2ee523a2206206994597C13D831ec7', 6],
+    'USDC': ['0xA0b86991c6218b36c1d19D4a2e9Eb0cE3606eB48', 6],
 }
 
 columns = ['exchange', 'version', 'name', 'address', 'fee', 'token0', 'token1']
@@ -8,6 +9,53 @@ columns = ['exchange', 'version', 'name', 'address', 'fee', 'token0', 'token1']
 POOLS = [
     ['uniswap', 2, 'ETH/USDT', '0x0d4a11d5EEaaC28EC3F61d100daF4d40471f1852', 3000, 'ETH', 'USDT'],
     ['sushiswap', 2, 'ETH/USDT', '0x06da0fd433C1A5d7a4faa01111c044910A184553', 3000, 'ETH', 'USDT'],
+    ['uniswap', 3, 'ETH/USDT', '0x11b815efB8f581194ae79006d24E0d814B7697F6', 500, 'ETH', 'USDT'],
+    ['uniswap', 3, 'ETH/USDT', '0x4e68Ccd3E89f51C3074ca5072bbAC773960dFa36', 3000, 'ETH', 'USDT'],
 ]
 
-POOLS = [dict(zip(columns, pool)) for pool in POOLS]
\ No newline at end of file
+POOLS = [dict(zip(columns, pool)) for pool in POOLS]
+
+"""
+Pools of the indirect routes (ETH --> USDC --> USDT), only used by routing.Router.
+They are kept out of POOLS, because the notebook's handlers expect every pool in POOLS to trade a CEX symbol
+"""
+ROUTING_POOLS = [
+    ['uniswap', 2, 'USDC/ETH', '0xB4e16d0168e52d35CaCD2c6185b44281Ec28C9Dc', 3000, 'USDC', 'ETH'],
+    ['sushiswap', 2, 'USDC/ETH', '0x397FF1542f962076d0BFE58eA045FfA2d347ACa0', 3000, 'USDC', 'ETH'],
+    ['uniswap', 2, 'USDC/USDT', '0x3041CbD36888bECc7bbCBc0045E3B1f144466f5f', 3000, 'USDC', 'USDT'],
+]
+
+ROUTING_POOLS = POOLS + [dict(zip(columns, pool)) for pool in ROUTING_POOLS]
+
+# Uniswap V3 tick spacing by fee tier
+TICK_SPACINGS = {
+    100: 1,
+    500: 10,
+    3000: 60,
+    10000: 200,
+}
+
+"""
+Tick/lot scales of CEX symbols used in fixed-point mode: [price_decimals, quantity_decimals]
+Prices and quantities are stored as integers scaled by 10 ** decimals
+(ex. ETH/USDT 1850.12 --> 185012)
+"""
+CEX_SCALES = {
+    'ETH/USDT': [2, 3],
+}
+
+DEFAULT_CEX_SCALE = [8, 8]
+
+"""
+CEX taker fees (Tier: LV 1), same as the notebook's event handlers
+
+- OKX: https://www.okx.com/fees
+- Binance: https://www.binance.com/en/fee/futureFee
+"""
+CEX_FEES = {
+    'binance': 0.0004,  # 0.04%
+    'okx': 0.0005,      # 0.05%
+}
+
+# gas used by a single V2 swap
+SWAP_GAS = 150000
@@ -0,0 +1,221 @@
+import json
+
+from typing import Any, Dict, List, Union
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+try:
+    import orjson
+    loads = orjson.loads
+except ImportError:
+    loads = json.loads
+
+
+"""
+Decoders for the websocket messages of each stream
+
+Each message kind has a typed record with only the fields the streams use.
+If msgspec is installed, messages are decoded straight into typed msgspec Structs with precompiled
+decoders, and no intermediate dicts are built. Otherwise, messages are parsed with orjson
+(or json as a last resort) and copied into __slots__ records with the same attributes.
+
+Prices and sizes are kept as the exchange's strings, so that the streams can convert them
+to Decimal or fixed-point integers. Hex quantities are converted to int once.
+
+Messages that don't match a schema (subscription responses, errors) are returned as dicts
+by decode_log/decode_new_head, so the streams can handle them separately.
+"""
+
+
+if msgspec is not None:
+
+    class BinanceDepthUpdate(msgspec.Struct):
+        symbol: str = msgspec.field(name='s')
+        event_time: int = msgspec.field(name='E')
+        transaction_time: int = msgspec.field(name='T')
+        bids: List[List[str]] = msgspec.field(name='b')
+        asks: List[List[str]] = msgspec.field(name='a')
+
+    class _OkxArg(msgspec.Struct):
+        instId: str
+
+    class _OkxBook(msgspec.Struct):
+        bids: List[List[str]]
+        asks: List[List[str]]
+        ts: str
+
+    class OkxBooks(msgspec.Struct):
+        arg: _OkxArg
+        data: List[_OkxBook]
+
+        @property
+        def inst_id(self) -> str:
+            return self.arg.instId
+
+        @property
+        def bids(self) -> List[List[str]]:
+            return self.data[0].bids
+
+        @property
+        def asks(self) -> List[List[str]]:
+            return self.data[0].asks
+
+        @property
+        def ts(self) -> int:
+            return int(self.data[0].ts)
+
+    class _NewHeadResult(msgspec.Struct):
+        number: str
+        timestamp: str
+        baseFeePerGas: str
+        gasUsed: str
+        gasLimit: str
+
+    class _NewHeadParams(msgspec.Struct):
+        result: _NewHeadResult
+
+    class NewHead(msgspec.Struct):
+        params: _NewHeadParams
+
+        @property
+        def number(self) -> int:
+            return int(self.params.result.number, base=16)
+
+        @property
+        def timestamp(self) -> int:
+            return int(self.params.result.timestamp, base=16)
+
+        @property
+        def base_fee(self) -> int:
+            return int(self.params.result.baseFeePerGas, base=16)
+
+        @property
+        def gas_used(self) -> int:
+            return int(self.params.result.gasUsed, base=16)
+
+        @property
+        def gas_limit(self) -> int:
+            return int(self.params.result.gasLimit, base=16)
+
+    class _LogResult(msgspec.Struct):
+        address: str
+        topics: List[str]
+        data: str
+        blockNumber: str
+        logIndex: str
+        removed: bool = False
+
+    class _LogParams(msgspec.Struct):
+        result: _LogResult
+
+    class Log(msgspec.Struct):
+        params: _LogParams
+
+        @property
+        def address(self) -> str:
+            return self.params.result.address.lower()
+
+        @property
+        def topics(self) -> List[str]:
+            return self.params.result.topics
+
+        @property
+        def data(self) -> str:
+            return self.params.result.data
+
+        @property
+        def block_number(self) -> int:
+            return int(self.params.result.blockNumber, base=16)
+
+        @property
+        def log_index(self) -> int:
+            return int(self.params.result.logIndex, base=16)
+
+        @property
+        def removed(self) -> bool:
+            return self.params.result.removed
+
+    _binance_depth_decoder = msgspec.json.Decoder(BinanceDepthUpdate)
+    _okx_books_decoder = msgspec.json.Decoder(OkxBooks)
+    _new_head_decoder = msgspec.json.Decoder(NewHead)
+    _log_decoder = msgspec.json.Decoder(Log)
+
+    def decode_binance_depth(msg: Union[str, bytes]) -> BinanceDepthUpdate:
+        return _binance_depth_decoder.decode(msg)
+
+    def decode_okx_books(msg: Union[str, bytes]) -> OkxBooks:
+        return _okx_books_decoder.decode(msg)
+
+    def decode_new_head(msg: Union[str, bytes]) -> Union[NewHead, Dict[str, Any]]:
+        try:
+            return _new_head_decoder.decode(msg)
+        except msgspec.ValidationError:
+            return msgspec.json.decode(msg)
+
+    def decode_log(msg: Union[str, bytes]) -> Union[Log, Dict[str, Any]]:
+        try:
+            return _log_decoder.decode(msg)
+        except msgspec.ValidationError:
+            return msgspec.json.decode(msg)
+
+else:
+
+    class BinanceDepthUpdate:
+        __slots__ = ('symbol', 'event_time', 'transaction_time', 'bids', 'asks')
+
+        def __init__(self, data: Dict[str, Any]):
+            self.symbol = data['s']
+            self.event_time = data['E']
+            self.transaction_time = data['T']
+            self.bids = data['b']
+            self.asks = data['a']
+
+    class OkxBooks:
+        __slots__ = ('inst_id', 'bids', 'asks', 'ts')
+
+        def __init__(self, data: Dict[str, Any]):
+            book = data['data'][0]
+            self.inst_id = data['arg']['instId']
+            self.bids = book['bids']
+            self.asks = book['asks']
+            self.ts = int(book['ts'])
+
+    class NewHead:
+        __slots__ = ('number', 'timestamp', 'base_fee', 'gas_used', 'gas_limit')
+
+        def __init__(self, data: Dict[str, Any]):
+            block = data['params']['result']
+            self.number = int(block['number'], base=16)
+            self.timestamp = int(block['timestamp'], base=16)
+            self.base_fee = int(block['baseFeePerGas'], base=16)
+            self.gas_used = int(block['gasUsed'], base=16)
+            self.gas_limit = int(block['gasLimit'], base=16)
+
+    class Log:
+        __slots__ = ('address', 'topics', 'data', 'block_number', 'log_index', 'removed')
+
+        def __init__(self, data: Dict[str, Any]):
+            log = data['params']['result']
+            self.address = log['address'].lower()
+            self.topics = log['topics']
+            self.data = log['data']
+            self.block_number = int(log['blockNumber'], base=16)
+            self.log_index = int(log['logIndex'], base=16)
+            self.removed = log.get('removed', False)
+
+    def decode_binance_depth(msg: Union[str, bytes]) -> BinanceDepthUpdate:
+        return BinanceDepthUpdate(loads(msg))
+
+    def decode_okx_books(msg: Union[str, bytes]) -> OkxBooks:
+        return OkxBooks(loads(msg))
+
+    def decode_new_head(msg: Union[str, bytes]) -> Union[NewHead, Dict[str, Any]]:
+        data = loads(msg)
+        return NewHead(data) if 'params' in data else data
+
+    def decode_log(msg: Union[str, bytes]) -> Union[Log, Dict[str, Any]]:
+        data = loads(msg)
+        return Log(data) if 'params' in data else data
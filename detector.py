@@ -0,0 +1,308 @@
+import time
+import queue
+import aioprocessing
+
+from typing import Any, Dict, List, Optional
+
+from aggregator import MultiOrderbook
+from simulator import UniswapV2Simulator
+from events import Opportunity
+from metrics import record_dequeued, record_handled
+from constants import CEX_FEES, SWAP_GAS
+
+
+class OpportunityDetector:
+    """
+    Keeps the CEX MultiOrderbooks and the DEX pool states of every symbol,
+    and evaluates the CEX-DEX arbitrage of a symbol only when one of its inputs changed
+
+    on_event updates the state and marks the symbol dirty:
+
+    - orderbook: the symbol, if the snapshot differs from the last one of that exchange
+    - pool_update: the symbol of the pool's tokens
+    - block: every symbol with pools, since the gas cost changed
+
+    evaluate re-prices the dirty symbols in one batch, so with hundreds of symbols
+    an event costs a dict update, and a symbol is priced once per batch no matter how many
+    of its events were in it. run does this per loop iteration: it drains the event_queue,
+    then evaluates.
+
+    For every pool of a dirty symbol and both directions, the optimal size is found with
+    UniswapV2Simulator.get_optimal_amount_in, walking the merged CEX depth with each level's
+    exchange taker fee. Opportunities with a net profit (after gas at the next base fee) above
+    min_profit are returned as events.Opportunity.
+
+    * The CEX streams of a symbol should all run in the same mode (Decimal or fixed_point),
+    since MultiOrderbook merges the levels by their raw prices.
+    """
+
+    def __init__(self,
+                 symbols: List[str],
+                 pools: List[Dict[str, Any]],
+                 cex_fees: Dict[str, float] = CEX_FEES,
+                 gas: int = SWAP_GAS,
+                 min_profit: float = 0,
+                 depth: Optional[int] = 10,
+                 gas_symbols: Optional[List[str]] = None):
+        """
+        :param symbols: ['ETH/USDT', ...]
+        :param pools: constants.POOLS, for the pool fees
+        :param gas: gas used by the DEX swap
+        :param min_profit: in quote token units
+        :param depth: the number of merged CEX levels walked
+        :param gas_symbols: ETH/quote symbols whose books are only kept to convert the gas cost,
+                            when they are evaluated by another detector (see sharding.py)
+        """
+        self.cex_fees = cex_fees
+        self.gas = gas
+        self.min_profit = min_profit
+        self.depth = depth
+
+        self.sim = UniswapV2Simulator()
+        self.pool_fees = {pool['address'].lower(): pool['fee'] for pool in pools}
+
+        # symbols are keyed by the exchange format (ETHUSDT), the same as the event symbols
+        self.symbols = {}
+        self.token_symbols = {}
+        for symbol in symbols:
+            base, quote = symbol.split('/')
+            key = f'{base}{quote}'
+            self.symbols[key] = (base, quote)
+            self.token_symbols[frozenset([base, quote])] = key
+
+        self.multi_orderbooks = {key: MultiOrderbook(depth) for key in self.symbols}
+        for symbol in gas_symbols or []:
+            self.multi_orderbooks.setdefault(symbol.replace('/', ''), MultiOrderbook(depth))
+        self.pools = {key: {} for key in self.symbols}
+
+        # (symbol, exchange) --> (price scale, quantity scale) of fixed-point snapshots
+        self.scales = {}
+
+        self.block_number = None
+        self.next_base_fee = 0
+
+        self.dirty = set()
+
+        self.events = 0
+        self.evaluations = 0
+
+    def on_event(self, event: Any):
+        self.events += 1
+        event_type = event['type']
+
+        if event_type == 'orderbook':
+            symbol = event['symbol']
+            multi_orderbook = self.multi_orderbooks.get(symbol)
+            if multi_orderbook is None:
+                return
+
+            exchange = event['exchange']
+            if multi_orderbook.orderbooks.get(exchange) == (event['bids'], event['asks']):
+                return
+
+            if event['price_decimals'] is not None:
+                self.scales[(symbol, exchange)] = (10 ** -event['price_decimals'], 10 ** -event['quantity_decimals'])
+            multi_orderbook.update(event)
+            if symbol in self.symbols:
+                self.dirty.add(symbol)
+
+        elif event_type == 'pool_update':
+            symbol = self.token_symbols.get(frozenset([event['token0'], event['token1']]))
+            if symbol is None:
+                return
+            self.pools[symbol][event['address']] = event
+            self.dirty.add(symbol)
+
+        elif event_type == 'block':
+            self.block_number = event['block_number']
+            self.next_base_fee = event['next_base_fee']
+            self.dirty.update(symbol for symbol, pools in self.pools.items() if pools)
+
+    def _levels(self, symbol: str, side: str) -> List[List[Any]]:
+        """
+        The merged CEX levels as floats, with the taker fee of each level's exchange in the price:
+        the price received when selling (bids), the price paid when buying (asks)
+        """
+        levels = []
+        for price, quantity, exchange in self.multi_orderbooks[symbol][side]:
+            price_scale, quantity_scale = self.scales.get((symbol, exchange), (1, 1))
+            fee = self.cex_fees.get(exchange, 0)
+            price = float(price) * price_scale
+            price = price * (1 - fee) if side == 'bids' else price / (1 - fee)
+            levels.append([price, float(quantity) * quantity_scale, exchange])
+
+        # the fees differ by exchange, so the order can change
+        levels.sort(key=lambda level: level[0], reverse=side == 'bids')
+        return levels
+
+    @staticmethod
+    def _allocation(levels: List[List[Any]], amount: float, in_quote: bool = False) -> Dict[str, float]:
+        """
+        The base quantity filled per exchange, walking the levels in the order get_optimal_amount_in does
+
+        :param amount: the base amount sold on the bids, or the quote amount spent on the asks if in_quote
+        """
+        allocation = {}
+        remaining = amount
+        for price, quantity, exchange in levels:
+            if remaining <= 0:
+                break
+            capacity = quantity * price if in_quote else quantity
+            filled = min(capacity, remaining)
+            allocation[exchange] = allocation.get(exchange, 0) + (filled / price if in_quote else filled)
+            remaining -= filled
+        return allocation
+
+    @staticmethod
+    def _cex(allocation: Dict[str, float], levels: List[List[Any]]) -> str:
+        if len(allocation) > 1:
+            return 'multi'
+        return next(iter(allocation), levels[0][2])
+
+    def _gas_cost(self, quote: str) -> float:
+        """
+        The gas cost in quote token units, converted at the ETH/quote mid. 0 if ETH/quote isn't tracked
+        """
+        multi_orderbook = self.multi_orderbooks.get(f'ETH{quote}')
+        if multi_orderbook is None:
+            return 0
+        best_bid, best_ask = multi_orderbook.best_bid(), multi_orderbook.best_ask()
+        if best_bid is None or best_ask is None:
+            return 0
+        price_scale = self.scales.get((f'ETH{quote}', best_bid[2]), (1, 1))[0]
+        mid = (float(best_bid[0]) + float(best_ask[0])) / 2 * price_scale
+        return self.gas * self.next_base_fee * mid
+
+    def _evaluate_symbol(self, symbol: str) -> List[Opportunity]:
+        base, quote = self.symbols[symbol]
+        bids, asks = self._levels(symbol, 'bids'), self._levels(symbol, 'asks')
+        if not bids or not asks:
+            return []
+
+        gas_cost = self._gas_cost(quote)
+
+        opportunities = []
+        for address, pool in self.pools[symbol].items():
+            if pool['token0'] == base:
+                reserve_base, reserve_quote = pool['reserve0'], pool['reserve1']
+                decimals_base, decimals_quote = pool['decimals0'], pool['decimals1']
+            else:
+                reserve_base, reserve_quote = pool['reserve1'], pool['reserve0']
+                decimals_base, decimals_quote = pool['decimals1'], pool['decimals0']
+            fee = self.pool_fees.get(address.lower(), 3000)
+
+            # buy base on the DEX, sell it on the CEX bids. The fees are already in the level prices
+            amount_in, amount_out, profit = self.sim.get_optimal_amount_in(
+                reserve_base, reserve_quote, decimals_base, decimals_quote, fee, False,
+                cex_orderbook=[level[:2] for level in bids])
+            if profit - gas_cost > self.min_profit:
+                allocation = self._allocation(bids, amount_out)
+                opportunities.append(Opportunity(symbol, 'buy_dex', self._cex(allocation, bids), pool['exchange'],
+                                                 address, amount_out, amount_in, amount_out, profit, gas_cost,
+                                                 self.block_number, allocation))
+
+            # sell base on the DEX, buy it back on the CEX asks. The profit is in base, valued at the best ask
+            amount_in, amount_out, profit = self.sim.get_optimal_amount_in(
+                reserve_base, reserve_quote, decimals_base, decimals_quote, fee, True,
+                cex_orderbook=[level[:2] for level in asks])
+            profit = profit * asks[0][0]
+            if profit - gas_cost > self.min_profit:
+                # the quote received on the DEX buys the base back on the asks
+                allocation = self._allocation(asks, amount_out, in_quote=True)
+                opportunities.append(Opportunity(symbol, 'sell_dex', self._cex(allocation, asks), pool['exchange'],
+                                                 address, amount_in, amount_in, amount_out, profit, gas_cost,
+                                                 self.block_number, allocation))
+        return opportunities
+
+    def evaluate(self) -> List[Opportunity]:
+        """
+        Evaluates the dirty symbols, and marks them clean
+        """
+        opportunities = []
+        for symbol in self.dirty:
+            if self.pools[symbol]:
+                self.evaluations += 1
+                opportunities.extend(self._evaluate_symbol(symbol))
+        self.dirty.clear()
+        return opportunities
+
+    async def run(self,
+                  event_queue: aioprocessing.AioQueue,
+                  publish_queue: Optional[Any] = None,
+                  max_batch: int = 1000):
+        """
+        :param publish_queue: opportunities are put into this queue. They are printed if None
+        :param max_batch: the maximum number of events handled before evaluating
+
+        The handler latency of every event in a batch is measured up to the batch's opportunities
+        being published (see metrics.py)
+        """
+        while True:
+            batch = [await event_queue.coro_get()]
+            record_dequeued(batch[0])
+            self.on_event(batch[0])
+            for _ in range(max_batch - 1):
+                try:
+                    event = event_queue.get_nowait()
+                except queue.Empty:
+                    break
+                record_dequeued(event)
+                self.on_event(event)
+                batch.append(event)
+
+            for opportunity in self.evaluate():
+                if publish_queue is not None:
+                    publish_queue.put(opportunity)
+                else:
+                    print(opportunity)
+
+            now_ns = time.monotonic_ns()
+            for event in batch:
+                record_handled(event, now_ns)
+
+
+if __name__ == '__main__':
+    import os
+    import asyncio
+    from functools import partial
+    from dotenv import load_dotenv
+
+    from constants import TOKENS, POOLS
+    from utils import reconnecting_websocket_loop
+    from cex_streams import stream_binance_usdm_orderbook, stream_okx_usdm_orderbook
+    from dex_streams import PoolStateEngine, stream_new_blocks, stream_uniswap_v2_events
+
+    load_dotenv(override=True)
+
+    HTTP_RPC_URL = os.getenv('HTTP_RPC_URL')
+    WS_RPC_URL = os.getenv('WS_RPC_URL')
+
+    symbols = ['ETH/USDT']
+
+    async def main():
+        event_queue = aioprocessing.AioQueue()
+        pool_state_engine = PoolStateEngine(TOKENS, POOLS, event_queue)
+        detector = OpportunityDetector(symbols, POOLS)
+
+        await asyncio.gather(
+            reconnecting_websocket_loop(
+                partial(stream_binance_usdm_orderbook, symbols, event_queue),
+                tag='binance_stream'
+            ),
+            reconnecting_websocket_loop(
+                partial(stream_okx_usdm_orderbook, symbols, event_queue),
+                tag='okx_stream'
+            ),
+            reconnecting_websocket_loop(
+                partial(stream_new_blocks, WS_RPC_URL, event_queue, False, pool_state_engine),
+                tag='new_blocks_stream'
+            ),
+            reconnecting_websocket_loop(
+                partial(stream_uniswap_v2_events, HTTP_RPC_URL, WS_RPC_URL, TOKENS, POOLS, event_queue, False,
+                        pool_state_engine),
+                tag='uniswap_v2_stream'
+            ),
+            detector.run(event_queue),
+        )
+
+    asyncio.run(main())
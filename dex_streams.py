@@ -1,55 +1,512 @@
 import os
-import json
+import time
 import eth_abi
 import asyncio
 import eth_utils
-import websockets
 import aioprocessing
 
-from web3 import Web3
 from functools import partial
-from typing import Any, Dict, List
-from multicall import Call, Multicall
+from typing import Any, Dict, List, Optional
 
+from events import PoolUpdate, StateRecovery
 from constants import TOKENS, POOLS
-from utils import calculate_next_block_base_fee
+from decoders import decode_log, decode_new_head
+from utils import next_block_base_fee, record_message
+from metrics import record_received
+from rpc import RpcWebsocketClient, HttpRpcClient, rpc_client_session
+from multicall3 import fetch_v2_reserves, get_block_number
+
+
+SYNC_EVENT_SELECTOR = '0x' + eth_utils.keccak(text='Sync(uint112,uint112)').hex()
+
+
+class LogSubscriptions:
+    """
+    Manages eth_subscribe('logs') subscriptions filtered by contract addresses on a RpcWebsocketClient
+
+    Subscribing to a topic without an address filter makes the node send every matching log on mainnet.
+    Filtering by address on the node removes most of the websocket traffic and JSON parsing.
+    Long address lists are sharded into multiple subscriptions of at most shard_size addresses,
+    and the logs of all shards are delivered to one queue.
+
+    Addresses can be added/removed while streaming: only the affected shards are resubscribed,
+    and the old subscription is cancelled after the new one is confirmed, so no logs are missed
+    (duplicate logs during the switch are dropped by PoolStateEngine).
+    """
+
+    def __init__(self, topics: List[Any], addresses: List[str] = [], shard_size: int = 500):
+        self.topics = topics
+        self.shard_size = shard_size
+
+        # shard index --> set of addresses
+        self.shards = []
+
+        # shard index --> Subscription
+        self.subscriptions = {}
+
+        self.queue = asyncio.Queue()
+        self.rpc_client = None
+
+        self._add(addresses)
+
+    @property
+    def addresses(self) -> List[str]:
+        return [address for shard in self.shards for address in shard]
+
+    def _add(self, addresses: List[str]) -> List[int]:
+        touched = set()
+        existing = set(self.addresses)
+
+        for address in addresses:
+            address = address.lower()
+            if address in existing:
+                continue
+            existing.add(address)
+
+            for i, shard in enumerate(self.shards):
+                if len(shard) < self.shard_size:
+                    break
+            else:
+                self.shards.append(set())
+                i = len(self.shards) - 1
+
+            self.shards[i].add(address)
+            touched.add(i)
+
+        return sorted(touched)
+
+    def _remove(self, addresses: List[str]) -> List[int]:
+        touched = set()
+
+        for address in addresses:
+            address = address.lower()
+            for i, shard in enumerate(self.shards):
+                if address in shard:
+                    shard.discard(address)
+                    touched.add(i)
+
+        return sorted(touched)
+
+    async def _subscribe(self, shard: int):
+        old_subscription = self.subscriptions.pop(shard, None)
+
+        if self.shards[shard]:
+            params = ['logs', {'address': sorted(self.shards[shard]), 'topics': self.topics}]
+            self.subscriptions[shard] = await self.rpc_client.subscribe(params, self.queue)
+
+        if old_subscription is not None:
+            await old_subscription.unsubscribe()
+
+    async def connect(self, rpc_client: RpcWebsocketClient):
+        """
+        Subscribes all shards on rpc_client.
+        The client subscribes them again by itself after a reconnect
+        """
+        self.rpc_client = rpc_client
+
+        for shard in range(len(self.shards)):
+            await self._subscribe(shard)
+
+    async def close(self):
+        for subscription in self.subscriptions.values():
+            await subscription.unsubscribe()
+        self.subscriptions = {}
+        self.rpc_client = None
+
+    async def add_addresses(self, addresses: List[str]):
+        touched = self._add(addresses)
+        if self.rpc_client is not None:
+            for shard in touched:
+                await self._subscribe(shard)
+
+    async def remove_addresses(self, addresses: List[str]):
+        touched = self._remove(addresses)
+        if self.rpc_client is not None:
+            for shard in touched:
+                await self._subscribe(shard)
+
+    async def get(self) -> str:
+        return await self.queue.get()
+
+
+class PoolStateEngine:
+    """
+    Keeps the reserves of Uniswap V2 pools keyed by pool address, and coalesces Sync events per block
+
+    A busy pool can emit several Sync events in a single block, but only the final reserves matter
+    for pricing the next block. Logs are applied in (block_number, log_index) order,
+    and one consolidated PoolUpdate is published per touched pool per block when:
+
+    1. a log from a newer block arrives (flushes the older blocks),
+    2. stream_new_blocks receives a new head (flushes up to that block), or
+    3. no log arrived for flush_delay seconds (flushes all pending blocks)
+
+    A node sends the newHeads of a block before its logs, so the logs of a block arrive as one burst
+    after its head, and 3. publishes them as soon as the burst is over, without waiting for the next head.
+
+    Because all pools touched in a block are published together,
+    handlers see consistent cross-pool snapshots.
+
+    synced_block_number is the block up to which all Sync events are known to be applied.
+    After a gap in the stream (a reconnect), recover() backfills the missed Sync events from there.
+    """
+
+    def __init__(self,
+                 tokens: Dict[str, List[Any]],
+                 pools: List[Dict[str, Any]],
+                 event_queue: aioprocessing.AioQueue,
+                 debug: bool = False,
+                 flush_delay: float = 0.005):
+        """
+        :param flush_delay: the pending updates are published once no log arrived for this long (seconds)
+        """
+
+        self.tokens = tokens
+        self.pools = {pool['address'].lower(): pool for pool in pools if pool['version'] == 2}
+        self.event_queue = event_queue
+        self.debug = debug
+
+        # address --> [reserve0, reserve1]
+        self.reserves = {}
+
+        # address --> (block_number, log_index) of the last applied Sync event
+        self.last_applied = {}
+
+        # address --> block_number of the pending (not yet published) update
+        self.pending = {}
+        self.pending_block_number = None
+
+        # address --> time.monotonic_ns() when the earliest pending log of the pool was received, for the metrics
+        self.pending_recv_ns = {}
+
+        self.flush_delay = flush_delay
+        self.flush_timer = None
+
+        self.last_block_number = 0
+        self.synced_block_number = None
+
+        # False from a disconnect until recover() is done, so synced_block_number doesn't skip the gap
+        self.in_sync = False
+        self.gaps = 0
+
+        self.recovery_lock = asyncio.Lock()
+
+        # set by stream_uniswap_v2_events to update the node side address filter
+        self.subscriptions = None
+
+        # set by stream_uniswap_v2_events to fetch reserves with multicalls
+        self.rpc_client = None
+
+    async def add_pools(self, pools: List[Dict[str, Any]]):
+        """
+        Starts tracking pools while streaming, without reconnecting.
+        The initial reserves are fetched with a multicall once the pools are subscribed
+        """
+        pools = [pool for pool in pools if pool['version'] == 2]
+        for pool in pools:
+            self.pools[pool['address'].lower()] = pool
+        if self.subscriptions is not None:
+            await self.subscriptions.add_addresses([pool['address'] for pool in pools])
+        if self.rpc_client is not None:
+            await self.resync([pool['address'] for pool in pools])
+
+    async def resync(self, addresses: Optional[List[str]] = None, **kwargs):
+        """
+        Fetches the reserves of the pools at the latest block with batched multicalls.
+        Used at bootstrap, and can be called periodically or after a reconnect.
+        Pools that got a Sync event in a newer block meanwhile are left as they are
+
+        :param addresses: all pools if None
+        :param kwargs: passed to multicall3.batch_call (batch_size, concurrency, retries)
+        """
+        synced = addresses is None
+        gaps = self.gaps
+        if addresses is None:
+            addresses = list(self.pools.keys())
+        block_number = await get_block_number(self.rpc_client)
+        reserves = await fetch_v2_reserves(self.rpc_client, addresses, block_number, **kwargs)
+        self.set_reserves(block_number, reserves, time.monotonic_ns())
+        if synced:
+            self.synced_block_number = max(self.synced_block_number or 0, block_number)
+            self.in_sync = self.in_sync or gaps == self.gaps
+        return block_number, list(reserves.keys())
+
+    def mark_gap(self):
+        self.in_sync = False
+        self.gaps += 1
+
+    async def close(self):
+        """
+        Closes the HTTP session of rpc_client. It's opened again on the next request
+        """
+        if self.rpc_client is not None:
+            await self.rpc_client.close()
+
+    async def recover(self,
+                      max_gap_blocks: int = 100,
+                      chunk_size: int = 20,
+                      address_chunk_size: int = 500,
+                      concurrency: int = 4):
+        """
+        Recovers the Sync events missed while the stream was disconnected.
+
+        Small gaps are backfilled with eth_getLogs from synced_block_number to the latest block,
+        in ranges of chunk_size blocks. If the gap is larger than max_gap_blocks,
+        the reserves are fetched again with a multicall instead.
+        The corrected pools are published as PoolUpdate events, followed by one StateRecovery event
+
+        :param concurrency: the maximum number of eth_getLogs requests in flight
+        """
+        async with self.recovery_lock:
+            gaps = self.gaps
+
+            if self.synced_block_number is None:
+                block_number, addresses = await self.resync()
+                self._publish_recovery(block_number, block_number, 'snapshot', addresses)
+                return
+
+            from_block = self.synced_block_number
+            to_block = await get_block_number(self.rpc_client)
+
+            if to_block - from_block > max_gap_blocks:
+                print(f'Gap of {to_block - from_block} blocks, fetching the reserves again')
+                block_number, addresses = await self.resync()
+                self._publish_recovery(from_block, block_number, 'snapshot', addresses)
+                return
+
+            addresses = list(self.pools.keys())
+            semaphore = asyncio.Semaphore(concurrency)
+
+            async def _get_logs(log_filter: Dict[str, Any]) -> List[Dict[str, Any]]:
+                async with semaphore:
+                    return await self.rpc_client.request('eth_getLogs', [log_filter])
+
+            requests = []
+            for start in range(from_block, to_block + 1, chunk_size):
+                end = min(start + chunk_size - 1, to_block)
+                for i in range(0, len(addresses), address_chunk_size):
+                    log_filter = {
+                        'fromBlock': hex(start),
+                        'toBlock': hex(end),
+                        'address': addresses[i:i + address_chunk_size],
+                        'topics': [SYNC_EVENT_SELECTOR],
+                    }
+                    requests.append(_get_logs(log_filter))
+
+            logs = [log for result in await asyncio.gather(*requests) for log in result]
+            recv_ns = time.monotonic_ns()
+            logs = [log for log in logs if not log.get('removed', False)]
+            logs.sort(key=lambda log: (int(log['blockNumber'], base=16), int(log['logIndex'], base=16)))
+
+            # applied without flushing per block, so that one PoolUpdate is published per corrected pool
+            corrected = set()
+            for log in logs:
+                address = log['address'].lower()
+                key = (int(log['blockNumber'], base=16), int(log['logIndex'], base=16))
+                if address not in self.pools or key <= self.last_applied.get(address, (-1, -1)):
+                    continue
+                reserve0, reserve1 = eth_abi.decode(['uint112', 'uint112'], eth_utils.decode_hex(log['data']))
+                self.reserves[address] = [reserve0, reserve1]
+                self.last_applied[address] = key
+                self.pending[address] = key[0]
+                self.pending_recv_ns.setdefault(address, recv_ns)
+                corrected.add(address)
+            self.flush()
+
+            self.synced_block_number = max(self.synced_block_number, to_block)
+            if gaps == self.gaps:
+                self.in_sync = True
+            self._publish_recovery(from_block, to_block, 'get_logs', sorted(corrected))
+
+    async def remove_pools(self, addresses: List[str]):
+        addresses = [address.lower() for address in addresses]
+        for address in addresses:
+            self.pools.pop(address, None)
+            self.reserves.pop(address, None)
+            self.last_applied.pop(address, None)
+            self.pending.pop(address, None)
+            self.pending_recv_ns.pop(address, None)
+        if self.subscriptions is not None:
+            await self.subscriptions.remove_addresses(addresses)
+
+    def set_reserves(self, block_number: int, reserves: Dict[str, List[int]], recv_ns: Optional[int] = None):
+        """
+        Sets the reserves fetched with a multicall (at bootstrap/resync), and publishes the pools
+        so that price can be calculated even if the pool is idle
+
+        :param reserves: {address: [reserve0, reserve1]}
+        :param recv_ns: time.monotonic_ns() when the reserves were received, for the metrics
+        """
+        for address, (reserve0, reserve1) in reserves.items():
+            address = address.lower()
+            if address not in self.pools:
+                continue
+            if self.last_applied.get(address, (-1, -1))[0] > block_number:
+                # a Sync event newer than the snapshot was applied already
+                continue
+            self.reserves[address] = [reserve0, reserve1]
+            self.last_applied[address] = (block_number, -1)
+            self.pending[address] = block_number
+            if recv_ns is not None:
+                self.pending_recv_ns.setdefault(address, recv_ns)
+
+        self.flush()
+
+    def apply_log(self,
+                  block_number: int,
+                  log_index: int,
+                  address: str,
+                  reserve0: int,
+                  reserve1: int,
+                  recv_ns: Optional[int] = None):
+        """
+        :param recv_ns: time.monotonic_ns() when the log was received. The PoolUpdate is stamped with
+                        the receive time of the earliest log it coalesces, so the metrics include the coalescing
+        """
+        address = address.lower()
+
+        if address not in self.pools:
+            return
+
+        if self.pending_block_number is not None and block_number > self.pending_block_number:
+            self.flush()
+
+        key = (block_number, log_index)
+        if key <= self.last_applied.get(address, (-1, -1)):
+            # an older (or duplicate) Sync event than the reserves we already have
+            return
+
+        self.reserves[address] = [reserve0, reserve1]
+        self.last_applied[address] = key
+        self.pending[address] = block_number
+        self.pending_block_number = max(self.pending_block_number or 0, block_number)
+        if recv_ns is not None:
+            self.pending_recv_ns.setdefault(address, recv_ns)
+
+        if self.in_sync:
+            # logs arrive in order, so all Sync events of the previous blocks were seen
+            self.synced_block_number = max(self.synced_block_number, block_number - 1)
+
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        """
+        (Re)starts the flush_delay timer, so the pending updates are published at the end of a burst of logs
+        """
+        if self.flush_timer is not None:
+            self.flush_timer.cancel()
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # no event loop to wait on
+            self.flush_timer = None
+            self.flush()
+            return
+        self.flush_timer = loop.call_later(self.flush_delay, self._flush_timeout)
+
+    def _flush_timeout(self):
+        self.flush_timer = None
+        self.flush()
+
+    def flush(self, block_number: Optional[int] = None):
+        """
+        Publishes one PoolUpdate per pool touched up to block_number (all pending pools if None)
+        """
+        flushed = [
+            address for address, _block_number in self.pending.items()
+            if block_number is None or _block_number <= block_number
+        ]
+
+        for address in flushed:
+            _block_number = self.pending.pop(address)
+            self.last_block_number = max(self.last_block_number, _block_number)
+            self._publish(_block_number, address, self.pending_recv_ns.pop(address, None))
+
+        self.pending_block_number = max(self.pending.values()) if self.pending else None
+
+        if not self.pending and self.flush_timer is not None:
+            self.flush_timer.cancel()
+            self.flush_timer = None
+
+    def _publish(self, block_number: int, address: str, recv_ns: Optional[int] = None):
+        pool = self.pools[address]
+        reserve0, reserve1 = self.reserves[address]
+
+        pool_update = PoolUpdate(
+            block_number,
+            pool['exchange'],
+            pool['version'],
+            pool['address'],
+            pool['token0'],
+            pool['token1'],
+            self.tokens[pool['token0']][1],
+            self.tokens[pool['token1']][1],
+            reserve0,
+            reserve1,
+        )
+        if recv_ns is not None:
+            record_received(pool_update.exchange, pool_update, recv_ns)
+
+        if not self.debug:
+            self.event_queue.put(pool_update)
+        else:
+            print(pool_update)
+
+    def _publish_recovery(self, from_block: int, to_block: int, method: str, addresses: List[str]):
+        recovery = StateRecovery(from_block, to_block, method, addresses)
+
+        if not self.debug:
+            self.event_queue.put(recovery)
+        else:
+            print(recovery)
 
 
 async def stream_new_blocks(ws_rpc_url: str,
                             event_queue: aioprocessing.AioQueue,
-                            debug: bool = False):
+                            debug: bool = False,
+                            pool_state_engine: Optional[PoolStateEngine] = None,
+                            rpc_client: Optional[RpcWebsocketClient] = None):
+    """
+    :param pool_state_engine: if given, the pool updates coalesced up to the new head
+                              that are still pending are published right before the block event
+    :param rpc_client: a RpcWebsocketClient shared with the other DEX streams.
+                       A new connection to ws_rpc_url is opened if None
+    """
     
-    async with websockets.connect(ws_rpc_url) as ws:
-        subscription = {
-            'json': '2.0',
-            'id': 1,
-            'method': 'eth_subscribe',
-            'params': ['newHeads']
-        }
-
-        await ws.send(json.dumps(subscription))
-        _ = await ws.recv()
+    async with rpc_client_session(ws_rpc_url, rpc_client) as client:
+        subscription = await client.subscribe(['newHeads'])
 
         WEI = 10 ** 18
 
-        while True:
-            msg = await asyncio.wait_for(ws.recv(), timeout=60 * 10)
-            block = json.loads(msg)['params']['result']
-            block_number = int(block['number'], base=16)
-            base_fee = int(block['baseFeePerGas'], base=16)
-            next_base_fee = calculate_next_block_base_fee(block)
-            event = {
-                'source': 'dex',
-                'type': 'block',
-                'block_number': block_number,
-                'base_fee': base_fee / WEI,
-                'next_base_fee': next_base_fee / WEI,
-            }
-            if not debug:
-                event_queue.put(event)
-            else:
-                print(event)
-            
+        try:
+            while True:
+                msg = await asyncio.wait_for(subscription.get(), timeout=60 * 10)
+                recv_ns = time.monotonic_ns()
+                block = decode_new_head(msg)
+                if isinstance(block, dict):
+                    # not a newHeads notification
+                    continue
+                record_message(time.time() - block.timestamp)
+                block_number = block.number
+                base_fee = block.base_fee
+                next_base_fee = next_block_base_fee(block.base_fee, block.gas_used, block.gas_limit)
+                event = {
+                    'source': 'dex',
+                    'type': 'block',
+                    'block_number': block_number,
+                    'base_fee': base_fee / WEI,
+                    'next_base_fee': next_base_fee / WEI,
+                    'timestamp': block.timestamp * 1000,
+                }
+                if pool_state_engine is not None:
+                    pool_state_engine.flush(block_number)
+                record_received('block', event, recv_ns, event['timestamp'])
+                if not debug:
+                    event_queue.put(event)
+                else:
+                    print(event)
+        finally:
+            await subscription.unsubscribe()
 
 
 async def stream_uniswap_v2_events(http_rpc_url: str,
@@ -57,120 +514,80 @@ async def stream_uniswap_v2_events(http_rpc_url: str,
                                    tokens: Dict[str, List[Any]],
                                    pools: List[List[Any]],
                                    event_queue: aioprocessing.AioQueue,
-                                   debug: bool = False):
+                                   debug: bool = False,
+                                   pool_state_engine: Optional[PoolStateEngine] = None,
+                                   shard_size: int = 500,
+                                   rpc_client: Optional[RpcWebsocketClient] = None):
+    """
+    :param pool_state_engine: pass the same PoolStateEngine to stream_new_blocks
+                              to publish the coalesced pool updates on every new head.
+                              Pools can be added/removed while streaming with
+                              PoolStateEngine.add_pools/remove_pools.
+                              A new engine is created if None
+    :param shard_size: the maximum number of pool addresses per logs subscription
+    :param rpc_client: a RpcWebsocketClient shared with the other DEX streams.
+                       A new connection to ws_rpc_url is opened if None
+    """
     
-    w3 = Web3(Web3.HTTPProvider(http_rpc_url))
+    # V3 pools don't have getReserves, and are not streamed here
+    pools = [pool for pool in pools if pool['version'] == 2]
     
-    block_number = w3.eth.get_block_number()
-    signature = 'getReserves()((uint112,uint112,uint32))'  # reserve0, reserve1, blockTimestampLast
+    if pool_state_engine is None:
+        pool_state_engine = PoolStateEngine(tokens, pools, event_queue, debug)
     
-    calls = []
-    for pool in pools:
-        pool_name = f'{pool["exchange"]}_{pool["version"]}_{pool["name"].replace("/", "")}'
-        call = Call(
-            pool['address'],
-            signature,
-            [(pool_name, lambda x: x)]
-        )
-        calls.append(call)
-        
-    multicall = Multicall(calls, _w3=w3)
-    result = multicall()
-    reserves = {k: list(v)[:2] for k, v in result.items()}
-    """
-    reserves:
-    {
-        'uniswap_2_ETHUSDT': [17368643486106939361172, 31867695075486],
-        'sushiswap_2_ETHUSDT': [5033262526671305584632, 9254792586342]
-    }
-    """
+    if pool_state_engine.rpc_client is None:
+        pool_state_engine.rpc_client = HttpRpcClient(http_rpc_url)
     
-    filtered_pools = [pool for pool in pools if pool['version'] == 2]
-    pools = {pool['address'].lower(): pool for pool in filtered_pools}
+    if pool_state_engine.subscriptions is None:
+        pool_state_engine.subscriptions = LogSubscriptions([SYNC_EVENT_SELECTOR],
+                                                           list(pool_state_engine.pools.keys()),
+                                                           shard_size)
+    subscriptions = pool_state_engine.subscriptions
     
-    def _publish(block_number: int,
-                 pool: Dict[str, Any],
-                 data: List[int] = []):
-        
-        exchange = pool['exchange']
-        version = pool['version']
-        symbol = f'{pool["token0"]}{pool["token1"]}'
-
-        # save to "reserves" in memory
-        symbol_key = f'{exchange}_{version}_{symbol}'
-        
-        if len(data) == 2:
-            # initial publishing occurs without data(=Sync event data)
-            reserves[symbol_key][0] = data[0]
-            reserves[symbol_key][1] = data[1]
-            
-        token_idx = {
-            pool['token0']: 0,
-            pool['token1']: 1,
-        }
-        
-        decimals = {
-            pool['token0']: tokens[pool['token0']][1],
-            pool['token1']: tokens[pool['token1']][1],
-        }
-        
-        reserve_update = {
-            pool['token0']: reserves[symbol_key][0],
-            pool['token1']: reserves[symbol_key][1],
-        }
-        
-        pool_update = {
-            'source': 'dex',
-            'type': 'pool_update',
-            'block_number': block_number,
-            'exchange': pool['exchange'],
-            'version': pool['version'],
-            'symbol': symbol,
-            'token_idx': token_idx,
-            'decimals': decimals,
-            'reserves': reserve_update,
-        }
-        
-        if not debug:
-            event_queue.put(pool_update)
-        else:
-            print(pool_update)
-            
-    """
-    Send initial reserve data so that price can be calculated even if the pool is idle
-    """
-    for address, pool in pools.items():
-        _publish(block_number, pool)
+    async with rpc_client_session(ws_rpc_url, rpc_client) as client:
+        try:
+            await subscriptions.connect(client)
+            client.disconnect_callbacks.append(pool_state_engine.mark_gap)
+            client.reconnect_callbacks.append(pool_state_engine.recover)
 
-    sync_event_selector = w3.keccak(text='Sync(uint112,uint112)').hex()
-    
-    async with websockets.connect(ws_rpc_url) as ws:
-        subscription = {
-            'json': '2.0',
-            'id': 1,
-            'method': 'eth_subscribe',
-            'params': [
-                'logs',
-                {'topics': [sync_event_selector]}
-            ]
-        }
-
-        await ws.send(json.dumps(subscription))
-        _ = await ws.recv()
-
-        while True:
-            msg = await asyncio.wait_for(ws.recv(), timeout=60 * 10)
-            event = json.loads(msg)['params']['result']
-            address = event['address'].lower()
-
-            if address in pools:
-                block_number = int(event['blockNumber'], base=16)
-                pool = pools[address]
-                data = eth_abi.decode(
-                    ['uint112', 'uint112'],
-                    eth_utils.decode_hex(event['data'])
-                )
-                _publish(block_number, pool, data)
+            """
+            Send initial reserve data so that price can be calculated even if the pool is idle.
+            The snapshot is taken after subscribing, so no Sync event is missed in between:
+            the logs queued meanwhile are applied on top of it (older ones are dropped).
+            When the stream is restarted, only the Sync events missed since then are recovered
+            """
+            if pool_state_engine.synced_block_number is None:
+                await pool_state_engine.resync()
+            else:
+                await pool_state_engine.recover()
+
+            while True:
+                msg = await asyncio.wait_for(subscriptions.get(), timeout=60 * 10)
+                recv_ns = time.monotonic_ns()
+                event = decode_log(msg)
+
+                if isinstance(event, dict):
+                    # not a logs notification
+                    continue
+                record_message()
+
+                address = event.address
+
+                if address in pool_state_engine.pools and not event.removed:
+                    data = eth_abi.decode(
+                        ['uint112', 'uint112'],
+                        eth_utils.decode_hex(event.data)
+                    )
+                    pool_state_engine.apply_log(event.block_number, event.log_index, address, data[0], data[1],
+                                                recv_ns)
+        finally:
+            pool_state_engine.mark_gap()
+            if pool_state_engine.mark_gap in client.disconnect_callbacks:
+                client.disconnect_callbacks.remove(pool_state_engine.mark_gap)
+            if pool_state_engine.recover in client.reconnect_callbacks:
+                client.reconnect_callbacks.remove(pool_state_engine.recover)
+            await subscriptions.close()
+            await pool_state_engine.close()
                 
 
 if __name__ == '__main__':
@@ -188,13 +605,20 @@ if __name__ == '__main__':
     HTTP_RPC_URL = os.getenv('HTTP_RPC_URL')
     WS_RPC_URL = os.getenv('WS_RPC_URL')
     
+    # shared, so that pool updates are published on every new head
+    pool_state_engine = PoolStateEngine(TOKENS, POOLS, None, True)
+    
+    # both streams subscribe over one websocket connection
+    rpc_client = RpcWebsocketClient(WS_RPC_URL)
+    
     new_blocks_stream = reconnecting_websocket_loop(
-        partial(stream_new_blocks, WS_RPC_URL, None, True),
+        partial(stream_new_blocks, WS_RPC_URL, None, True, pool_state_engine, rpc_client),
         tag='new_blocks_stream'
     )
     
     uniswap_v2_stream = reconnecting_websocket_loop(
-        partial(stream_uniswap_v2_events, HTTP_RPC_URL, WS_RPC_URL, TOKENS, POOLS, None, True),
+        partial(stream_uniswap_v2_events, HTTP_RPC_URL, WS_RPC_URL, TOKENS, POOLS, None, True, pool_state_engine,
+                500, rpc_client),
         tag='uniswap_v2_stream'
     )
 
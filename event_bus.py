@@ -0,0 +1,469 @@
+import time
+import queue
+import pickle
+import struct
+import asyncio
+import aioprocessing
+
+from decimal import Decimal
+from functools import partial
+from collections import defaultdict, deque
+from typing import Any, Iterable, Optional, Tuple
+from multiprocessing import shared_memory
+
+from utils import decimal_places, from_fixed
+from events import EXCHANGES, OrderbookSnapshot, PoolUpdate
+
+
+"""
+Record kinds written into the ring buffer slots.
+Events that don't have a fixed binary layout (blocks, 1inch orders, ...) are pickled
+"""
+KIND_PICKLE = 0
+KIND_ORDERBOOK = 1
+KIND_POOL_UPDATE = 2
+
+# slot header: record length, record kind
+SLOT_HEADER = struct.Struct('<IB')
+
+# exchange_id, symbol, n_bids, n_asks, price_decimals, quantity_decimals, Decimal mode, timestamp (-1: None),
+# recv_ns (-1: None). In Decimal mode (price_decimals is None), the decimals are the scale of the record's values,
+# so they are written without rounding. Records whose values don't fit are pickled
+ORDERBOOK_HEADER = struct.Struct('<b16sBBbb?qq')
+ORDERBOOK_LEVELS = struct.Struct(f'<{OrderbookSnapshot.DEPTH * 4}q')
+
+# block_number, exchange_id, version, address (as given: checksummed or lowercase), token0, token1,
+# decimals0, decimals1, reserve0, reserve1, recv_ns (-1: None)
+POOL_UPDATE = struct.Struct('<QbB42s16s16sBB16s16sq')
+
+# head (write index) and tail (read index) are kept on separate cache lines.
+# They are read and written through a memoryview cast to 'Q', which copies one aligned 8 byte word:
+# struct.pack_into zeroes the destination before packing, so the other process could read a 0 index
+HEAD_OFFSET = 0
+TAIL_OFFSET = 64
+DATA_OFFSET = 128
+HEAD_INDEX = HEAD_OFFSET // 8
+TAIL_INDEX = TAIL_OFFSET // 8
+
+
+def _encode_orderbook(event: OrderbookSnapshot) -> Optional[bytes]:
+    symbol = event.symbol.encode()
+    if event.exchange_id < 0 or len(symbol) > 16:
+        return None
+
+    timestamp = -1 if event.timestamp is None else event.timestamp
+    recv_ns = getattr(event, 'recv_ns', -1)
+
+    decimal_mode = event.price_decimals is None
+    if decimal_mode:
+        levels = event.bids + event.asks
+        price_decimals = decimal_places(level[0] for level in levels)
+        quantity_decimals = decimal_places(level[1] for level in levels)
+    else:
+        price_decimals, quantity_decimals = event.price_decimals, event.quantity_decimals
+
+    values = [0] * (OrderbookSnapshot.DEPTH * 4)
+    for i, (price, quantity) in enumerate(event.bids):
+        values[i * 2] = _to_int(price, price_decimals)
+        values[i * 2 + 1] = _to_int(quantity, quantity_decimals)
+    offset = OrderbookSnapshot.DEPTH * 2
+    for i, (price, quantity) in enumerate(event.asks):
+        values[offset + i * 2] = _to_int(price, price_decimals)
+        values[offset + i * 2 + 1] = _to_int(quantity, quantity_decimals)
+
+    try:
+        return ORDERBOOK_HEADER.pack(event.exchange_id, symbol, len(event.bids), len(event.asks),
+                                     price_decimals, quantity_decimals, decimal_mode,
+                                     timestamp, recv_ns) + ORDERBOOK_LEVELS.pack(*values)
+    except struct.error:
+        # the decimals or a scaled value don't fit the layout
+        return None
+
+
+def _decode_orderbook(buf: memoryview) -> OrderbookSnapshot:
+    (exchange_id, symbol, n_bids, n_asks,
+     price_decimals, quantity_decimals, decimal_mode, timestamp, recv_ns) = ORDERBOOK_HEADER.unpack_from(buf, 0)
+    values = ORDERBOOK_LEVELS.unpack_from(buf, ORDERBOOK_HEADER.size)
+
+    if decimal_mode:
+        price = partial(from_fixed, decimals=price_decimals)
+        quantity = partial(from_fixed, decimals=quantity_decimals)
+        price_decimals, quantity_decimals = None, None
+    else:
+        price = quantity = int
+
+    offset = OrderbookSnapshot.DEPTH * 2
+    bids = [[price(values[i * 2]), quantity(values[i * 2 + 1])] for i in range(n_bids)]
+    asks = [[price(values[offset + i * 2]), quantity(values[offset + i * 2 + 1])] for i in range(n_asks)]
+
+    event = OrderbookSnapshot(EXCHANGES[exchange_id],
+                              symbol.rstrip(b'\x00').decode(),
+                              bids,
+                              asks,
+                              price_decimals,
+                              quantity_decimals,
+                              None if timestamp < 0 else timestamp)
+    if recv_ns >= 0:
+        event.recv_ns = recv_ns
+    return event
+
+
+def _encode_pool_update(event: PoolUpdate) -> Optional[bytes]:
+    address, token0, token1 = event.address.encode(), event.token0.encode(), event.token1.encode()
+    if event.exchange_id < 0 or len(address) > 42 or len(token0) > 16 or len(token1) > 16:
+        return None
+
+    return POOL_UPDATE.pack(event.block_number,
+                            event.exchange_id,
+                            event.version,
+                            address,
+                            token0,
+                            token1,
+                            event.decimals0,
+                            event.decimals1,
+                            event.reserve0.to_bytes(16, 'little'),
+                            event.reserve1.to_bytes(16, 'little'),
+                            getattr(event, 'recv_ns', -1))
+
+
+def _decode_pool_update(buf: memoryview) -> PoolUpdate:
+    (block_number, exchange_id, version, address, token0, token1,
+     decimals0, decimals1, reserve0, reserve1, recv_ns) = POOL_UPDATE.unpack_from(buf, 0)
+
+    event = PoolUpdate(block_number,
+                       EXCHANGES[exchange_id],
+                       version,
+                       address.rstrip(b'\x00').decode(),
+                       token0.rstrip(b'\x00').decode(),
+                       token1.rstrip(b'\x00').decode(),
+                       decimals0,
+                       decimals1,
+                       int.from_bytes(reserve0, 'little'),
+                       int.from_bytes(reserve1, 'little'))
+    if recv_ns >= 0:
+        event.recv_ns = recv_ns
+    return event
+
+
+def _to_int(value: Any, decimals: int) -> int:
+    if isinstance(value, Decimal):
+        return int(value.scaleb(decimals))
+    return value
+
+
+def encode_event(event: Any) -> Tuple[int, bytes]:
+    """
+    Returns (kind, payload) of the binary record for event
+    """
+    payload = None
+
+    if isinstance(event, OrderbookSnapshot):
+        kind, payload = KIND_ORDERBOOK, _encode_orderbook(event)
+    elif isinstance(event, PoolUpdate):
+        kind, payload = KIND_POOL_UPDATE, _encode_pool_update(event)
+
+    if payload is None:
+        kind, payload = KIND_PICKLE, pickle.dumps(event, protocol=pickle.HIGHEST_PROTOCOL)
+
+    return kind, payload
+
+
+def decode_event(kind: int, buf: memoryview) -> Any:
+    if kind == KIND_ORDERBOOK:
+        return _decode_orderbook(buf)
+    elif kind == KIND_POOL_UPDATE:
+        return _decode_pool_update(buf)
+    else:
+        return pickle.loads(buf)
+
+
+class SharedMemoryRingBuffer:
+    """
+    A single-producer/single-consumer event queue backed by multiprocessing.shared_memory
+
+    Events are written as fixed-layout binary records (see encode_event) into fixed-size slots.
+    The producer only writes the head index, the consumer only writes the tail index,
+    so no locks are needed. This replaces the pickling, the pipe and the executor thread hop
+    of aioprocessing.AioQueue with a memcpy on each side.
+
+    It exposes the same put / get_nowait / coro_get API as aioprocessing.AioQueue,
+    so it can be passed to the streams and event handlers as the event_queue.
+
+    * Single producer: all streams putting events should run on one thread (ex. the same event loop).
+    Use one ring buffer per producer process.
+
+    * The consumer polls the shared memory: coro_get yields to the event loop spin_count times
+    before sleeping for poll_interval, trading some idle CPU for latency.
+    """
+
+    def __init__(self,
+                 name: Optional[str] = None,
+                 capacity: int = 4096,
+                 slot_size: int = 512,
+                 create: bool = True,
+                 spin_count: int = 100,
+                 poll_interval: float = 0.0001):
+        """
+        :param name: shared memory block name. A random name is used if None
+        :param capacity: the number of slots
+        :param slot_size: the maximum record size in bytes (including the slot header)
+        :param create: create a new block if True, otherwise attach to an existing block named: name
+        """
+        self.capacity = capacity
+        self.slot_size = slot_size
+        self.spin_count = spin_count
+        self.poll_interval = poll_interval
+
+        size = DATA_OFFSET + capacity * slot_size
+        self.shm = shared_memory.SharedMemory(name=name, create=create, size=size)
+        self.name = self.shm.name
+        self.buf = self.shm.buf
+        self.index = self.buf[:DATA_OFFSET].cast('Q')
+        self.owner = create
+
+        if create:
+            self.index[HEAD_INDEX] = 0
+            self.index[TAIL_INDEX] = 0
+        else:
+            _untrack(self.shm)
+
+    def __getstate__(self):
+        # the ring buffer is attached by name when passed to another process
+        return {
+            'name': self.name,
+            'capacity': self.capacity,
+            'slot_size': self.slot_size,
+            'spin_count': self.spin_count,
+            'poll_interval': self.poll_interval,
+        }
+
+    def __setstate__(self, state):
+        self.__init__(create=False, **state)
+
+    def _head(self) -> int:
+        return self.index[HEAD_INDEX]
+
+    def _tail(self) -> int:
+        return self.index[TAIL_INDEX]
+
+    def qsize(self) -> int:
+        return self._head() - self._tail()
+
+    def empty(self) -> bool:
+        return self.qsize() == 0
+
+    def put(self, event: Any, block: bool = True, timeout: Optional[float] = None):
+        kind, payload = encode_event(event)
+        size = SLOT_HEADER.size + len(payload)
+        if size > self.slot_size:
+            raise ValueError(f'Event record of {size} bytes does not fit in slot_size: {self.slot_size}')
+
+        head = self._head()
+
+        if head - self._tail() >= self.capacity:
+            if not block:
+                raise queue.Full
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while head - self._tail() >= self.capacity:
+                if deadline is not None and time.monotonic() > deadline:
+                    raise queue.Full
+                time.sleep(0)
+
+        offset = DATA_OFFSET + (head % self.capacity) * self.slot_size
+        SLOT_HEADER.pack_into(self.buf, offset, len(payload), kind)
+        start = offset + SLOT_HEADER.size
+        self.buf[start:start + len(payload)] = payload
+
+        # publish the record only after it is fully written
+        self.index[HEAD_INDEX] = head + 1
+
+    def put_nowait(self, event: Any):
+        self.put(event, block=False)
+
+    def get_nowait(self) -> Any:
+        tail = self._tail()
+        if tail == self._head():
+            raise queue.Empty
+
+        offset = DATA_OFFSET + (tail % self.capacity) * self.slot_size
+        length, kind = SLOT_HEADER.unpack_from(self.buf, offset)
+        start = offset + SLOT_HEADER.size
+        event = decode_event(kind, self.buf[start:start + length])
+
+        # release the slot after the record is decoded
+        self.index[TAIL_INDEX] = tail + 1
+        return event
+
+    async def coro_get(self) -> Any:
+        spins = 0
+        while True:
+            try:
+                return self.get_nowait()
+            except queue.Empty:
+                if spins < self.spin_count:
+                    spins += 1
+                    await asyncio.sleep(0)
+                else:
+                    await asyncio.sleep(self.poll_interval)
+
+    async def coro_put(self, event: Any):
+        while True:
+            try:
+                return self.put(event, block=False)
+            except queue.Full:
+                await asyncio.sleep(self.poll_interval)
+
+    def close(self):
+        # the cast view has to be released before the shared memory can be closed
+        self.index.release()
+        self.buf = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def _untrack(shm: shared_memory.SharedMemory):
+    """
+    Processes attaching to an existing block register it with their resource tracker,
+    which unlinks the block when they exit. Only the creator should unlink it
+    """
+    try:
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    except Exception:
+        pass
+
+
+class ConflatingQueue:
+    """
+    Wraps an event_queue and conflates full-snapshot events
+
+    Binance depth5 and OKX books5 messages are full top-of-book snapshots, so when the handler
+    falls behind, only the newest one per (exchange, symbol) matters. Every time coro_get is called,
+    all the events waiting in the wrapped queue are drained into:
+
+    - latest: the newest snapshot per (exchange, symbol)
+    - dirty: the (exchange, symbol) keys updated since they were last handed out
+
+    A dirty key is handed out at the position of its first pending update,
+    with the newest snapshot at that time. Other event types are passed through in FIFO order.
+    Memory is bounded by the number of (exchange, symbol) pairs plus the passthrough events.
+
+    dropped counts the snapshots that were replaced before the handler saw them.
+    """
+
+    def __init__(self,
+                 event_queue: Any,
+                 conflate_types: Iterable[str] = ('orderbook',)):
+        """
+        :param event_queue: aioprocessing.AioQueue, SharedMemoryRingBuffer, or any queue with coro_get, get_nowait
+        :param conflate_types: event types that are full snapshots and can be conflated
+        """
+        self.event_queue = event_queue
+        self.conflate_types = set(conflate_types)
+
+        self.latest = {}
+        self.dirty = set()
+        self.pending = deque()
+
+        self.dropped = 0
+        self.dropped_by_key = defaultdict(int)
+
+    def put(self, event: Any, *args, **kwargs):
+        self.event_queue.put(event, *args, **kwargs)
+
+    def _offer(self, event: Any):
+        if event['type'] in self.conflate_types:
+            key = (event['exchange'], event['symbol'])
+            if key in self.dirty:
+                self.dropped += 1
+                self.dropped_by_key[key] += 1
+            else:
+                self.dirty.add(key)
+                self.pending.append((key, None))
+            self.latest[key] = event
+        else:
+            self.pending.append((None, event))
+
+    def _drain(self):
+        while True:
+            try:
+                self._offer(self.event_queue.get_nowait())
+            except queue.Empty:
+                break
+
+    def _pop(self) -> Any:
+        key, event = self.pending.popleft()
+        if key is None:
+            return event
+        self.dirty.discard(key)
+        return self.latest[key]
+
+    def qsize(self) -> int:
+        return len(self.pending)
+
+    def get_nowait(self) -> Any:
+        self._drain()
+        if not self.pending:
+            raise queue.Empty
+        return self._pop()
+
+    async def coro_get(self) -> Any:
+        if not self.pending:
+            self._offer(await self.event_queue.coro_get())
+        self._drain()
+        return self._pop()
+
+
+class LocalQueue:
+    """
+    An event_queue for streams and handlers running on the same event loop (see runner.py)
+
+    Events are passed by reference: no pickling, and coro_get awaits an asyncio.Queue
+    instead of a get on an executor thread. It exposes the same put / get_nowait / coro_get API
+    as aioprocessing.AioQueue, but can't be shared with other processes or threads.
+    """
+
+    def __init__(self, maxsize: int = 0):
+        self.queue = asyncio.Queue(maxsize)
+
+    def put(self, event: Any, block: bool = True, timeout: Optional[float] = None):
+        """
+        The streams and the handler share the loop, so a full queue can't be waited on: it raises queue.Full
+        """
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            raise queue.Full
+
+    def put_nowait(self, event: Any):
+        self.put(event)
+
+    def get_nowait(self) -> Any:
+        try:
+            return self.queue.get_nowait()
+        except asyncio.QueueEmpty:
+            raise queue.Empty
+
+    async def coro_get(self) -> Any:
+        return await self.queue.get()
+
+    def qsize(self) -> int:
+        return self.queue.qsize()
+
+
+def create_event_queue(kind: str = 'aioprocessing', **kwargs):
+    """
+    Returns the event_queue used by streams and event handlers
+
+    :param kind: 'aioprocessing' (aioprocessing.AioQueue), 'shm' (SharedMemoryRingBuffer)
+                 or 'local' (LocalQueue, same event loop only)
+    """
+    if kind == 'aioprocessing':
+        return aioprocessing.AioQueue(**kwargs)
+    elif kind == 'shm':
+        return SharedMemoryRingBuffer(**kwargs)
+    elif kind == 'local':
+        return LocalQueue(**kwargs)
+    else:
+        raise ValueError(f'Unknown event queue kind: {kind}')
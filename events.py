@@ -0,0 +1,305 @@
+import sys
+
+from typing import Any, Dict, List, Optional, Tuple
+
+
+"""
+Exchanges get fixed ids so that they can be written into binary records.
+New exchanges should be appended to the end of the list, so that the ids of existing ones do not change
+"""
+EXCHANGES = ['binance', 'okx', 'uniswap', 'sushiswap']
+
+EXCHANGE_IDS = {exchange: i for i, exchange in enumerate(EXCHANGES)}
+
+"""
+Symbols are interned strings, so that comparing and hashing them is cheap.
+They don't get process-wide ids: binary records carry the symbol string,
+and recorder.TickRecorder keeps the symbol ids of each recording in its meta
+"""
+
+
+def intern_symbol(symbol: str) -> str:
+    return sys.intern(symbol)
+
+
+class Event:
+    """
+    Base class for events published to the event_queue
+
+    Events use __slots__ instead of dicts to cut down allocations on the hot path.
+    They still support data['key'] access, so handlers written for the dict events keep working
+
+    recv_ns, dequeue_ns are the latency stamps set by the streams and the handlers (see metrics.py).
+    They are unset until stamped, and are not part of to_dict or ==
+    """
+    __slots__ = ('recv_ns', 'dequeue_ns')
+
+    source = None
+    type = None
+
+    def __getitem__(self, key: str):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def get(self, key: str, default: Any = None):
+        return getattr(self, key, default)
+
+    def to_dict(self) -> Dict[str, Any]:
+        data = {'source': self.source, 'type': self.type}
+        data.update({k: getattr(self, k) for k in self.__slots__})
+        return data
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.to_dict()})'
+
+    def _stamps(self) -> Optional[Tuple[None, Dict[str, int]]]:
+        """
+        The latency stamps as the pickle state returned by __reduce__, restored after the constructor call
+        """
+        stamps = {key: getattr(self, key) for key in Event.__slots__ if hasattr(self, key)}
+        return (None, stamps) if stamps else None
+
+    def __eq__(self, other):
+        if not isinstance(other, self.__class__):
+            return NotImplemented
+        return all(getattr(self, k) == getattr(other, k) for k in self.__slots__)
+
+
+class OrderbookSnapshot(Event):
+    """
+    depth5 (Binance) / books5 (OKX) orderbook snapshot
+
+    bids, asks: [[price, quantity], ...] with at most DEPTH levels.
+    price_decimals, quantity_decimals are set when the stream runs in fixed-point mode
+    timestamp: the exchange's event time in milliseconds
+    """
+    __slots__ = (
+        'exchange',
+        'symbol',
+        'exchange_id',
+        'bids',
+        'asks',
+        'price_decimals',
+        'quantity_decimals',
+        'timestamp',
+    )
+
+    source = 'cex'
+    type = 'orderbook'
+
+    DEPTH = 5
+
+    def __init__(self,
+                 exchange: str,
+                 symbol: str,
+                 bids: List[List[Any]],
+                 asks: List[List[Any]],
+                 price_decimals: Optional[int] = None,
+                 quantity_decimals: Optional[int] = None,
+                 timestamp: Optional[int] = None):
+
+        self.exchange = intern_symbol(exchange)
+        self.symbol = intern_symbol(symbol)
+        self.exchange_id = EXCHANGE_IDS.get(exchange, -1)
+        self.bids = bids[:self.DEPTH]
+        self.asks = asks[:self.DEPTH]
+        self.price_decimals = price_decimals
+        self.quantity_decimals = quantity_decimals
+        self.timestamp = timestamp
+
+    def __reduce__(self):
+        # pickle as constructor arguments, which is smaller than the default slot state
+        return (self.__class__, (self.exchange,
+                                 self.symbol,
+                                 self.bids,
+                                 self.asks,
+                                 self.price_decimals,
+                                 self.quantity_decimals,
+                                 self.timestamp), self._stamps())
+
+
+class PoolUpdate(Event):
+    """
+    Reserves update of a Uniswap V2 variant pool
+
+    token_idx, decimals, reserves are provided as properties in the same format
+    as the dict events: {token0: ..., token1: ...}
+    """
+    __slots__ = (
+        'block_number',
+        'exchange',
+        'version',
+        'symbol',
+        'address',
+        'exchange_id',
+        'token0',
+        'token1',
+        'decimals0',
+        'decimals1',
+        'reserve0',
+        'reserve1',
+    )
+
+    source = 'dex'
+    type = 'pool_update'
+
+    def __init__(self,
+                 block_number: int,
+                 exchange: str,
+                 version: int,
+                 address: str,
+                 token0: str,
+                 token1: str,
+                 decimals0: int,
+                 decimals1: int,
+                 reserve0: int,
+                 reserve1: int):
+
+        self.block_number = block_number
+        self.exchange = intern_symbol(exchange)
+        self.version = version
+        self.symbol = intern_symbol(f'{token0}{token1}')
+        self.address = address
+        self.exchange_id = EXCHANGE_IDS.get(exchange, -1)
+        self.token0 = intern_symbol(token0)
+        self.token1 = intern_symbol(token1)
+        self.decimals0 = decimals0
+        self.decimals1 = decimals1
+        self.reserve0 = reserve0
+        self.reserve1 = reserve1
+
+    def __reduce__(self):
+        return (self.__class__, (self.block_number,
+                                 self.exchange,
+                                 self.version,
+                                 self.address,
+                                 self.token0,
+                                 self.token1,
+                                 self.decimals0,
+                                 self.decimals1,
+                                 self.reserve0,
+                                 self.reserve1), self._stamps())
+
+    @property
+    def token_idx(self) -> Dict[str, int]:
+        return {self.token0: 0, self.token1: 1}
+
+    @property
+    def decimals(self) -> Dict[str, int]:
+        return {self.token0: self.decimals0, self.token1: self.decimals1}
+
+    @property
+    def reserves(self) -> Dict[str, int]:
+        return {self.token0: self.reserve0, self.token1: self.reserve1}
+
+
+class StateRecovery(Event):
+    """
+    Published after the pool states were recovered from a gap in the stream (ex. a reconnect)
+
+    The corrected pools are published as PoolUpdate events right before this event.
+    method: 'get_logs' if the missed Sync events were backfilled,
+            'snapshot' if the reserves were fetched again with a multicall
+    """
+    __slots__ = (
+        'from_block',
+        'to_block',
+        'method',
+        'addresses',
+    )
+
+    source = 'dex'
+    type = 'recovery'
+
+    def __init__(self,
+                 from_block: int,
+                 to_block: int,
+                 method: str,
+                 addresses: List[str]):
+
+        self.from_block = from_block
+        self.to_block = to_block
+        self.method = method
+        self.addresses = addresses
+
+    def __reduce__(self):
+        return (self.__class__, (self.from_block,
+                                 self.to_block,
+                                 self.method,
+                                 self.addresses), self._stamps())
+
+
+class Opportunity(Event):
+    """
+    A CEX-DEX arbitrage found by detector.OpportunityDetector
+
+    direction: 'buy_dex' (buy the base token on the DEX, sell it on the CEX),
+               'sell_dex' (sell the base token on the DEX, buy it back on the CEX)
+    cex: the CEX the whole CEX leg trades on, or 'multi' if it walks the levels of several CEXs
+    allocation: {cex: base token quantity} of the CEX leg
+    size: the amount of the base token traded
+    amount_in, amount_out: of the DEX swap, in token units
+    profit, gas_cost, net_profit: in quote token units
+    """
+    __slots__ = (
+        'symbol',
+        'direction',
+        'cex',
+        'dex',
+        'address',
+        'size',
+        'amount_in',
+        'amount_out',
+        'profit',
+        'gas_cost',
+        'net_profit',
+        'block_number',
+        'allocation',
+    )
+
+    source = 'detector'
+    type = 'opportunity'
+
+    def __init__(self,
+                 symbol: str,
+                 direction: str,
+                 cex: str,
+                 dex: str,
+                 address: str,
+                 size: float,
+                 amount_in: float,
+                 amount_out: float,
+                 profit: float,
+                 gas_cost: float,
+                 block_number: Optional[int] = None,
+                 allocation: Optional[Dict[str, float]] = None):
+
+        self.symbol = intern_symbol(symbol)
+        self.direction = direction
+        self.cex = cex
+        self.dex = dex
+        self.address = address
+        self.size = size
+        self.amount_in = amount_in
+        self.amount_out = amount_out
+        self.profit = profit
+        self.gas_cost = gas_cost
+        self.net_profit = profit - gas_cost
+        self.block_number = block_number
+        self.allocation = allocation if allocation is not None else {cex: size}
+
+    def __reduce__(self):
+        return (self.__class__, (self.symbol,
+                                 self.direction,
+                                 self.cex,
+                                 self.dex,
+                                 self.address,
+                                 self.size,
+                                 self.amount_in,
+                                 self.amount_out,
+                                 self.profit,
+                                 self.gas_cost,
+                                 self.block_number,
+                                 self.allocation), self._stamps())
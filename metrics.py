@@ -0,0 +1,277 @@
+import time
+import json
+import asyncio
+
+from typing import Any, Dict, Optional, Tuple
+
+
+"""
+Latency histograms per stream and per stage of the pipeline:
+
+exchange time --(network)--> receive --(decode)--> event_queue.put --> dequeue --(handler)--> done/publish
+
+Events are stamped with recv_ns (time.monotonic_ns() when the websocket message was received)
+by the streams, and with dequeue_ns by the handler. CLOCK_MONOTONIC is shared by all the processes
+on a host, so the stamps can be compared across the event queue. The stages are:
+
+- network: the exchange/block timestamp to the receive time. Wall clock, so it includes the clock offset,
+           and block timestamps only have a resolution of 1s
+- decode: receive to event_queue.put (JSON decode, fixed-point conversion, the event construction).
+          Pool updates are stamped with the receive time of the earliest Sync log they coalesce,
+          so for the DEX streams it includes the time the update was pending in PoolStateEngine
+- queue: receive to dequeue, so the decode time plus the time spent in the event queue
+- handler: dequeue to the handler being done with the event (ex. opportunities published)
+
+The streams are keyed by the event's exchange (binance, okx, uniswap, ...), or 'block'.
+Each process records into its own METRICS, log_metrics prints them periodically,
+and serve_metrics exposes them as JSON over HTTP. log_metrics resets the interval histograms,
+serve_metrics reports the cumulative ones, so a scrape is not affected by the log interval.
+"""
+STAGES = ('network', 'decode', 'queue', 'handler')
+
+
+class Histogram:
+    """
+    A log-linear histogram of nanosecond values: every power of 2 is split into SUB_BUCKETS buckets,
+    so the percentiles are within 1 / SUB_BUCKETS of the exact value. Recording is O(1),
+    and the memory is fixed no matter how many values are recorded
+    """
+    __slots__ = ('counts', 'count', 'total', 'min', 'max')
+
+    SUB_BITS = 4
+    SUB_BUCKETS = 1 << SUB_BITS
+
+    def __init__(self):
+        self.counts = [0] * (64 * self.SUB_BUCKETS)
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def _bucket_value(self, bucket: int) -> int:
+        """
+        The upper bound of the bucket
+        """
+        if bucket < self.SUB_BUCKETS:
+            return bucket
+        shift = bucket // self.SUB_BUCKETS - 1
+        return ((bucket % self.SUB_BUCKETS + self.SUB_BUCKETS + 1) << shift) - 1
+
+    def record(self, value: int):
+        value = int(value)
+        if value < 0:
+            value = 0
+        if value < self.SUB_BUCKETS:
+            bucket = value
+        else:
+            shift = value.bit_length() - self.SUB_BITS - 1
+            bucket = (shift + 1) * self.SUB_BUCKETS + ((value >> shift) - self.SUB_BUCKETS)
+        self.counts[bucket] += 1
+        self.count += 1
+        self.total += value
+        if self.max is None or value > self.max:
+            self.max = value
+        if self.min is None or value < self.min:
+            self.min = value
+
+    def percentile(self, q: float) -> Optional[int]:
+        """
+        :param q: 0 - 100
+        """
+        if not self.count:
+            return None
+        rank = max(1, int(round(q / 100 * self.count)))
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(self._bucket_value(bucket), self.max)
+        return self.max
+
+    def merge(self, other: 'Histogram'):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.total += other.total
+        for value in (other.min, other.max):
+            if value is not None:
+                self.min = value if self.min is None else min(self.min, value)
+                self.max = value if self.max is None else max(self.max, value)
+
+    def reset(self):
+        self.__init__()
+
+    def summary(self) -> Dict[str, Any]:
+        """
+        In milliseconds
+        """
+        if not self.count:
+            return {'count': 0}
+        return {
+            'count': self.count,
+            'mean_ms': self.total / self.count / 1e6,
+            'p50_ms': self.percentile(50) / 1e6,
+            'p99_ms': self.percentile(99) / 1e6,
+            'max_ms': self.max / 1e6,
+        }
+
+
+class LatencyMetrics:
+    """
+    (stream, stage) --> Histogram
+
+    histograms cover the values since the last reset, and reset merges them into totals,
+    so the cumulative histograms are totals + histograms
+    """
+
+    def __init__(self):
+        self.histograms = {}
+        self.totals = {}
+
+    def record(self, stream: str, stage: str, value_ns: int):
+        key = (stream, stage)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.record(value_ns)
+
+    def cumulative(self) -> Dict[Tuple[str, str], Histogram]:
+        """
+        (stream, stage) --> Histogram of all the values recorded, reset or not
+        """
+        histograms = {}
+        for source in (self.totals, self.histograms):
+            for key, histogram in source.items():
+                if key not in histograms:
+                    histograms[key] = Histogram()
+                histograms[key].merge(histogram)
+        return histograms
+
+    def summary(self, cumulative: bool = False) -> Dict[str, Dict[str, Dict[str, Any]]]:
+        """
+        {stream: {stage: {'count', 'mean_ms', 'p50_ms', 'p99_ms', 'max_ms'}}}
+
+        :param cumulative: since the start instead of since the last reset
+        """
+        histograms = self.cumulative() if cumulative else self.histograms
+        summary = {}
+        for (stream, stage), histogram in sorted(histograms.items()):
+            summary.setdefault(stream, {})[stage] = histogram.summary()
+        return summary
+
+    def reset(self):
+        """
+        Starts a new interval, the values recorded so far are kept in totals
+        """
+        for key, histogram in self.histograms.items():
+            if key not in self.totals:
+                self.totals[key] = Histogram()
+            self.totals[key].merge(histogram)
+            histogram.reset()
+
+
+METRICS = LatencyMetrics()
+
+
+def event_stream(event: Any) -> str:
+    """
+    The stream of an event for the metrics: its exchange (binance, okx, uniswap, ...), or its type
+    """
+    return event.get('exchange') or event['type']
+
+
+def _stamp(event: Any, key: str, value: int):
+    if isinstance(event, dict):
+        event[key] = value
+    else:
+        setattr(event, key, value)
+
+
+def record_received(stream: str,
+                    event: Any,
+                    recv_ns: int,
+                    exchange_time_ms: Optional[float] = None,
+                    metrics: LatencyMetrics = METRICS):
+    """
+    Called by the streams right before event_queue.put: stamps recv_ns, and records the network and decode stages
+
+    :param recv_ns: time.monotonic_ns() when the message was received
+    :param exchange_time_ms: the exchange/block timestamp of the message (unix milliseconds)
+    """
+    _stamp(event, 'recv_ns', recv_ns)
+    if exchange_time_ms is not None:
+        metrics.record(stream, 'network', (time.time() * 1000 - exchange_time_ms) * 1e6)
+    metrics.record(stream, 'decode', time.monotonic_ns() - recv_ns)
+
+
+def record_dequeued(event: Any, metrics: LatencyMetrics = METRICS) -> int:
+    """
+    Called by the handler for every event it takes out of the event_queue: stamps dequeue_ns,
+    and records the queue stage
+
+    :return: dequeue_ns
+    """
+    dequeue_ns = time.monotonic_ns()
+    _stamp(event, 'dequeue_ns', dequeue_ns)
+    recv_ns = event.get('recv_ns')
+    if recv_ns is not None:
+        metrics.record(event_stream(event), 'queue', dequeue_ns - recv_ns)
+    return dequeue_ns
+
+
+def record_handled(event: Any, now_ns: Optional[int] = None, metrics: LatencyMetrics = METRICS):
+    """
+    Called by the handler once it's done with an event: records the handler stage
+    """
+    dequeue_ns = event.get('dequeue_ns')
+    if dequeue_ns is not None:
+        metrics.record(event_stream(event), 'handler', (now_ns or time.monotonic_ns()) - dequeue_ns)
+
+
+def format_summary(summary: Dict[str, Dict[str, Dict[str, Any]]]) -> str:
+    lines = []
+    for stream, stages in summary.items():
+        for stage in STAGES:
+            stats = stages.get(stage)
+            if stats is None or not stats['count']:
+                continue
+            lines.append(f'{stream:>10} {stage:>8}: n={stats["count"]:<8} p50 {stats["p50_ms"]:.3f}ms, '
+                         f'p99 {stats["p99_ms"]:.3f}ms, max {stats["max_ms"]:.3f}ms')
+    return '\n'.join(lines)
+
+
+async def log_metrics(interval: float = 60,
+                      tag: str = 'metrics',
+                      reset: bool = True,
+                      metrics: LatencyMetrics = METRICS):
+    """
+    :param reset: start a new interval after every log, so that each log covers the last interval.
+                  The cumulative histograms served by serve_metrics are kept
+    """
+    while True:
+        await asyncio.sleep(interval)
+        text = format_summary(metrics.summary())
+        if text:
+            print(f'[{tag}]\n{text}')
+        if reset:
+            metrics.reset()
+
+
+async def serve_metrics(host: str = '127.0.0.1',
+                        port: int = 9100,
+                        metrics: LatencyMetrics = METRICS) -> Tuple[Any, str]:
+    """
+    Serves the cumulative metrics.summary() as JSON on GET /metrics, independent of the resets of log_metrics
+
+    :return: (aiohttp AppRunner, url). Call runner.cleanup() to stop
+    """
+    from aiohttp import web
+
+    async def _metrics(request: web.Request) -> web.Response:
+        return web.Response(text=json.dumps(metrics.summary(cumulative=True)), content_type='application/json')
+
+    app = web.Application()
+    app.router.add_get('/metrics', _metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner, f'http://{host}:{port}/metrics'
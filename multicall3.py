@@ -0,0 +1,211 @@
+import re
+import asyncio
+import aiohttp
+import eth_abi
+import eth_utils
+
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+from rpc import RpcError, RpcWebsocketClient, HttpRpcClient
+
+
+"""
+Async, batched Multicall3 calls over RpcWebsocketClient/HttpRpcClient
+
+Calls are split into batches of at most batch_size calls, each batch is a single
+eth_call to Multicall3.aggregate3, and up to concurrency batches are in flight at once.
+A failed or rate limited batch is retried with exponential backoff, and a batch that fails
+to execute (ex. out of gas) is split in half and retried.
+
+All batches are called at the same block, so the results are one consistent snapshot.
+"""
+
+MULTICALL3_ADDRESS = '0xcA11bde05977b3631167028862bE2a173976CA11'
+
+AGGREGATE3_SELECTOR = eth_utils.function_signature_to_4byte_selector('aggregate3((address,bool,bytes)[])')
+
+GET_RESERVES_SELECTOR = eth_utils.function_signature_to_4byte_selector('getReserves()')
+SLOT0_SELECTOR = eth_utils.function_signature_to_4byte_selector('slot0()')
+LIQUIDITY_SELECTOR = eth_utils.function_signature_to_4byte_selector('liquidity()')
+
+RETRY_EXCEPTIONS = (ConnectionError, asyncio.TimeoutError, aiohttp.ClientError)
+
+# the eth_call failed to execute, a smaller batch can succeed. Other RpcErrors are raised
+EXECUTION_ERROR_PATTERN = re.compile(r'revert|out of gas|gas required|gas limit|execution', re.IGNORECASE)
+
+RpcClient = Union[RpcWebsocketClient, HttpRpcClient]
+
+
+async def aggregate3(rpc_client: RpcClient,
+                     calls: List[Tuple[str, bytes]],
+                     block: Union[int, str] = 'latest') -> List[Tuple[bool, bytes]]:
+    """
+    :param calls: [(target, calldata), ...]. Calls are allowed to fail
+    :return: [(success, return data), ...]
+    """
+    calldata = AGGREGATE3_SELECTOR + eth_abi.encode(
+        ['(address,bool,bytes)[]'],
+        [[(target, True, data) for target, data in calls]]
+    )
+    block = hex(block) if isinstance(block, int) else block
+    result = await rpc_client.request('eth_call', [
+        {'to': MULTICALL3_ADDRESS, 'data': '0x' + calldata.hex()},
+        block
+    ])
+    return eth_abi.decode(['(bool,bytes)[]'], eth_utils.decode_hex(result))[0]
+
+
+async def _call_batch(rpc_client: RpcClient,
+                      calls: List[Tuple[str, bytes]],
+                      block: Union[int, str],
+                      retries: int,
+                      backoff: float) -> List[Tuple[bool, bytes]]:
+
+    for attempt in range(retries + 1):
+        try:
+            return await aggregate3(rpc_client, calls, block)
+
+        except RpcError as e:
+            if e.rate_limited:
+                # splitting the batch would only send more requests
+                if attempt == retries:
+                    raise
+                print(f'Multicall of {len(calls)} calls rate limited ({attempt + 1}/{retries + 1}): {e}')
+                await asyncio.sleep(backoff * 2 ** attempt)
+            elif len(calls) > 1 and EXECUTION_ERROR_PATTERN.search(e.message):
+                print(f'Multicall of {len(calls)} calls failed, splitting the batch: {e}')
+                half = len(calls) // 2
+                return (await _call_batch(rpc_client, calls[:half], block, retries, backoff) +
+                        await _call_batch(rpc_client, calls[half:], block, retries, backoff))
+            else:
+                raise
+
+        except RETRY_EXCEPTIONS as e:
+            if attempt == retries:
+                raise
+            print(f'Multicall of {len(calls)} calls failed ({attempt + 1}/{retries + 1}): {e!r}')
+            await asyncio.sleep(backoff * 2 ** attempt)
+
+
+async def batch_call(rpc_client: RpcClient,
+                     calls: List[Tuple[str, bytes]],
+                     block: Union[int, str] = 'latest',
+                     batch_size: int = 500,
+                     concurrency: int = 4,
+                     retries: int = 3,
+                     backoff: float = 0.5) -> List[Tuple[bool, bytes]]:
+    """
+    :param calls: [(target, calldata), ...]
+    :param block: pass a block number so that all batches read the same state
+    :param batch_size: the maximum number of calls per eth_call
+    :param concurrency: the maximum number of eth_calls in flight
+    :return: [(success, return data), ...] in the order of calls
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def _call(batch: List[Tuple[str, bytes]]) -> List[Tuple[bool, bytes]]:
+        async with semaphore:
+            return await _call_batch(rpc_client, batch, block, retries, backoff)
+
+    batches = [calls[i:i + batch_size] for i in range(0, len(calls), batch_size)]
+    results = await asyncio.gather(*[_call(batch) for batch in batches])
+    return [result for batch_result in results for result in batch_result]
+
+
+async def get_block_number(rpc_client: RpcClient) -> int:
+    return int(await rpc_client.request('eth_blockNumber', []), base=16)
+
+
+async def fetch_v2_reserves(rpc_client: RpcClient,
+                            addresses: List[str],
+                            block: Union[int, str] = 'latest',
+                            **kwargs) -> Dict[str, List[int]]:
+    """
+    :return: {address (lowercase): [reserve0, reserve1]}. Failed calls are left out
+    """
+    calls = [(address, GET_RESERVES_SELECTOR) for address in addresses]
+    results = await batch_call(rpc_client, calls, block, **kwargs)
+
+    reserves = {}
+    for address, (success, data) in zip(addresses, results):
+        if success and len(data) >= 96:
+            reserve0, reserve1, _ = eth_abi.decode(['uint112', 'uint112', 'uint32'], data)
+            reserves[address.lower()] = [reserve0, reserve1]
+        else:
+            print(f'getReserves failed for {address}')
+    return reserves
+
+
+async def fetch_v3_states(rpc_client: RpcClient,
+                          addresses: List[str],
+                          block: Union[int, str] = 'latest',
+                          **kwargs) -> Dict[str, Dict[str, int]]:
+    """
+    :return: {address (lowercase): {'sqrt_price_x96': ..., 'tick': ..., 'liquidity': ...}}.
+             Failed calls are left out
+    """
+    calls = []
+    for address in addresses:
+        calls.append((address, SLOT0_SELECTOR))
+        calls.append((address, LIQUIDITY_SELECTOR))
+    results = await batch_call(rpc_client, calls, block, **kwargs)
+
+    states = {}
+    for i, address in enumerate(addresses):
+        (slot0_success, slot0), (liquidity_success, liquidity) = results[2 * i], results[2 * i + 1]
+        if slot0_success and liquidity_success and len(slot0) >= 64 and len(liquidity) >= 32:
+            sqrt_price_x96, tick = eth_abi.decode(['uint160', 'int24'], slot0[:64])
+            states[address.lower()] = {
+                'sqrt_price_x96': sqrt_price_x96,
+                'tick': tick,
+                'liquidity': eth_abi.decode(['uint128'], liquidity)[0],
+            }
+        else:
+            print(f'slot0/liquidity failed for {address}')
+    return states
+
+
+async def fetch_pool_states(rpc_client: RpcClient,
+                            pools: List[Dict[str, Any]],
+                            block: Optional[int] = None,
+                            **kwargs) -> Tuple[int, Dict[str, List[int]], Dict[str, Dict[str, int]]]:
+    """
+    Fetches the reserves of V2 pools and slot0/liquidity of V3 pools at the same block
+
+    :param block: the latest block if None
+    :return: (block_number, V2 reserves, V3 states)
+    """
+    if block is None:
+        block = await get_block_number(rpc_client)
+
+    v2_addresses = [pool['address'] for pool in pools if pool['version'] == 2]
+    v3_addresses = [pool['address'] for pool in pools if pool['version'] == 3]
+
+    reserves, states = await asyncio.gather(
+        fetch_v2_reserves(rpc_client, v2_addresses, block, **kwargs),
+        fetch_v3_states(rpc_client, v3_addresses, block, **kwargs),
+    )
+    return block, reserves, states
+
+
+if __name__ == '__main__':
+    import os
+    from dotenv import load_dotenv
+
+    from constants import POOLS
+
+    load_dotenv(override=True)
+
+    HTTP_RPC_URL = os.getenv('HTTP_RPC_URL')
+
+    async def main():
+        rpc_client = HttpRpcClient(HTTP_RPC_URL)
+        try:
+            block_number, reserves, states = await fetch_pool_states(rpc_client, POOLS)
+            print(block_number)
+            print(reserves)
+            print(states)
+        finally:
+            await rpc_client.close()
+
+    asyncio.run(main())
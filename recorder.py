@@ -0,0 +1,649 @@
+import os
+import json
+import time
+import queue
+import asyncio
+import threading
+import numpy as np
+
+from decimal import Decimal
+from typing import Any, Dict, Iterator, Optional, Union
+
+from utils import decimal_places, from_fixed
+from events import EXCHANGES, OrderbookSnapshot, PoolUpdate
+
+
+"""
+Tick capture in an append-only columnar binary format, and a memory-mapped replay
+
+A recording is a directory with one raw little-endian file per column:
+
+recording/
+    meta.json               column dtypes, symbol and pool tables
+    index/ts.bin            receive time (ns) of every event, in the order they were recorded
+    index/kind.bin          the table of the event: KIND_ORDERBOOK, KIND_POOL_UPDATE, KIND_BLOCK
+    index/row.bin           the row of the event in its table
+    orderbook/*.bin
+    pool_update/*.bin
+    block/*.bin
+
+Every table also has its own ts column, which is sorted, so a time range is found with
+np.searchsorted, and backtests can read the columns directly without building events.
+Rows are appended in batches, the tables before the index, so a reader never sees an index
+row pointing at a missing table row. A recording that was cut off (ex. the process was killed)
+is read up to its last complete row.
+"""
+
+KIND_ORDERBOOK = 0
+KIND_POOL_UPDATE = 1
+KIND_BLOCK = 2
+
+TABLE_NAMES = ['orderbook', 'pool_update', 'block']
+
+# 2: Decimal mode rows store their own scale. Version 1 scaled every Decimal row by 10 ** 8
+VERSION = 2
+DECIMAL_SCALE_V1 = 8
+
+INT64_MIN, INT64_MAX = -2 ** 63, 2 ** 63 - 1
+
+LEVELS = OrderbookSnapshot.DEPTH * 4
+
+SCHEMA = {
+    'index': [
+        ('ts', '<i8'),
+        ('kind', 'u1'),
+        ('row', '<u8'),
+    ],
+    # levels: bid price, bid quantity x DEPTH, then ask price, ask quantity x DEPTH.
+    # Prices/quantities are fixed-point integers. In Decimal mode, the decimals are -1 - the scale of the row
+    # (the fewest decimals that write its values without rounding), see decimal_scales
+    'orderbook': [
+        ('ts', '<i8'),
+        ('exchange_id', 'i1'),
+        ('symbol_id', '<u2'),
+        ('timestamp', '<i8'),
+        ('price_decimals', 'i1'),
+        ('quantity_decimals', 'i1'),
+        ('n_bids', 'u1'),
+        ('n_asks', 'u1'),
+        ('levels', '<i8', LEVELS),
+    ],
+    # reserves are uint112, stored as two uint64 halves: reserve = lo + (hi << 64)
+    'pool_update': [
+        ('ts', '<i8'),
+        ('block_number', '<u8'),
+        ('pool_id', '<u2'),
+        ('reserve0_lo', '<u8'),
+        ('reserve0_hi', '<u8'),
+        ('reserve1_lo', '<u8'),
+        ('reserve1_hi', '<u8'),
+    ],
+    'block': [
+        ('ts', '<i8'),
+        ('block_number', '<u8'),
+        ('base_fee', '<f8'),
+        ('next_base_fee', '<f8'),
+    ],
+}
+
+UINT64_MASK = (1 << 64) - 1
+
+
+def _column_dtype(column: tuple) -> np.dtype:
+    return np.dtype(column[1]) if len(column) == 2 else np.dtype((column[1], column[2]))
+
+
+def _fixed(value: Any, decimals: int) -> int:
+    if isinstance(value, Decimal):
+        value = int(value.scaleb(decimals))
+        if not INT64_MIN <= value <= INT64_MAX:
+            raise ValueError(f'{value} does not fit into an int64 level')
+    return value
+
+
+def decimal_scales(decimals: Union[int, np.ndarray], version: int = VERSION) -> Union[int, np.ndarray]:
+    """
+    The scales of the price_decimals/quantity_decimals column values: the levels are value * 10 ** -scale
+
+    :param version: meta['version'] of the recording (TickReader.version)
+    """
+    decimal_scale = DECIMAL_SCALE_V1 if version == 1 else -1 - decimals
+    if isinstance(decimals, np.ndarray):
+        return np.where(decimals < 0, decimal_scale, decimals)
+    return decimal_scale if decimals < 0 else decimals
+
+
+def reserves_from_halves(lo: np.ndarray, hi: np.ndarray) -> np.ndarray:
+    """
+    Joins the uint64 halves of the reserve columns into float64 reserves, for vectorized research.
+    Use int(lo) + (int(hi) << 64) where exact integers are needed
+    """
+    return lo.astype(np.float64) + hi.astype(np.float64) * 2.0 ** 64
+
+
+class TickRecorder:
+    """
+    Writes CEX orderbook snapshots, pool updates and blocks into a recording directory
+
+    Rows are buffered in memory and handed to a writer thread every flush_rows events
+    or flush_interval seconds, whichever comes first, so record() doesn't wait on the disk
+    when it's called on the streams' event loop. Other events (1inch orders, recoveries, ...)
+    are not recorded.
+
+    Usage:
+
+    recorder = TickRecorder('data/2023-07-20')
+    recorder.record(event)
+    ...
+    recorder.close()
+    """
+
+    def __init__(self,
+                 path: str,
+                 flush_rows: int = 10000,
+                 flush_interval: float = 1.0):
+        """
+        :param path: the recording directory. Recording into an existing directory appends to it
+        """
+        self.path = path
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+
+        for table in ['index'] + TABLE_NAMES:
+            os.makedirs(os.path.join(path, table), exist_ok=True)
+
+        meta = _read_meta(path)
+        if meta is not None and meta.get('version', 1) != VERSION:
+            raise ValueError(f'{path} is a version {meta.get("version", 1)} recording, record into a new directory')
+        self.symbols = meta['symbols'] if meta else []
+        self.pools = meta['pools'] if meta else []
+        self.symbol_ids = {symbol: i for i, symbol in enumerate(self.symbols)}
+        self.pool_ids = {tuple(pool): i for i, pool in enumerate(self.pools)}
+        self.meta_dirty = meta is None
+
+        # rows already on disk, so that the index points at the right rows when appending
+        self.rows = {table: _table_length(path, table) for table in TABLE_NAMES}
+
+        self.buffers = {table: {column[0]: [] for column in SCHEMA[table]} for table in SCHEMA}
+        self.buffered = 0
+        self.last_flush = time.monotonic()
+
+        self.events = 0
+
+        # (meta, {table: buffers}) batches, appended to the files in order by the writer thread
+        self.writes = queue.Queue()
+        self.writer = threading.Thread(target=self._write_loop, daemon=True)
+        self.writer.start()
+        self.closed = False
+
+    def _symbol_id(self, symbol: str) -> int:
+        if symbol not in self.symbol_ids:
+            self.symbol_ids[symbol] = len(self.symbols)
+            self.symbols.append(symbol)
+            self.meta_dirty = True
+        return self.symbol_ids[symbol]
+
+    def _pool_id(self, event: PoolUpdate) -> int:
+        pool = (event.exchange, event.version, event.address,
+                event.token0, event.token1, event.decimals0, event.decimals1)
+        if pool not in self.pool_ids:
+            self.pool_ids[pool] = len(self.pools)
+            self.pools.append(list(pool))
+            self.meta_dirty = True
+        return self.pool_ids[pool]
+
+    def _append(self, table: str, ts: int, row: Dict[str, Any]):
+        buffers = self.buffers[table]
+        buffers['ts'].append(ts)
+        for column, value in row.items():
+            buffers[column].append(value)
+
+        index = self.buffers['index']
+        index['ts'].append(ts)
+        index['kind'].append(TABLE_NAMES.index(table))
+        index['row'].append(self.rows[table])
+        self.rows[table] += 1
+
+    def record(self, event: Any, ts: Optional[int] = None):
+        """
+        :param ts: the receive time in nanoseconds, time.time_ns() if None
+        """
+        ts = time.time_ns() if ts is None else ts
+        event_type = event['type']
+
+        if event_type == 'orderbook':
+            decimal_mode = event['price_decimals'] is None
+            if decimal_mode:
+                levels = event['bids'][:OrderbookSnapshot.DEPTH] + event['asks'][:OrderbookSnapshot.DEPTH]
+                price_decimals = decimal_places(level[0] for level in levels)
+                quantity_decimals = decimal_places(level[1] for level in levels)
+                if max(price_decimals, quantity_decimals) > 127:
+                    raise ValueError(f'{event["exchange"]} {event["symbol"]} orderbook has too many decimals')
+            else:
+                price_decimals, quantity_decimals = event['price_decimals'], event['quantity_decimals']
+
+            levels = [0] * LEVELS
+            for i, (price, quantity) in enumerate(event['bids'][:OrderbookSnapshot.DEPTH]):
+                levels[i * 2] = _fixed(price, price_decimals)
+                levels[i * 2 + 1] = _fixed(quantity, quantity_decimals)
+            offset = OrderbookSnapshot.DEPTH * 2
+            for i, (price, quantity) in enumerate(event['asks'][:OrderbookSnapshot.DEPTH]):
+                levels[offset + i * 2] = _fixed(price, price_decimals)
+                levels[offset + i * 2 + 1] = _fixed(quantity, quantity_decimals)
+
+            timestamp = event.get('timestamp')
+            self._append('orderbook', ts, {
+                'exchange_id': EXCHANGES.index(event['exchange']),
+                'symbol_id': self._symbol_id(event['symbol']),
+                'timestamp': -1 if timestamp is None else timestamp,
+                'price_decimals': -1 - price_decimals if decimal_mode else price_decimals,
+                'quantity_decimals': -1 - quantity_decimals if decimal_mode else quantity_decimals,
+                'n_bids': min(len(event['bids']), OrderbookSnapshot.DEPTH),
+                'n_asks': min(len(event['asks']), OrderbookSnapshot.DEPTH),
+                'levels': levels,
+            })
+
+        elif event_type == 'pool_update':
+            self._append('pool_update', ts, {
+                'block_number': event.block_number,
+                'pool_id': self._pool_id(event),
+                'reserve0_lo': event.reserve0 & UINT64_MASK,
+                'reserve0_hi': event.reserve0 >> 64,
+                'reserve1_lo': event.reserve1 & UINT64_MASK,
+                'reserve1_hi': event.reserve1 >> 64,
+            })
+
+        elif event_type == 'block':
+            self._append('block', ts, {
+                'block_number': event['block_number'],
+                'base_fee': event['base_fee'],
+                'next_base_fee': event['next_base_fee'],
+            })
+
+        else:
+            return
+
+        self.events += 1
+        self.buffered += 1
+        if self.buffered >= self.flush_rows or time.monotonic() - self.last_flush > self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Hands the buffered rows to the writer thread. Call close to wait until they are on disk
+        """
+        meta = None
+        if self.meta_dirty:
+            meta = {
+                'version': VERSION,
+                'schema': SCHEMA,
+                'symbols': list(self.symbols),
+                'pools': list(self.pools),
+            }
+            self.meta_dirty = False
+
+        # the index goes last, see the module docstring
+        tables = {}
+        for table in TABLE_NAMES + ['index']:
+            if self.buffers[table]['ts']:
+                tables[table] = self.buffers[table]
+                self.buffers[table] = {column[0]: [] for column in SCHEMA[table]}
+
+        if meta is not None or tables:
+            self.writes.put((meta, tables))
+
+        self.buffered = 0
+        self.last_flush = time.monotonic()
+
+    def _write_loop(self):
+        while True:
+            batch = self.writes.get()
+            if batch is None:
+                return
+            meta, tables = batch
+            if meta is not None:
+                _write_meta(self.path, meta)
+            for table, buffers in tables.items():
+                for column in SCHEMA[table]:
+                    values = np.asarray(buffers[column[0]], dtype=column[1])
+                    with open(_column_path(self.path, table, column[0]), 'ab') as f:
+                        values.tofile(f)
+
+    def close(self):
+        """
+        Flushes, and waits for the writer thread to write everything
+        """
+        if self.closed:
+            return
+        self.closed = True
+        self.flush()
+        self.writes.put(None)
+        self.writer.join()
+
+
+class RecordingQueue:
+    """
+    Taps an event_queue: every event put into it is also recorded.
+    Pass it to the streams in place of the event_queue, the handlers keep reading the event_queue
+    """
+
+    def __init__(self, event_queue: Any, recorder: TickRecorder):
+        self.event_queue = event_queue
+        self.recorder = recorder
+
+    def put(self, event: Any, *args, **kwargs):
+        self.recorder.record(event)
+        if self.event_queue is not None:
+            self.event_queue.put(event, *args, **kwargs)
+
+
+async def record_events(event_queue: Any, recorder: TickRecorder):
+    """
+    Records everything published to event_queue, for a recorder that runs as the only handler
+    """
+    try:
+        while True:
+            event = await event_queue.coro_get()
+            recorder.record(event)
+    finally:
+        recorder.close()
+
+
+def _column_path(path: str, table: str, column: str) -> str:
+    return os.path.join(path, table, f'{column}.bin')
+
+
+def _read_meta(path: str) -> Optional[Dict[str, Any]]:
+    meta_path = os.path.join(path, 'meta.json')
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path) as f:
+        return json.load(f)
+
+
+def _write_meta(path: str, meta: Dict[str, Any]):
+    # replaced atomically, so a reader never sees a half written file
+    tmp_path = os.path.join(path, 'meta.json.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, os.path.join(path, 'meta.json'))
+
+
+def _table_length(path: str, table: str) -> int:
+    """
+    The number of complete rows in table: the shortest column
+    """
+    lengths = []
+    for column in SCHEMA[table]:
+        column_path = _column_path(path, table, column[0])
+        size = os.path.getsize(column_path) if os.path.exists(column_path) else 0
+        lengths.append(size // _column_dtype(column).itemsize)
+    return min(lengths)
+
+
+class TickReader:
+    """
+    Memory-maps a recording made by TickRecorder
+
+    table(name) returns the columns as read-only np.memmap arrays (no copies, pages are loaded on access),
+    and events(start, end) rebuilds the events in the order they were recorded:
+    OrderbookSnapshot, PoolUpdate, and the block dicts published by stream_new_blocks.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        meta = _read_meta(path)
+        if meta is None:
+            raise FileNotFoundError(f'No recording in {path}')
+        self.symbols = meta['symbols']
+        self.pools = meta['pools']
+        self.version = meta.get('version', 1)
+
+        self.tables = {table: self._map(table) for table in ['index'] + TABLE_NAMES}
+
+        # a table row can be cut off after its index row was written, by an appending recorder
+        index = self.tables['index']
+        n = len(index['ts'])
+        for kind, table in enumerate(TABLE_NAMES):
+            missing = np.flatnonzero((index['kind'] == kind) & (index['row'] >= len(self.tables[table]['ts'])))
+            if len(missing):
+                n = min(n, int(missing[0]))
+        self.length = n
+
+    def _map(self, table: str) -> Dict[str, np.ndarray]:
+        length = _table_length(self.path, table)
+        columns = {}
+        for column in SCHEMA[table]:
+            dtype = _column_dtype(column)
+            if length == 0:
+                columns[column[0]] = np.zeros((0,) + dtype.shape, dtype=dtype.base)
+            else:
+                columns[column[0]] = np.memmap(_column_path(self.path, table, column[0]),
+                                               dtype=dtype.base,
+                                               mode='r',
+                                               shape=(length,) + dtype.shape)
+        return columns
+
+    def __len__(self) -> int:
+        return self.length
+
+    def table(self, name: str) -> Dict[str, np.ndarray]:
+        return self.tables[name]
+
+    def time_range(self, table: str, start: Optional[int] = None, end: Optional[int] = None) -> slice:
+        """
+        :param start, end: receive times in nanoseconds. end is exclusive
+        :return: the rows of table recorded within [start, end)
+        """
+        ts = self.tables[table]['ts']
+        if table == 'index':
+            ts = ts[:self.length]
+        lo = 0 if start is None else int(np.searchsorted(ts, start, side='left'))
+        hi = len(ts) if end is None else int(np.searchsorted(ts, end, side='left'))
+        return slice(lo, hi)
+
+    def orderbook(self, row: int) -> OrderbookSnapshot:
+        table = self.tables['orderbook']
+        price_decimals = int(table['price_decimals'][row])
+        quantity_decimals = int(table['quantity_decimals'][row])
+        n_bids, n_asks = int(table['n_bids'][row]), int(table['n_asks'][row])
+        values = table['levels'][row].tolist()
+
+        if price_decimals < 0:
+            price_scale = decimal_scales(price_decimals, self.version)
+            quantity_scale = decimal_scales(quantity_decimals, self.version)
+            price = lambda value: from_fixed(value, price_scale)
+            quantity = lambda value: from_fixed(value, quantity_scale)
+            price_decimals, quantity_decimals = None, None
+        else:
+            price = quantity = int
+
+        offset = OrderbookSnapshot.DEPTH * 2
+        bids = [[price(values[i * 2]), quantity(values[i * 2 + 1])] for i in range(n_bids)]
+        asks = [[price(values[offset + i * 2]), quantity(values[offset + i * 2 + 1])] for i in range(n_asks)]
+        timestamp = int(table['timestamp'][row])
+
+        return OrderbookSnapshot(EXCHANGES[table['exchange_id'][row]],
+                                 self.symbols[table['symbol_id'][row]],
+                                 bids,
+                                 asks,
+                                 price_decimals,
+                                 quantity_decimals,
+                                 None if timestamp < 0 else timestamp)
+
+    def pool_update(self, row: int) -> PoolUpdate:
+        table = self.tables['pool_update']
+        exchange, version, address, token0, token1, decimals0, decimals1 = self.pools[table['pool_id'][row]]
+        return PoolUpdate(int(table['block_number'][row]),
+                          exchange,
+                          version,
+                          address,
+                          token0,
+                          token1,
+                          decimals0,
+                          decimals1,
+                          int(table['reserve0_lo'][row]) + (int(table['reserve0_hi'][row]) << 64),
+                          int(table['reserve1_lo'][row]) + (int(table['reserve1_hi'][row]) << 64))
+
+    def block(self, row: int) -> Dict[str, Any]:
+        table = self.tables['block']
+        return {
+            'source': 'dex',
+            'type': 'block',
+            'block_number': int(table['block_number'][row]),
+            'base_fee': float(table['base_fee'][row]),
+            'next_base_fee': float(table['next_base_fee'][row]),
+        }
+
+    def event(self, i: int) -> Any:
+        """
+        :param i: the position of the event in the index
+        """
+        index = self.tables['index']
+        kind, row = index['kind'][i], int(index['row'][i])
+        if kind == KIND_ORDERBOOK:
+            return self.orderbook(row)
+        elif kind == KIND_POOL_UPDATE:
+            return self.pool_update(row)
+        else:
+            return self.block(row)
+
+    def events(self, start: Optional[int] = None, end: Optional[int] = None) -> Iterator[Any]:
+        rows = self.time_range('index', start, end)
+        for i in range(rows.start, rows.stop):
+            yield self.event(i)
+
+
+class TickReplay:
+    """
+    Replays a recording with the event_queue API (get_nowait, coro_get), so the handlers
+    written for the live streams can run on recorded data
+
+    With speed=None the events are handed out as fast as the handler takes them,
+    otherwise at speed times the recorded rate. EOFError is raised once the recording is exhausted.
+    """
+
+    def __init__(self,
+                 reader: Union[str, TickReader],
+                 start: Optional[int] = None,
+                 end: Optional[int] = None,
+                 speed: Optional[float] = None):
+        """
+        :param reader: a TickReader or a recording directory
+        :param start, end: replay the events received within [start, end) (ns)
+        """
+        self.reader = reader if isinstance(reader, TickReader) else TickReader(reader)
+        self.speed = speed
+
+        rows = self.reader.time_range('index', start, end)
+        self.position = rows.start
+        self.stop = rows.stop
+
+        self.ts = self.reader.table('index')['ts']
+        self.started = None
+
+    def _delay(self) -> float:
+        """
+        Seconds until the next event is due
+        """
+        if self.speed is None:
+            return 0
+        now = time.monotonic()
+        if self.started is None:
+            self.started = (now, int(self.ts[self.position]))
+        wall_start, ts_start = self.started
+        due = wall_start + (int(self.ts[self.position]) - ts_start) / 1e9 / self.speed
+        return due - now
+
+    def qsize(self) -> int:
+        return self.stop - self.position
+
+    def get_nowait(self) -> Any:
+        if self.position >= self.stop:
+            raise EOFError('End of recording')
+        if self._delay() > 0:
+            raise queue.Empty
+        event = self.reader.event(self.position)
+        self.position += 1
+        return event
+
+    async def coro_get(self) -> Any:
+        if self.position >= self.stop:
+            raise EOFError('End of recording')
+        delay = self._delay()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        event = self.reader.event(self.position)
+        self.position += 1
+        return event
+
+    def __iter__(self):
+        while self.position < self.stop:
+            delay = self._delay()
+            if delay > 0:
+                time.sleep(delay)
+            event = self.reader.event(self.position)
+            self.position += 1
+            yield event
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Record the streams, or print a summary of a recording')
+    parser.add_argument('command', choices=['record', 'info'])
+    parser.add_argument('path')
+    parser.add_argument('--symbols', nargs='+', default=['ETH/USDT'])
+    args = parser.parse_args()
+
+    if args.command == 'info':
+        reader = TickReader(args.path)
+        ts = reader.table('index')['ts']
+        print(f'{len(reader)} events, {(ts[len(reader) - 1] - ts[0]) / 1e9:.1f} seconds' if len(reader) else '0 events')
+        for table in TABLE_NAMES:
+            print(f'{table}: {len(reader.table(table)["ts"])} rows')
+        print(f'symbols: {reader.symbols}')
+        print(f'pools: {len(reader.pools)}')
+    else:
+        from functools import partial
+        from dotenv import load_dotenv
+
+        from constants import TOKENS, POOLS
+        from utils import reconnecting_websocket_loop
+        from cex_streams import stream_binance_usdm_orderbook, stream_okx_usdm_orderbook
+        from dex_streams import PoolStateEngine, stream_new_blocks, stream_uniswap_v2_events
+
+        load_dotenv(override=True)
+
+        HTTP_RPC_URL = os.getenv('HTTP_RPC_URL')
+        WS_RPC_URL = os.getenv('WS_RPC_URL')
+
+        recorder = TickRecorder(args.path)
+        event_queue = RecordingQueue(None, recorder)
+
+        async def main():
+            pool_state_engine = PoolStateEngine(TOKENS, POOLS, event_queue)
+            await asyncio.gather(
+                reconnecting_websocket_loop(
+                    partial(stream_binance_usdm_orderbook, args.symbols, event_queue),
+                    tag='binance_stream'
+                ),
+                reconnecting_websocket_loop(
+                    partial(stream_okx_usdm_orderbook, args.symbols, event_queue),
+                    tag='okx_stream'
+                ),
+                reconnecting_websocket_loop(
+                    partial(stream_new_blocks, WS_RPC_URL, event_queue, False, pool_state_engine),
+                    tag='new_blocks_stream'
+                ),
+                reconnecting_websocket_loop(
+                    partial(stream_uniswap_v2_events, HTTP_RPC_URL, WS_RPC_URL, TOKENS, POOLS, event_queue, False,
+                            pool_state_engine),
+                    tag='uniswap_v2_stream'
+                ),
+            )
+
+        try:
+            asyncio.run(main())
+        finally:
+            recorder.close()
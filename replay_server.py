@@ -0,0 +1,631 @@
+import json
+import math
+import time
+import random
+import asyncio
+import eth_abi
+import eth_utils
+
+from aiohttp import web, WSMsgType
+from decimal import Decimal
+from collections import deque
+from typing import Any, Dict, List, Optional
+
+from utils import from_fixed
+from decoders import loads
+from events import OrderbookSnapshot, PoolUpdate
+from recorder import TickReplay
+from constants import TOKENS, ROUTING_POOLS
+from dex_streams import SYNC_EVENT_SELECTOR
+from multicall3 import (
+    AGGREGATE3_SELECTOR,
+    GET_RESERVES_SELECTOR,
+    SLOT0_SELECTOR,
+    LIQUIDITY_SELECTOR,
+)
+
+
+"""
+A local stand-in for Binance, OKX and an Ethereum node, for load benchmarks and tests without live venues
+
+Endpoints (the streams connect to them with their URL overrides, see ReplayServer.urls):
+
+- /binance: Binance USDM depth5 websocket (SUBSCRIBE)
+- /okx: OKX books5 websocket (subscribe), and /okx/instruments: the instruments REST endpoint
+- /rpc: JSON-RPC over websocket (eth_subscribe newHeads/logs) and over HTTP POST
+        (eth_blockNumber, eth_call to Multicall3.aggregate3, eth_getLogs)
+
+Frames are either synthetic (a random walk of the mid price, pools following it with Sync events),
+or replayed from a recording made by recorder.TickRecorder: orderbook snapshots are sent back as
+depth5/books5 frames, blocks as newHeads and pool updates as Sync logs, at their recorded pace.
+
+Like a node, the newHeads of a block are sent before the logs of the block.
+
+speed multiplies all rates: speed=10 sends depth frames every 10ms instead of 100ms,
+and a block every 1.2s. The exchange timestamps in the frames are set to the time they are sent,
+so the streams can measure their latency.
+"""
+
+BINANCE_PATH = '/binance'
+OKX_PATH = '/okx'
+OKX_INSTRUMENTS_PATH = '/okx/instruments'
+RPC_PATH = '/rpc'
+
+# the number of blocks of Sync logs kept for eth_getLogs
+LOG_HISTORY_BLOCKS = 256
+
+# synthetic pool prices: tokens priced as another token
+USD_ALIASES = {'USDC': 'USDT'}
+
+# the contract value of the OKX coin margined swaps served on /okx/instruments: books5 sizes are base * OKX_CT_VAL
+OKX_CT_VAL = 10
+
+GAS_LIMIT = 30_000_000
+
+
+def replay_urls(host: str = '127.0.0.1', port: int = 8765) -> Dict[str, str]:
+    """
+    The URL overrides of the streams to connect to a ReplayServer
+    """
+    return {
+        'binance_ws_url': f'ws://{host}:{port}{BINANCE_PATH}',
+        'okx_ws_url': f'ws://{host}:{port}{OKX_PATH}',
+        'okx_instruments_url': f'http://{host}:{port}{OKX_INSTRUMENTS_PATH}',
+        'ws_rpc_url': f'ws://{host}:{port}{RPC_PATH}',
+        'http_rpc_url': f'http://{host}:{port}{RPC_PATH}',
+    }
+
+
+class ReplayServer:
+
+    def __init__(self,
+                 host: str = '127.0.0.1',
+                 port: int = 8765,
+                 symbols: List[str] = ['ETH/USDT'],
+                 tokens: Dict[str, List[Any]] = TOKENS,
+                 pools: List[Dict[str, Any]] = ROUTING_POOLS,
+                 speed: float = 1.0,
+                 cex_interval: float = 0.1,
+                 block_time: float = 12,
+                 syncs_per_block: int = 2,
+                 recording: Optional[str] = None,
+                 start_price: float = 1850.0,
+                 volatility: float = 0.0001,
+                 seed: Optional[int] = None):
+        """
+        :param speed: multiple of the real rate
+        :param cex_interval: seconds between depth frames per symbol and exchange (100ms for depth5/books5)
+        :param syncs_per_block: the number of Sync events per block (synthetic mode)
+        :param recording: a recorder.TickRecorder recording directory to replay instead of the synthetic frames.
+                          The orderbooks of symbols not in symbols are not sent
+        :param volatility: the standard deviation of the mid price log return per depth frame
+        """
+        self.host = host
+        self.port = port
+        self.symbols = symbols
+        self.tokens = tokens
+        self.pools = pools
+        self.speed = speed
+        self.cex_interval = cex_interval
+        self.block_time = block_time
+        self.syncs_per_block = syncs_per_block
+        self.recording = recording
+        self.volatility = volatility
+
+        self.random = random.Random(seed)
+
+        self.prices = {symbol.replace('/', ''): start_price for symbol in symbols}
+
+        self.block_number = 17_000_000
+        self.base_fee = 20 * 10 ** 9
+
+        # address (lowercase) --> [reserve0, reserve1] of the V2 pools
+        self.reserves = {}
+        for pool in pools:
+            if pool['version'] == 2:
+                self.reserves[pool['address'].lower()] = self._pool_reserves(pool, self._pool_price(pool))
+
+        # Sync logs of the recent blocks for eth_getLogs
+        self.logs = deque()
+
+        # clients: websocket --> subscribed streams
+        self.binance_clients = {}
+        self.okx_clients = {}
+        # websocket --> {subscription id: params}
+        self.rpc_clients = {}
+        self.subscription_id = 0
+
+        self.sent = 0
+        self.runner = None
+        self.tasks = []
+
+    @property
+    def urls(self) -> Dict[str, str]:
+        return replay_urls(self.host, self.port)
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get(BINANCE_PATH, self._binance)
+        app.router.add_get(OKX_PATH, self._okx)
+        app.router.add_get(OKX_INSTRUMENTS_PATH, self._okx_instruments)
+        app.router.add_get(RPC_PATH, self._rpc_ws)
+        app.router.add_post(RPC_PATH, self._rpc_http)
+
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+
+        if self.recording is not None:
+            self.tasks = [asyncio.create_task(self._replay_recording())]
+        else:
+            self.tasks = [
+                asyncio.create_task(self._cex_loop()),
+                asyncio.create_task(self._block_loop()),
+            ]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+    async def serve_forever(self):
+        await self.start()
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await self.stop()
+
+    """
+    Websocket endpoints
+    """
+
+    async def _binance(self, request: web.Request) -> web.WebSocketResponse:
+        ws = web.WebSocketResponse(max_msg_size=0)
+        await ws.prepare(request)
+        self.binance_clients[ws] = set()
+        try:
+            async for msg in ws:
+                if msg.type != WSMsgType.TEXT:
+                    continue
+                data = loads(msg.data)
+                if data.get('method') == 'SUBSCRIBE':
+                    # ethusdt@depth5@100ms --> ETHUSDT
+                    self.binance_clients[ws].update(p.split('@')[0].upper() for p in data['params'])
+                    await ws.send_str(json.dumps({'result': None, 'id': data.get('id')}))
+        finally:
+            self.binance_clients.pop(ws, None)
+        return ws
+
+    async def _okx(self, request: web.Request) -> web.WebSocketResponse:
+        ws = web.WebSocketResponse(max_msg_size=0)
+        await ws.prepare(request)
+        self.okx_clients[ws] = set()
+        try:
+            async for msg in ws:
+                if msg.type != WSMsgType.TEXT:
+                    continue
+                data = loads(msg.data)
+                if data.get('op') == 'subscribe':
+                    self.okx_clients[ws].update(arg['instId'] for arg in data['args'])
+                    await ws.send_str(json.dumps({'event': 'subscribe', 'arg': data['args'][0]}))
+        finally:
+            self.okx_clients.pop(ws, None)
+        return ws
+
+    async def _okx_instruments(self, request: web.Request) -> web.Response:
+        data = []
+        for symbol in self.symbols:
+            base, quote = symbol.split('/')
+            # cex_streams reads the contract multiplier of the coin margined swap
+            data.append({'instId': f'{base}-USD-SWAP', 'ctMult': '1', 'ctVal': str(OKX_CT_VAL)})
+            data.append({'instId': f'{base}-{quote}-SWAP', 'ctMult': '1', 'ctVal': '0.1'})
+        return web.json_response({'code': '0', 'data': data})
+
+    async def _rpc_ws(self, request: web.Request) -> web.WebSocketResponse:
+        ws = web.WebSocketResponse(max_msg_size=0)
+        await ws.prepare(request)
+        self.rpc_clients[ws] = {}
+        try:
+            async for msg in ws:
+                if msg.type != WSMsgType.TEXT:
+                    continue
+                response = self._handle_rpc(loads(msg.data), ws)
+                await ws.send_str(json.dumps(response))
+        finally:
+            self.rpc_clients.pop(ws, None)
+        return ws
+
+    async def _rpc_http(self, request: web.Request) -> web.Response:
+        data = loads(await request.read())
+        if isinstance(data, list):
+            return web.json_response([self._handle_rpc(d) for d in data])
+        return web.json_response(self._handle_rpc(data))
+
+    """
+    JSON-RPC methods
+    """
+
+    def _handle_rpc(self, request: Dict[str, Any], ws: Optional[web.WebSocketResponse] = None) -> Dict[str, Any]:
+        method, params = request.get('method'), request.get('params', [])
+        response = {'jsonrpc': '2.0', 'id': request.get('id')}
+
+        try:
+            if method == 'eth_subscribe' and ws is not None:
+                self.subscription_id += 1
+                subscription_id = hex(self.subscription_id)
+                self.rpc_clients[ws][subscription_id] = params
+                response['result'] = subscription_id
+            elif method == 'eth_unsubscribe' and ws is not None:
+                response['result'] = self.rpc_clients[ws].pop(params[0], None) is not None
+            elif method == 'eth_blockNumber':
+                response['result'] = hex(self.block_number)
+            elif method == 'eth_chainId':
+                response['result'] = '0x1'
+            elif method == 'eth_call':
+                response['result'] = self._eth_call(params[0])
+            elif method == 'eth_getLogs':
+                response['result'] = self._eth_get_logs(params[0])
+            else:
+                response['error'] = {'code': -32601, 'message': f'the method {method} does not exist'}
+        except Exception as e:
+            response['error'] = {'code': -32000, 'message': repr(e)}
+
+        return response
+
+    def _eth_call(self, call: Dict[str, Any]) -> str:
+        data = eth_utils.decode_hex(call['data'])
+        if data[:4] != AGGREGATE3_SELECTOR:
+            raise ValueError('only Multicall3.aggregate3 is supported')
+
+        calls = eth_abi.decode(['(address,bool,bytes)[]'], data[4:])[0]
+        results = []
+        for target, _, calldata in calls:
+            target = target.lower()
+            if calldata == GET_RESERVES_SELECTOR and target in self.reserves:
+                reserve0, reserve1 = self.reserves[target]
+                results.append((True, eth_abi.encode(['uint112', 'uint112', 'uint32'], [reserve0, reserve1, 0])))
+            elif calldata == SLOT0_SELECTOR:
+                sqrt_price_x96, tick = self._slot0(target)
+                results.append((True, eth_abi.encode(['uint160', 'int24', 'uint16', 'uint16', 'uint16', 'uint8', 'bool'],
+                                                     [sqrt_price_x96, tick, 0, 1, 1, 0, True])))
+            elif calldata == LIQUIDITY_SELECTOR:
+                results.append((True, eth_abi.encode(['uint128'], [10 ** 18])))
+            else:
+                results.append((False, b''))
+
+        return '0x' + eth_abi.encode(['(bool,bytes)[]'], [results]).hex()
+
+    def _eth_get_logs(self, log_filter: Dict[str, Any]) -> List[Dict[str, Any]]:
+        from_block = int(log_filter.get('fromBlock', hex(self.block_number)), base=16)
+        to_block = int(log_filter.get('toBlock', hex(self.block_number)), base=16)
+        if from_block < self.block_number - LOG_HISTORY_BLOCKS:
+            raise ValueError('block range is too old')
+
+        addresses = log_filter.get('address')
+        if isinstance(addresses, str):
+            addresses = [addresses]
+        addresses = None if addresses is None else {address.lower() for address in addresses}
+
+        return [
+            log for log in self.logs
+            if from_block <= int(log['blockNumber'], base=16) <= to_block
+            and (addresses is None or log['address'].lower() in addresses)
+        ]
+
+    """
+    Synthetic frames
+    """
+
+    def _pool_price(self, pool: Dict[str, Any]) -> float:
+        """
+        The price of token0 in token1, from the CEX symbol of the pair in either order.
+        USDC is priced as USDT, and pairs without a CEX symbol (ex. USDC/USDT) are priced at 1
+        """
+        token0, token1 = [USD_ALIASES.get(token, token) for token in (pool['token0'], pool['token1'])]
+        if token0 == token1:
+            return 1.0
+        symbol = f'{token0}{token1}'
+        if symbol in self.prices:
+            return self.prices[symbol]
+        inverse = f'{token1}{token0}'
+        if inverse in self.prices:
+            return 1 / self.prices[inverse]
+        return 1.0
+
+    def _pool_reserves(self, pool: Dict[str, Any], price: float) -> List[int]:
+        decimals0 = self.tokens[pool['token0']][1]
+        decimals1 = self.tokens[pool['token1']][1]
+        reserve0 = 10_000 * self.random.uniform(0.5, 2)
+        return [int(reserve0 * 10 ** decimals0), int(reserve0 * price * 10 ** decimals1)]
+
+    def _slot0(self, address: str):
+        pool = next((p for p in self.pools if p['address'].lower() == address), None)
+        price = 1.0
+        if pool is not None:
+            price = self._pool_price(pool) * 10 ** (self.tokens[pool['token1']][1] - self.tokens[pool['token0']][1])
+        tick = int(math.log(price, 1.0001))
+        return int(math.sqrt(price) * 2 ** 96), tick
+
+    def _step_price(self, symbol: str) -> float:
+        price = self.prices[symbol] * math.exp(self.random.gauss(0, self.volatility))
+        self.prices[symbol] = price
+        return price
+
+    def _levels(self, price: float, side: int, quantity_scale: float = 1.0) -> List[List[float]]:
+        """
+        :param side: 1 for asks, -1 for bids
+        """
+        levels = []
+        level_price = price + side * 0.005
+        for i in range(5):
+            levels.append([round(level_price, 2), self.random.uniform(0.5, 50) * quantity_scale])
+            level_price += side * self.random.uniform(0.01, 0.03)
+        return levels
+
+    def _binance_frame(self, symbol: str, price: float) -> Dict[str, Any]:
+        now = int(time.time() * 1000)
+        return {
+            'e': 'depthUpdate',
+            'E': now,
+            'T': now,
+            's': symbol,
+            'U': 0,
+            'u': 0,
+            'pu': 0,
+            'b': [[f'{p:.2f}', f'{q:.3f}'] for p, q in self._levels(price, -1)],
+            'a': [[f'{p:.2f}', f'{q:.3f}'] for p, q in self._levels(price, 1)],
+        }
+
+    def _okx_frame(self, inst_id: str, price: float) -> Dict[str, Any]:
+        now = int(time.time() * 1000)
+        # sizes in contracts of 0.1 base
+        return {
+            'arg': {'channel': 'books5', 'instId': inst_id},
+            'data': [{
+                'asks': [[f'{p:.2f}', str(int(q)), '0', '1'] for p, q in self._levels(price, 1, OKX_CT_VAL)],
+                'bids': [[f'{p:.2f}', str(int(q)), '0', '1'] for p, q in self._levels(price, -1, OKX_CT_VAL)],
+                'instId': inst_id,
+                'ts': str(now),
+                'seqId': 0,
+            }],
+        }
+
+    async def _cex_loop(self):
+        interval = self.cex_interval / self.speed
+        next_time = time.monotonic()
+
+        while True:
+            for symbol in self.symbols:
+                binance_symbol = symbol.replace('/', '')
+                inst_id = f'{symbol.replace("/", "-")}-SWAP'
+
+                price = self._step_price(binance_symbol)
+                await self._broadcast_binance(binance_symbol, json.dumps(self._binance_frame(binance_symbol, price)))
+                await self._broadcast_okx(inst_id, json.dumps(self._okx_frame(inst_id, price)))
+
+            next_time += interval
+            await asyncio.sleep(max(0.0, next_time - time.monotonic()))
+
+    async def _block_loop(self):
+        interval = self.block_time / self.speed
+        v2_pools = [pool for pool in self.pools if pool['version'] == 2]
+
+        while True:
+            await asyncio.sleep(interval)
+
+            self.block_number += 1
+            self.base_fee = max(10 ** 9, int(self.base_fee * self.random.uniform(0.9, 1.1)))
+
+            logs = []
+            for log_index in range(self.syncs_per_block):
+                if not v2_pools:
+                    break
+                pool = self.random.choice(v2_pools)
+                price = self._pool_price(pool) * (1 + self.random.gauss(0, 0.0005))
+                reserve0 = self.reserves[pool['address'].lower()][0]
+                decimals0 = self.tokens[pool['token0']][1]
+                decimals1 = self.tokens[pool['token1']][1]
+                reserve1 = int(reserve0 / 10 ** decimals0 * price * 10 ** decimals1)
+                self.reserves[pool['address'].lower()] = [reserve0, reserve1]
+                logs.append(self._sync_log(pool['address'], log_index, reserve0, reserve1))
+
+            self._add_logs(logs)
+            await self._broadcast_rpc('newHeads', self._new_head())
+            for log in logs:
+                await self._broadcast_rpc('logs', log)
+
+    def _sync_log(self, address: str, log_index: int, reserve0: int, reserve1: int) -> Dict[str, Any]:
+        return {
+            'address': address.lower(),
+            'topics': [SYNC_EVENT_SELECTOR],
+            'data': '0x' + eth_abi.encode(['uint112', 'uint112'], [reserve0, reserve1]).hex(),
+            'blockNumber': hex(self.block_number),
+            'blockHash': '0x' + self.block_number.to_bytes(32, 'big').hex(),
+            'transactionHash': '0x' + (self.block_number * 1000 + log_index).to_bytes(32, 'big').hex(),
+            'transactionIndex': hex(log_index),
+            'logIndex': hex(log_index),
+            'removed': False,
+        }
+
+    def _new_head(self, gas_used: Optional[int] = None) -> Dict[str, Any]:
+        if gas_used is None:
+            gas_used = int(GAS_LIMIT * self.random.uniform(0.3, 0.7))
+        return {
+            'number': hex(self.block_number),
+            'hash': '0x' + self.block_number.to_bytes(32, 'big').hex(),
+            'timestamp': hex(int(time.time())),
+            'baseFeePerGas': hex(self.base_fee),
+            'gasUsed': hex(gas_used),
+            'gasLimit': hex(GAS_LIMIT),
+        }
+
+    def _add_logs(self, logs: List[Dict[str, Any]]):
+        self.logs.extend(logs)
+        oldest = self.block_number - LOG_HISTORY_BLOCKS
+        while self.logs and int(self.logs[0]['blockNumber'], base=16) < oldest:
+            self.logs.popleft()
+
+    """
+    Recorded frames
+    """
+
+    async def _replay_recording(self):
+        replay = TickReplay(self.recording, speed=self.speed)
+        inst_ids = {symbol.replace('/', ''): f'{symbol.replace("/", "-")}-SWAP' for symbol in self.symbols}
+
+        # the logIndex of the next Sync log of the block
+        log_index = 0
+
+        while replay.qsize():
+            event = await replay.coro_get()
+            now = int(time.time() * 1000)
+
+            if isinstance(event, OrderbookSnapshot):
+                if event.symbol not in inst_ids:
+                    continue
+                bids, asks = _level_strings(event, event.bids), _level_strings(event, event.asks)
+                if event.exchange == 'binance':
+                    data = {'e': 'depthUpdate', 'E': now, 'T': now, 's': event.symbol, 'U': 0, 'u': 0, 'pu': 0,
+                            'b': bids, 'a': asks}
+                    await self._broadcast_binance(event.symbol, json.dumps(data))
+                elif event.exchange == 'okx':
+                    inst_id = inst_ids[event.symbol]
+                    data = {
+                        'arg': {'channel': 'books5', 'instId': inst_id},
+                        'data': [{
+                            'asks': [[price, _contracts(quantity), '0', '1'] for price, quantity in asks],
+                            'bids': [[price, _contracts(quantity), '0', '1'] for price, quantity in bids],
+                            'instId': inst_id,
+                            'ts': str(now),
+                            'seqId': 0,
+                        }],
+                    }
+                    await self._broadcast_okx(inst_id, json.dumps(data))
+
+            elif isinstance(event, PoolUpdate):
+                if event.block_number > self.block_number:
+                    # a pool update recorded before the head of its block: the head goes first
+                    self.block_number = event.block_number
+                    log_index = 0
+                    await self._broadcast_rpc('newHeads', self._new_head())
+                address = event.address.lower()
+                self.reserves[address] = [event.reserve0, event.reserve1]
+                log = self._sync_log(address, log_index, event.reserve0, event.reserve1)
+                log['blockNumber'] = hex(event.block_number)
+                log_index += 1
+                self._add_logs([log])
+                await self._broadcast_rpc('logs', log)
+
+            elif event['block_number'] > self.block_number:
+                self.block_number = event['block_number']
+                log_index = 0
+                self.base_fee = int(event['base_fee'] * 10 ** 18)
+                await self._broadcast_rpc('newHeads', self._new_head(_gas_used(event['base_fee'],
+                                                                                event['next_base_fee'])))
+
+    """
+    Broadcasting
+    """
+
+    async def _send(self, ws: web.WebSocketResponse, msg: str):
+        try:
+            await ws.send_str(msg)
+            self.sent += 1
+        except ConnectionError:
+            pass
+
+    async def _broadcast_binance(self, symbol: str, msg: str):
+        for ws, symbols in list(self.binance_clients.items()):
+            if symbol in symbols:
+                await self._send(ws, msg)
+
+    async def _broadcast_okx(self, inst_id: str, msg: str):
+        for ws, inst_ids in list(self.okx_clients.items()):
+            if inst_id in inst_ids:
+                await self._send(ws, msg)
+
+    async def _broadcast_rpc(self, kind: str, result: Dict[str, Any]):
+        for ws, subscriptions in list(self.rpc_clients.items()):
+            for subscription_id, params in list(subscriptions.items()):
+                if params[0] != kind or not _log_matches(kind, params, result):
+                    continue
+                msg = {
+                    'jsonrpc': '2.0',
+                    'method': 'eth_subscription',
+                    'params': {'subscription': subscription_id, 'result': result},
+                }
+                await self._send(ws, json.dumps(msg))
+
+
+def _log_matches(kind: str, params: List[Any], log: Dict[str, Any]) -> bool:
+    if kind != 'logs' or len(params) < 2:
+        return True
+
+    log_filter = params[1]
+    addresses = log_filter.get('address')
+    if addresses is not None:
+        addresses = [addresses] if isinstance(addresses, str) else addresses
+        if log['address'].lower() not in {address.lower() for address in addresses}:
+            return False
+
+    for i, topic in enumerate(log_filter.get('topics', [])):
+        if topic is None:
+            continue
+        topics = topic if isinstance(topic, list) else [topic]
+        if i >= len(log['topics']) or log['topics'][i] not in topics:
+            return False
+
+    return True
+
+
+def _level_strings(event: OrderbookSnapshot, levels: List[List[Any]]) -> List[List[str]]:
+    """
+    The [price, quantity] decimal strings of recorded levels, Decimal or fixed-point
+    """
+    if event.price_decimals is None:
+        return [[format(price, 'f'), format(quantity, 'f')] for price, quantity in levels]
+    return [[format(from_fixed(price, event.price_decimals), 'f'),
+             format(from_fixed(quantity, event.quantity_decimals), 'f')]
+            for price, quantity in levels]
+
+
+def _contracts(quantity: str) -> str:
+    return format(Decimal(quantity) * OKX_CT_VAL, 'f')
+
+
+def _gas_used(base_fee: float, next_base_fee: float) -> int:
+    """
+    The gas used that makes the stream compute next_base_fee from base_fee (EIP-1559), within the gas limit
+    """
+    if base_fee <= 0:
+        return GAS_LIMIT // 2
+    gas_used = GAS_LIMIT / 2 * (1 + 8 * (next_base_fee - base_fee) / base_fee)
+    return int(min(max(gas_used, 0), GAS_LIMIT))
+
+
+def run_replay_server(**kwargs):
+    """
+    Runs a ReplayServer until the process is stopped. Used as a multiprocessing.Process target
+    """
+    asyncio.run(ReplayServer(**kwargs).serve_forever())
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Replay Binance/OKX/RPC websocket streams locally')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--speed', type=float, default=1.0, help='multiple of the real rate')
+    parser.add_argument('--recording', default=None, help='recorder.py recording directory to replay')
+    args = parser.parse_args()
+
+    server = ReplayServer(host=args.host, port=args.port, speed=args.speed, recording=args.recording)
+    for name, url in server.urls.items():
+        print(f'{name}: {url}')
+
+    asyncio.run(server.serve_forever())
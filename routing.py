@@ -0,0 +1,308 @@
+import aioprocessing
+import numpy as np
+
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Tuple
+
+from simulator import UniswapV2Simulator
+from metrics import record_dequeued, record_handled
+
+
+class Route:
+    """
+    A path of V2 pools from token_in to token_out: tokens[0] --> pools[0] --> tokens[1] --> ...
+    """
+    __slots__ = ('tokens', 'pools', 'fees', 'zero_for_one')
+
+    def __init__(self, tokens: List[str], pools: List[str], fees: List[int], zero_for_one: List[bool]):
+        """
+        :param pools: lowercase pool addresses
+        :param zero_for_one: per hop, True if token0 of the pool is swapped in
+        """
+        self.tokens = tokens
+        self.pools = pools
+        self.fees = fees
+        self.zero_for_one = zero_for_one
+
+    def __len__(self) -> int:
+        return len(self.pools)
+
+    def reverse(self) -> 'Route':
+        return Route(self.tokens[::-1],
+                     self.pools[::-1],
+                     self.fees[::-1],
+                     [not zero_for_one for zero_for_one in self.zero_for_one[::-1]])
+
+    def __repr__(self):
+        return f'Route({" --> ".join(self.tokens)}, {[pool[:10] for pool in self.pools]})'
+
+
+class Router:
+    """
+    Prices multi-hop DEX routes between the tokens of CEX symbols (ex. ETH --> USDC --> USDT for ETH/USDT)
+
+    The token graph is built once from the V2 pools, and every simple path of up to max_hops pools
+    between the base and quote tokens of each symbol is precomputed, together with an index of
+    pool --> routes through it. A pool update only marks the routes through that pool dirty,
+    and reprice (called once per block) re-prices only the dirty routes:
+
+    - sell: size base --> quote, the amount_out chained through get_amounts_out_approx
+    - buy: quote --> size base, the amount_in chained backwards through get_amounts_in_approx
+
+    The routes of a symbol with the same number of hops are priced together,
+    one batched float64 (approximate) simulator call per hop. best_route re-prices the best route
+    with the exact integer math of get_amount_out/get_amount_in.
+    """
+
+    def __init__(self,
+                 tokens: Dict[str, List[Any]],
+                 pools: List[Dict[str, Any]],
+                 symbols: List[str],
+                 max_hops: int = 3,
+                 sizes: Optional[Dict[str, float]] = None):
+        """
+        :param tokens, pools: constants.TOKENS, constants.ROUTING_POOLS. Only V2 pools are used
+        :param symbols: ['ETH/USDT', ...]
+        :param sizes: the base amount priced per symbol: {'ETH/USDT': 1}. 1 by default
+        """
+        self.tokens = tokens
+        self.max_hops = max_hops
+        self.sim = UniswapV2Simulator()
+
+        self.pools = {}
+        self.graph = defaultdict(list)
+        for pool in pools:
+            if pool['version'] != 2:
+                continue
+            address = pool['address'].lower()
+            self.pools[address] = pool
+            self.graph[pool['token0']].append((address, pool['token1'], True))
+            self.graph[pool['token1']].append((address, pool['token0'], False))
+
+        # symbol (ETHUSDT) --> routes from base to quote
+        self.symbols = {}
+        self.sizes = {}
+        self.routes = {}
+        self.routes_by_pool = defaultdict(set)
+        for symbol in symbols:
+            base, quote = symbol.split('/')
+            key = f'{base}{quote}'
+            self.symbols[key] = (base, quote)
+            self.sizes[key] = (sizes or {}).get(symbol, 1)
+            self.routes[key] = self._find_routes(base, quote)
+            for i, route in enumerate(self.routes[key]):
+                for address in route.pools:
+                    self.routes_by_pool[address].add((key, i))
+
+        # address --> [reserve0, reserve1]
+        self.reserves = {}
+
+        self.dirty = set()
+
+        # (symbol, route index) --> {'sell': {...}, 'buy': {...}}
+        self.quotes = {}
+
+    def _find_routes(self, token_in: str, token_out: str) -> List[Route]:
+        routes = []
+
+        def _search(tokens: List[str], hops: List[Tuple[str, str, bool]]):
+            if tokens[-1] == token_out:
+                routes.append(Route(list(tokens),
+                                    [hop[0] for hop in hops],
+                                    [self.pools[hop[0]]['fee'] for hop in hops],
+                                    [hop[2] for hop in hops]))
+                return
+            if len(hops) == self.max_hops:
+                return
+            for hop in self.graph[tokens[-1]]:
+                address, token, _ = hop
+                if token in tokens:
+                    continue
+                _search(tokens + [token], hops + [hop])
+
+        _search([token_in], [])
+        return routes
+
+    def on_event(self, event: Any):
+        if event['type'] != 'pool_update':
+            return
+        address = event['address'].lower()
+        if address not in self.pools:
+            return
+        self.reserves[address] = [event['reserve0'], event['reserve1']]
+        self.dirty.update(self.routes_by_pool[address])
+
+    def _hop_reserves(self, routes: List[Route], hop: int) -> Tuple[List[int], List[int], List[int]]:
+        reserves_in, reserves_out, fees = [], [], []
+        for route in routes:
+            reserve0, reserve1 = self.reserves[route.pools[hop]]
+            if route.zero_for_one[hop]:
+                reserves_in.append(reserve0)
+                reserves_out.append(reserve1)
+            else:
+                reserves_in.append(reserve1)
+                reserves_out.append(reserve0)
+            fees.append(route.fees[hop])
+        return reserves_in, reserves_out, fees
+
+    def _size(self, symbol: str) -> int:
+        base, _ = self.symbols[symbol]
+        return int(self.sizes[symbol] * 10 ** self.tokens[base][1])
+
+    def _quote(self, symbol: str, side: str, amount: float) -> Dict[str, Any]:
+        """
+        :param amount: the quote token amount out (sell) or in (buy) for the size, 0 if the route can't fill it
+        """
+        _, quote = self.symbols[symbol]
+        size = self.sizes[symbol]
+        amount = amount / 10 ** self.tokens[quote][1]
+        if side == 'sell':
+            return {'amount_in': size, 'amount_out': amount, 'price': amount / size}
+        return {'amount_in': amount, 'amount_out': size, 'price': amount / size if amount else None}
+
+    def _exact_quote(self, symbol: str, route: Route, side: str) -> Dict[str, Any]:
+        """
+        Re-prices one route with the scalar simulator methods, which are exact on 112-bit reserves
+        """
+        amount = self._size(symbol)
+        if side == 'sell':
+            for hop in range(len(route)):
+                (reserve_in,), (reserve_out,), (fee,) = self._hop_reserves([route], hop)
+                amount = self.sim.get_amount_out(amount, reserve_in, reserve_out, fee)
+            return self._quote(symbol, side, amount)
+
+        reversed_route = route.reverse()
+        for hop in reversed(range(len(route))):
+            (reserve_in,), (reserve_out,), (fee,) = self._hop_reserves([reversed_route], hop)
+            if amount >= reserve_out:
+                return self._quote(symbol, side, 0)
+            amount = self.sim.get_amount_in(amount, reserve_in, reserve_out, fee)
+        return self._quote(symbol, side, amount)
+
+    def _price_routes(self, symbol: str, indices: List[int]):
+        size = self._size(symbol)
+
+        by_hops = defaultdict(list)
+        for i in indices:
+            route = self.routes[symbol][i]
+            if all(address in self.reserves for address in route.pools):
+                by_hops[len(route)].append(i)
+
+        for hops, group in by_hops.items():
+            routes = [self.routes[symbol][i] for i in group]
+
+            # sell: chain the amount_out from base to quote
+            amounts = np.full(len(routes), size, dtype=np.float64)
+            for hop in range(hops):
+                reserves_in, reserves_out, fees = self._hop_reserves(routes, hop)
+                amounts = self.sim.get_amounts_out_approx(amounts, reserves_in, reserves_out, fees)
+            sell_out = amounts
+
+            # buy: chain the amount_in backwards from base to quote on the reversed routes
+            reversed_routes = [route.reverse() for route in routes]
+            amounts = np.full(len(routes), size, dtype=np.float64)
+            fillable = np.ones(len(routes), dtype=bool)
+            for hop in reversed(range(hops)):
+                reserves_in, reserves_out, fees = self._hop_reserves(reversed_routes, hop)
+                # a hop can't take out all of its reserve, the route can't fill the size
+                fillable &= amounts < np.array(reserves_out, dtype=np.float64)
+                amounts = np.where(fillable, amounts, 0)
+                amounts = self.sim.get_amounts_in_approx(amounts, reserves_in, reserves_out, fees)
+            amounts = np.where(fillable, amounts, 0)
+            buy_in = amounts
+
+            for i, amount_out, amount_in in zip(group, sell_out, buy_in):
+                self.quotes[(symbol, i)] = {
+                    'sell': self._quote(symbol, 'sell', amount_out),
+                    'buy': self._quote(symbol, 'buy', amount_in),
+                }
+
+    def reprice(self) -> Dict[str, List[int]]:
+        """
+        Re-prices the dirty routes, and marks them clean
+
+        :return: {symbol: [indices of the re-priced routes]}
+        """
+        dirty = defaultdict(list)
+        for symbol, i in self.dirty:
+            dirty[symbol].append(i)
+        for symbol, indices in dirty.items():
+            self._price_routes(symbol, indices)
+        self.dirty.clear()
+        return dict(dirty)
+
+    def best_route(self, symbol: str, side: str) -> Optional[Tuple[Route, Dict[str, Any]]]:
+        """
+        :param symbol: ETHUSDT
+        :param side: 'sell' (the most quote out for the size), 'buy' (the least quote in for the size)
+        :return: (route, quote) as of the last reprice. The best route is picked on the float64 quotes,
+                 and its quote is re-priced exactly
+        """
+        best = None
+        for i, route in enumerate(self.routes[symbol]):
+            route_quote = self.quotes.get((symbol, i))
+            if route_quote is None or route_quote[side]['price'] is None:
+                continue
+            price = route_quote[side]['price']
+            if best is None or (price > best[1]['price'] if side == 'sell' else price < best[1]['price']):
+                best = (route, route_quote[side])
+        if best is None:
+            return None
+        return best[0], self._exact_quote(symbol, best[0], side)
+
+
+async def route_handler(event_queue: aioprocessing.AioQueue, router: Router):
+    while True:
+        data = await event_queue.coro_get()
+        record_dequeued(data)
+        router.on_event(data)
+
+        if data['type'] == 'block':
+            repriced = router.reprice()
+            for symbol in repriced:
+                print(data['block_number'], symbol,
+                      'sell:', router.best_route(symbol, 'sell'),
+                      'buy:', router.best_route(symbol, 'buy'))
+        record_handled(data)
+
+
+if __name__ == '__main__':
+    """
+    Or with the runner: "handler": "router" in the config (see runner.py)
+    """
+    import os
+    import asyncio
+    from functools import partial
+    from dotenv import load_dotenv
+
+    from constants import TOKENS, ROUTING_POOLS
+    from utils import reconnecting_websocket_loop
+    from dex_streams import PoolStateEngine, stream_new_blocks, stream_uniswap_v2_events
+
+    load_dotenv(override=True)
+
+    HTTP_RPC_URL = os.getenv('HTTP_RPC_URL')
+    WS_RPC_URL = os.getenv('WS_RPC_URL')
+
+    router = Router(TOKENS, ROUTING_POOLS, ['ETH/USDT'])
+    for symbol, routes in router.routes.items():
+        print(symbol, routes)
+
+    async def main():
+        event_queue = aioprocessing.AioQueue()
+        pool_state_engine = PoolStateEngine(TOKENS, ROUTING_POOLS, event_queue)
+
+        await asyncio.gather(
+            reconnecting_websocket_loop(
+                partial(stream_new_blocks, WS_RPC_URL, event_queue, False, pool_state_engine),
+                tag='new_blocks_stream'
+            ),
+            reconnecting_websocket_loop(
+                partial(stream_uniswap_v2_events, HTTP_RPC_URL, WS_RPC_URL, TOKENS, ROUTING_POOLS, event_queue,
+                        False, pool_state_engine),
+                tag='uniswap_v2_stream'
+            ),
+            route_handler(event_queue, router),
+        )
+
+    asyncio.run(main())
@@ -0,0 +1,325 @@
+import re
+import json
+import asyncio
+import aiohttp
+import websockets
+
+from contextlib import asynccontextmanager
+from typing import Any, List, Optional
+
+from decoders import loads
+
+
+# notifications are routed by subscription id without decoding the whole message
+SUBSCRIPTION_ID_PATTERN = re.compile(r'"subscription"\s*:\s*"(0x[0-9a-fA-F]+)"')
+
+# JSON-RPC error codes that providers return for rate limited requests
+RATE_LIMIT_CODES = {-32005, 429}
+RATE_LIMIT_PATTERN = re.compile(r'rate limit|too many requests|exceeded .* capacity', re.IGNORECASE)
+
+
+class RpcError(Exception):
+
+    def __init__(self, method: str, error: Any):
+        super().__init__(f'{method} failed: {error}')
+        self.method = method
+        self.error = error
+        self.code = error.get('code') if isinstance(error, dict) else None
+        self.message = str(error.get('message', '')) if isinstance(error, dict) else str(error)
+
+    @property
+    def rate_limited(self) -> bool:
+        """
+        True if the provider rejected the request because of its rate limits. Retry it later, don't split it
+        """
+        return self.code in RATE_LIMIT_CODES or RATE_LIMIT_PATTERN.search(self.message) is not None
+
+
+class Subscription:
+    """
+    An eth_subscribe subscription on RpcWebsocketClient
+
+    Notifications are queued as raw messages, so streams can decode them with the typed decoders.
+    The subscription survives reconnects: the client subscribes again with the same params,
+    and keeps delivering to the same queue.
+    """
+
+    def __init__(self, client: 'RpcWebsocketClient', params: List[Any], queue: Optional[asyncio.Queue] = None):
+        """
+        :param queue: notifications are put into this queue. Several subscriptions can share one queue
+        """
+        self.client = client
+        self.params = params
+        self.queue = queue if queue is not None else asyncio.Queue()
+        self.subscription_id = None
+
+    async def get(self) -> str:
+        return await self.queue.get()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> str:
+        return await self.queue.get()
+
+    async def unsubscribe(self):
+        await self.client.unsubscribe(self)
+
+
+class RpcWebsocketClient:
+    """
+    A JSON-RPC websocket client that multiplexes eth_subscribe subscriptions and
+    ad-hoc requests (eth_call, eth_getLogs, ...) over a single connection
+
+    Responses are routed to the caller by request id, notifications by subscription id.
+    On a disconnect, pending requests fail with ConnectionError, and after reconnecting
+    all active subscriptions are subscribed again automatically.
+    Notifications sent while disconnected are lost: register a reconnect callback
+    (ex. PoolStateEngine.recover) to backfill them.
+
+    Usage:
+
+    client = RpcWebsocketClient(ws_rpc_url)
+    await client.start()
+
+    blocks = await client.subscribe(['newHeads'])
+    block_number = await client.request('eth_blockNumber', [])
+    msg = await blocks.get()
+    """
+
+    def __init__(self,
+                 ws_url: str,
+                 request_timeout: float = 30,
+                 reconnect_delay: float = 2):
+
+        self.ws_url = ws_url
+        self.request_timeout = request_timeout
+        self.reconnect_delay = reconnect_delay
+
+        self.ws = None
+        self.request_id = 0
+
+        # request id --> Future
+        self.requests = {}
+
+        # all active subscriptions, and subscription id --> Subscription of the current connection
+        self.subscriptions = []
+        self.subscription_ids = {}
+
+        self.connected = asyncio.Event()
+        self.reconnects = 0
+        self._task = None
+
+        # async callbacks run after every reconnect, once the subscriptions are active again,
+        # and sync callbacks run right after a disconnect
+        self.reconnect_callbacks = []
+        self.disconnect_callbacks = []
+        self._callback_tasks = set()
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+        await self.connected.wait()
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def run(self):
+        while True:
+            reader = None
+            try:
+                async with websockets.connect(self.ws_url, max_size=None) as ws:
+                    self.ws = ws
+                    reader = asyncio.create_task(self._read(ws))
+
+                    for subscription in list(self.subscriptions):
+                        await self._subscribe(subscription)
+
+                    self.connected.set()
+                    if self.reconnects > 0:
+                        self._run_reconnect_callbacks()
+                    await reader
+
+            except (websockets.ConnectionClosedError, websockets.ConnectionClosedOK, OSError) as e:
+                print(f'{self.ws_url} websocket connection closed: {e}')
+
+            except Exception as e:
+                print(f'An error has occurred with {self.ws_url} websocket: {e}')
+
+            finally:
+                if reader is not None:
+                    reader.cancel()
+                self._disconnected()
+
+            self.reconnects += 1
+            print('Reconnecting...')
+            await asyncio.sleep(self.reconnect_delay)
+
+    def _run_reconnect_callbacks(self):
+        for callback in list(self.reconnect_callbacks):
+            task = asyncio.create_task(self._run_callback(callback))
+            self._callback_tasks.add(task)
+            task.add_done_callback(self._callback_tasks.discard)
+
+    async def _run_callback(self, callback):
+        try:
+            await callback()
+        except Exception as e:
+            print(f'Reconnect callback {callback} failed: {e!r}')
+
+    def _disconnected(self):
+        self.ws = None
+        self.connected.clear()
+        self.subscription_ids = {}
+        for subscription in self.subscriptions:
+            subscription.subscription_id = None
+        for future in self.requests.values():
+            if not future.done():
+                future.set_exception(ConnectionError(f'{self.ws_url} disconnected'))
+        self.requests = {}
+        for callback in self.disconnect_callbacks:
+            callback()
+
+    async def _read(self, ws: websockets.WebSocketClientProtocol):
+        async for msg in ws:
+            if '"eth_subscription"' in msg[:200]:
+                match = SUBSCRIPTION_ID_PATTERN.search(msg)
+                subscription = self.subscription_ids.get(match.group(1)) if match else None
+                if subscription is not None:
+                    subscription.queue.put_nowait(msg)
+                continue
+
+            response = loads(msg)
+            future = self.requests.pop(response.get('id'), None)
+            if future is None or future.done():
+                continue
+            if 'error' in response:
+                future.set_exception(RpcError(future.method, response['error']))
+            else:
+                if future.subscription is not None:
+                    # map the subscription id before reading any of its notifications
+                    future.subscription.subscription_id = response['result']
+                    self.subscription_ids[response['result']] = future.subscription
+                future.set_result(response.get('result'))
+
+    async def _send_request(self,
+                            method: str,
+                            params: List[Any],
+                            subscription: Optional[Subscription] = None) -> Any:
+        self.request_id += 1
+        request_id = self.request_id
+
+        future = asyncio.get_running_loop().create_future()
+        future.method = method
+        future.subscription = subscription
+        self.requests[request_id] = future
+
+        request = {
+            'jsonrpc': '2.0',
+            'id': request_id,
+            'method': method,
+            'params': params,
+        }
+        try:
+            await self.ws.send(json.dumps(request))
+            return await asyncio.wait_for(future, timeout=self.request_timeout)
+        finally:
+            self.requests.pop(request_id, None)
+
+    async def request_ready(self):
+        await self.connected.wait()
+
+    async def request(self, method: str, params: List[Any]) -> Any:
+        await self.request_ready()
+        return await self._send_request(method, params)
+
+    async def _subscribe(self, subscription: Subscription):
+        await self._send_request('eth_subscribe', subscription.params, subscription)
+
+    async def subscribe(self, params: List[Any], queue: Optional[asyncio.Queue] = None) -> Subscription:
+        """
+        :param params: eth_subscribe params: ['newHeads'], ['logs', {'address': [...], 'topics': [...]}]
+        :param queue: deliver the notifications to this queue (ex. one queue shared by several subscriptions)
+        """
+        subscription = Subscription(self, params, queue)
+        await self.request_ready()
+        await self._subscribe(subscription)
+        self.subscriptions.append(subscription)
+        return subscription
+
+    async def unsubscribe(self, subscription: Subscription):
+        if subscription in self.subscriptions:
+            self.subscriptions.remove(subscription)
+
+        subscription_id = subscription.subscription_id
+        if subscription_id is not None:
+            subscription.subscription_id = None
+            self.subscription_ids.pop(subscription_id, None)
+            try:
+                await self._send_request('eth_unsubscribe', [subscription_id])
+            except (ConnectionError, RpcError, asyncio.TimeoutError):
+                pass
+
+
+class HttpRpcClient:
+    """
+    A JSON-RPC client over HTTP with the same request API as RpcWebsocketClient,
+    for the calls that shouldn't share the websocket with the subscriptions (ex. large multicalls)
+    """
+
+    def __init__(self, http_url: str, request_timeout: float = 30):
+        self.http_url = http_url
+        self.request_timeout = request_timeout
+
+        self.request_id = 0
+        self.session = None
+
+    async def request(self, method: str, params: List[Any]) -> Any:
+        if self.session is None:
+            timeout = aiohttp.ClientTimeout(total=self.request_timeout)
+            self.session = aiohttp.ClientSession(timeout=timeout)
+
+        self.request_id += 1
+        request = {
+            'jsonrpc': '2.0',
+            'id': self.request_id,
+            'method': method,
+            'params': params,
+        }
+        async with self.session.post(self.http_url, json=request) as response:
+            response.raise_for_status()
+            data = loads(await response.read())
+
+        if 'error' in data:
+            raise RpcError(method, data['error'])
+        return data['result']
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+
+@asynccontextmanager
+async def rpc_client_session(ws_rpc_url: str, rpc_client: Optional[RpcWebsocketClient] = None):
+    """
+    Yields rpc_client if it's given (shared by several streams),
+    otherwise opens a client on ws_rpc_url that is closed on exit
+    """
+    if rpc_client is not None:
+        await rpc_client.start()
+        yield rpc_client
+        return
+
+    client = RpcWebsocketClient(ws_rpc_url)
+    try:
+        await client.start()
+        yield client
+    finally:
+        await client.close()
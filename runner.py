@@ -0,0 +1,322 @@
+import os
+import sys
+import json
+import time
+import signal
+import asyncio
+
+from functools import partial
+from typing import Any, Callable, Dict, List, Optional
+
+from constants import TOKENS, POOLS, ROUTING_POOLS
+from event_bus import create_event_queue
+from rpc import RpcWebsocketClient
+from replay_server import replay_urls
+from metrics import log_metrics, serve_metrics
+from utils import RetryPolicy, reconnecting_websocket_loop, log_stream_stats
+from cex_streams import stream_binance_usdm_orderbook, stream_okx_usdm_orderbook
+from dex_streams import PoolStateEngine, stream_new_blocks, stream_uniswap_v2_events
+
+
+"""
+Runs the streams and an event handler from a JSON config, under one event loop:
+
+python -m runner --config config.json
+
+Without workers, the streams and the handler share the loop and a LocalQueue,
+so events don't cross a thread or a process. With workers > 0, the detector is sharded
+across worker processes (see sharding.py) and the runner only runs the streams.
+
+Every stream and handler runs in a supervised task: if it fails or returns, it's restarted
+with exponential backoff. SIGINT/SIGTERM cancel all the tasks and close the connections,
+the recorder and the workers. A dead worker process stops the runner with exit code 1,
+so that the process manager restarts it.
+
+See config.example.json. Keys that are left out get the DEFAULT_CONFIG values.
+"""
+DEFAULT_CONFIG = {
+    'symbols': ['ETH/USDT'],
+    # binance, okx
+    'venues': ['binance', 'okx'],
+    # stream new blocks and V2 Sync events
+    'dex': True,
+    # pool addresses or names (ETH/USDT) from constants.POOLS, or constants.ROUTING_POOLS for the router.
+    # All the pools if None
+    'pools': None,
+    'fixed_point': False,
+    # detector, router, recorder
+    'handler': 'detector',
+    # passed to the handler: OpportunityDetector/Router kwargs, or {'path': ...} for the recorder
+    'handler_options': {},
+    # worker processes for the detector, 0 runs it on the runner's event loop
+    'workers': 0,
+    # the workers' event queues: aioprocessing, shm
+    'worker_queue': 'aioprocessing',
+    # connect to a replay server (replay_server.py) on this port instead of the exchanges and the node
+    'replay_port': None,
+    'replay_host': '127.0.0.1',
+    # from the HTTP_RPC_URL, WS_RPC_URL environment variables if None
+    'http_rpc_url': None,
+    'ws_rpc_url': None,
+    'stale_timeout': 30,
+    'stats_interval': 60,
+    # latency histograms (see metrics.py): logged at this interval, and served on this port if set
+    'metrics_interval': 60,
+    'metrics_port': None,
+    'shutdown_timeout': 10,
+    'uvloop': False,
+}
+
+HANDLERS = ['detector', 'router', 'recorder']
+VENUES = ['binance', 'okx']
+
+
+def load_config(path: Optional[str] = None, **overrides) -> Dict[str, Any]:
+    """
+    :param path: JSON config file. The defaults are used if None
+    :param overrides: keys set over the file (ex. from command line flags). None values are ignored
+    """
+    config = dict(DEFAULT_CONFIG)
+    if path is not None:
+        with open(path) as f:
+            config.update(json.load(f))
+    config.update({key: value for key, value in overrides.items() if value is not None})
+
+    unknown = set(config) - set(DEFAULT_CONFIG)
+    if unknown:
+        raise ValueError(f'Unknown config keys: {sorted(unknown)}')
+    if config['handler'] not in HANDLERS:
+        raise ValueError(f'Unknown handler: {config["handler"]}. Choose from {HANDLERS}')
+    for venue in config['venues']:
+        if venue not in VENUES:
+            raise ValueError(f'Unknown venue: {venue}. Choose from {VENUES}')
+    if config['workers'] > 0 and config['handler'] != 'detector':
+        raise ValueError('Only the detector handler can run on workers')
+    return config
+
+
+def select_pools(pools: List[Dict[str, Any]], selection: Optional[List[str]]) -> List[Dict[str, Any]]:
+    if selection is None:
+        return pools
+    selection = {key.lower() for key in selection}
+    return [pool for pool in pools if pool['address'].lower() in selection or pool['name'].lower() in selection]
+
+
+class Runner:
+
+    def __init__(self, config: Dict[str, Any]):
+        self.config = config
+        self.symbols = config['symbols']
+        # the routing pools (USDC/ETH, ...) are only streamed for the router
+        self.pools = select_pools(ROUTING_POOLS if config['handler'] == 'router' else POOLS, config['pools'])
+
+        if config['replay_port'] is not None:
+            self.urls = replay_urls(config['replay_host'], config['replay_port'])
+        else:
+            self.urls = {
+                'http_rpc_url': config['http_rpc_url'] or os.getenv('HTTP_RPC_URL'),
+                'ws_rpc_url': config['ws_rpc_url'] or os.getenv('WS_RPC_URL'),
+            }
+
+        self.event_queue = None
+        self.publish_queue = None
+        self.workers = []
+        self.pool_state_engine = None
+        self.rpc_client = None
+        self.recorder = None
+        self.metrics_server = None
+
+        self.stop = None
+        self.exit_code = 0
+
+    def _streams(self) -> Dict[str, Callable]:
+        """
+        tag --> stream_fn for reconnecting_websocket_loop
+        """
+        event_queue = self.event_queue
+        fixed_point = self.config['fixed_point']
+        streams = {}
+
+        if 'binance' in self.config['venues']:
+            kwargs = {'ws_url': self.urls['binance_ws_url']} if 'binance_ws_url' in self.urls else {}
+            streams['binance_stream'] = partial(stream_binance_usdm_orderbook, self.symbols, event_queue, False,
+                                                fixed_point, **kwargs)
+
+        if 'okx' in self.config['venues']:
+            kwargs = {'ws_url': self.urls['okx_ws_url'], 'instruments_url': self.urls['okx_instruments_url']} \
+                if 'okx_ws_url' in self.urls else {}
+            streams['okx_stream'] = partial(stream_okx_usdm_orderbook, self.symbols, event_queue, False,
+                                            fixed_point, **kwargs)
+
+        if self.config['dex']:
+            http_rpc_url, ws_rpc_url = self.urls['http_rpc_url'], self.urls['ws_rpc_url']
+            self.pool_state_engine = PoolStateEngine(TOKENS, self.pools, event_queue)
+            # both streams subscribe over one websocket connection
+            self.rpc_client = RpcWebsocketClient(ws_rpc_url)
+            streams['new_blocks_stream'] = partial(stream_new_blocks, ws_rpc_url, event_queue, False,
+                                                   self.pool_state_engine, self.rpc_client)
+            streams['uniswap_v2_stream'] = partial(stream_uniswap_v2_events, http_rpc_url, ws_rpc_url, TOKENS,
+                                                   self.pools, event_queue, False, self.pool_state_engine, 500,
+                                                   self.rpc_client)
+        return streams
+
+    def _handler(self) -> Callable:
+        """
+        Returns a function that creates the handler coroutine. A restarted handler starts from a new state
+        """
+        handler = self.config['handler']
+        options = self.config['handler_options']
+
+        if self.config['workers'] > 0:
+            from sharding import print_opportunities
+            return partial(print_opportunities, self.publish_queue)
+
+        if handler == 'detector':
+            from detector import OpportunityDetector
+
+            def _detector():
+                return OpportunityDetector(self.symbols, self.pools, **options).run(self.event_queue)
+            return _detector
+
+        elif handler == 'router':
+            from routing import Router, route_handler
+
+            def _router():
+                return route_handler(self.event_queue, Router(TOKENS, self.pools, self.symbols, **options))
+            return _router
+
+        else:
+            from recorder import TickRecorder, record_events
+
+            def _recorder():
+                self.recorder = TickRecorder(**options)
+                return record_events(self.event_queue, self.recorder)
+            return _recorder
+
+    async def _supervise(self, name: str, coro_fn: Callable, policy: RetryPolicy = RetryPolicy(max_delay=60)):
+        """
+        Runs coro_fn(), and restarts it when it fails or returns. The failure count is reset
+        once it ran for longer than the policy's max delay
+        """
+        failures = 0
+        while True:
+            started_at = time.monotonic()
+            try:
+                await coro_fn()
+                print(f'[runner] {name} returned, restarting')
+            except Exception as e:
+                print(f'[runner] {name} failed: {e!r}')
+
+            if time.monotonic() - started_at > policy.max_delay:
+                failures = 0
+            failures += 1
+            delay = policy.delay(failures)
+            print(f'[runner] Restarting {name} in {delay:.2f}s (failure #{failures})')
+            await asyncio.sleep(delay)
+
+    async def _watch_workers(self, interval: float = 1):
+        while True:
+            await asyncio.sleep(interval)
+            for i, process in enumerate(self.workers):
+                if not process.is_alive():
+                    print(f'[runner] Worker {i} exited with code {process.exitcode}, stopping')
+                    self.exit_code = 1
+                    self.stop.set()
+                    return
+
+    async def run(self) -> int:
+        config = self.config
+        self.stop = asyncio.Event()
+
+        # the workers are started first, so that they don't inherit the signal handlers
+        if config['workers'] > 0:
+            from sharding import start_workers
+            self.event_queue, self.publish_queue, self.workers = start_workers(
+                self.symbols, self.pools, config['workers'], config['worker_queue'],
+                metrics_interval=config['metrics_interval'], **config['handler_options'])
+        else:
+            self.event_queue = create_event_queue('local')
+
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self.stop.set)
+
+        tasks = []
+        for tag, stream_fn in self._streams().items():
+            stream = partial(reconnecting_websocket_loop, stream_fn, tag, stale_timeout=config['stale_timeout'])
+            tasks.append(asyncio.create_task(self._supervise(tag, stream), name=tag))
+
+        tasks.append(asyncio.create_task(self._supervise(config['handler'], self._handler()), name='handler'))
+
+        if config['stats_interval']:
+            tasks.append(asyncio.create_task(log_stream_stats(config['stats_interval']), name='stats'))
+        if config['metrics_interval']:
+            tasks.append(asyncio.create_task(log_metrics(config['metrics_interval']), name='metrics'))
+        if config['metrics_port'] is not None:
+            self.metrics_server, url = await serve_metrics(port=config['metrics_port'])
+            print(f'[runner] Serving metrics on {url}')
+        if self.workers:
+            tasks.append(asyncio.create_task(self._watch_workers(), name='workers'))
+
+        print(f'[runner] Running {[task.get_name() for task in tasks]}')
+        await self.stop.wait()
+
+        print('[runner] Shutting down')
+        for task in tasks:
+            task.cancel()
+        _, pending = await asyncio.wait(tasks, timeout=config['shutdown_timeout'])
+        if pending:
+            print(f'[runner] Tasks did not stop in time: {[task.get_name() for task in pending]}')
+
+        await self.close()
+        return self.exit_code
+
+    async def close(self):
+        if self.metrics_server is not None:
+            await self.metrics_server.cleanup()
+        if self.rpc_client is not None:
+            await self.rpc_client.close()
+        if self.pool_state_engine is not None:
+            await self.pool_state_engine.close()
+        if self.recorder is not None:
+            self.recorder.close()
+        for process in self.workers:
+            process.terminate()
+            process.join()
+        if self.workers:
+            self.event_queue.close()
+            # releases the executor thread still blocked in the cancelled publish_queue.coro_get
+            self.publish_queue.put(None)
+
+
+def install_uvloop() -> bool:
+    try:
+        import uvloop
+    except ImportError:
+        print('[runner] uvloop is not installed, using the default event loop')
+        return False
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return True
+
+
+def main(args: Optional[List[str]] = None) -> int:
+    import argparse
+    from dotenv import load_dotenv
+
+    parser = argparse.ArgumentParser(description='Run the streams and an event handler from a JSON config')
+    parser.add_argument('--config', default=None, help='JSON config file, see config.example.json')
+    parser.add_argument('--workers', type=int, default=None, help='overrides the config')
+    parser.add_argument('--uvloop', action='store_true', default=None, help='overrides the config')
+    args = parser.parse_args(args)
+
+    load_dotenv(override=True)
+
+    config = load_config(args.config, workers=args.workers, uvloop=args.uvloop)
+    if config['uvloop']:
+        install_uvloop()
+
+    return asyncio.run(Runner(config).run())
+
+
+if __name__ == '__main__':
+    sys.exit(main())
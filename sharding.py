@@ -0,0 +1,242 @@
+import zlib
+import asyncio
+import multiprocessing
+import aioprocessing
+
+from typing import Any, Dict, List, Optional, Tuple
+
+from detector import OpportunityDetector
+from event_bus import create_event_queue
+from metrics import log_metrics
+
+
+"""
+Shards the symbols across worker processes, so that the event handling isn't limited by one GIL
+
+streams --> ShardedEventQueue --> event_queue per worker --> OpportunityDetector per worker --> publish_queue
+
+Every symbol belongs to one worker, by crc32(symbol) % workers, and that worker owns its whole state
+(MultiOrderbooks, pools, simulator). The streams keep running on one event loop and put into
+the ShardedEventQueue like into any event_queue:
+
+- orderbook: to the worker of the symbol
+- pool_update: to the worker of the symbol of the pool's tokens
+- block: to every worker, since it re-prices the gas of every symbol
+
+The ETH/quote books (ETHUSDT) convert the gas cost of every symbol with that quote,
+so they also go to every worker. The workers that don't own them only keep the book (gas_symbols).
+Events that no worker evaluates (ex. pools of routing tokens) go to every worker as well.
+
+The opportunities of all the workers are merged into one publish_queue.
+"""
+
+
+def shard_of(symbol: str, workers: int) -> int:
+    """
+    :param symbol: the event symbol format (ETHUSDT)
+    """
+    return zlib.crc32(symbol.encode()) % workers
+
+
+def shard_symbols(symbols: List[str], workers: int) -> List[List[str]]:
+    """
+    :param symbols: ['ETH/USDT', ...]
+    :return: the symbols of each worker
+    """
+    shards = [[] for _ in range(workers)]
+    for symbol in symbols:
+        shards[shard_of(symbol.replace('/', ''), workers)].append(symbol)
+    return shards
+
+
+class ShardedEventQueue:
+    """
+    Routes the events put into it to the event_queue of the worker that owns the event's symbol.
+    Pass it to the streams in place of the event_queue
+    """
+
+    def __init__(self,
+                 symbols: List[str],
+                 workers: int,
+                 queue_kind: str = 'aioprocessing',
+                 **kwargs):
+        """
+        :param symbols: ['ETH/USDT', ...]
+        :param queue_kind, kwargs: the event_queue of each worker, see event_bus.create_event_queue
+        """
+        self.workers = workers
+        self.queue_kind = queue_kind
+        self.queues = [create_event_queue(queue_kind, **kwargs) for _ in range(workers)]
+
+        self.shards = {}
+        self.token_symbols = {}
+        for symbol in symbols:
+            base, quote = symbol.split('/')
+            key = f'{base}{quote}'
+            self.shards[key] = shard_of(key, workers)
+            self.token_symbols[frozenset([base, quote])] = key
+
+        self.broadcast_symbols = {f'ETH{symbol.split("/")[1]}' for symbol in symbols} & set(self.shards)
+
+        self.routed = [0] * workers
+        self.broadcast = 0
+
+    def _shard(self, event: Any) -> Optional[int]:
+        """
+        The worker of the event, None if it goes to every worker
+        """
+        event_type = event['type']
+        if event_type == 'orderbook':
+            symbol = event['symbol']
+            if symbol in self.broadcast_symbols:
+                return None
+            return self.shards.get(symbol)
+        elif event_type == 'pool_update':
+            symbol = self.token_symbols.get(frozenset([event['token0'], event['token1']]))
+            return self.shards.get(symbol)
+        return None
+
+    def put(self, event: Any, *args, **kwargs):
+        shard = self._shard(event)
+        if shard is not None:
+            self.routed[shard] += 1
+            self.queues[shard].put(event, *args, **kwargs)
+        else:
+            self.broadcast += 1
+            for event_queue in self.queues:
+                event_queue.put(event, *args, **kwargs)
+
+    def close(self):
+        if self.queue_kind == 'shm':
+            for event_queue in self.queues:
+                event_queue.close()
+
+
+def shard_worker(event_queue: Any,
+                 publish_queue: Any,
+                 symbols: List[str],
+                 gas_symbols: List[str],
+                 pools: List[Dict[str, Any]],
+                 detector_kwargs: Dict[str, Any],
+                 tag: str = 'shard',
+                 metrics_interval: Optional[float] = 60):
+    """
+    Runs the OpportunityDetector of one shard. Used as a multiprocessing.Process target
+
+    :param metrics_interval: the worker's latency metrics are logged at this interval. Disabled if None
+    """
+    detector = OpportunityDetector(symbols, pools, gas_symbols=gas_symbols, **detector_kwargs)
+
+    async def _run():
+        tasks = [detector.run(event_queue, publish_queue)]
+        if metrics_interval:
+            tasks.append(log_metrics(metrics_interval, tag))
+        await asyncio.gather(*tasks)
+
+    try:
+        asyncio.run(_run())
+    except KeyboardInterrupt:
+        pass
+
+
+def start_workers(symbols: List[str],
+                  pools: List[Dict[str, Any]],
+                  workers: int,
+                  queue_kind: str = 'aioprocessing',
+                  publish_queue: Optional[Any] = None,
+                  metrics_interval: Optional[float] = 60,
+                  **detector_kwargs) -> Tuple[ShardedEventQueue, Any, List[multiprocessing.Process]]:
+    """
+    :param symbols: ['ETH/USDT', ...]
+    :param pools: constants.POOLS
+    :param publish_queue: the queue the workers put their opportunities into. A new AioQueue if None
+    :param metrics_interval: see shard_worker
+    :param detector_kwargs: passed to every OpportunityDetector (min_profit, depth, ...)
+    :return: (event_queue for the streams, publish_queue, worker processes)
+    """
+    event_queue = ShardedEventQueue(symbols, workers, queue_kind)
+    if publish_queue is None:
+        publish_queue = aioprocessing.AioQueue()
+
+    processes = []
+    for shard, shard_symbols_ in enumerate(shard_symbols(symbols, workers)):
+        gas_symbols = [symbol for symbol in symbols
+                       if symbol.replace('/', '') in event_queue.broadcast_symbols and symbol not in shard_symbols_]
+        process = multiprocessing.Process(
+            target=shard_worker,
+            args=(event_queue.queues[shard], publish_queue, shard_symbols_, gas_symbols, pools, detector_kwargs,
+                  f'shard {shard}', metrics_interval),
+            daemon=True,
+        )
+        process.start()
+        processes.append(process)
+        print(f'[shard {shard}] {len(shard_symbols_)} symbols: {shard_symbols_}')
+
+    return event_queue, publish_queue, processes
+
+
+async def print_opportunities(publish_queue: aioprocessing.AioQueue):
+    while True:
+        print(await publish_queue.coro_get())
+
+
+if __name__ == '__main__':
+    import os
+    import argparse
+    from functools import partial
+    from dotenv import load_dotenv
+
+    from constants import TOKENS, POOLS
+    from utils import reconnecting_websocket_loop
+    from cex_streams import stream_binance_usdm_orderbook, stream_okx_usdm_orderbook
+    from dex_streams import PoolStateEngine, stream_new_blocks, stream_uniswap_v2_events
+
+    parser = argparse.ArgumentParser(description='Run the OpportunityDetector sharded across worker processes')
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count() - 1,
+                        help='number of worker processes (the streams run in the main process)')
+    parser.add_argument('--symbols', default='ETH/USDT', help='comma separated: ETH/USDT,BTC/USDT')
+    parser.add_argument('--queue', default='aioprocessing', choices=['aioprocessing', 'shm'])
+    parser.add_argument('--min-profit', type=float, default=0)
+    args = parser.parse_args()
+
+    load_dotenv(override=True)
+
+    HTTP_RPC_URL = os.getenv('HTTP_RPC_URL')
+    WS_RPC_URL = os.getenv('WS_RPC_URL')
+
+    symbols = args.symbols.split(',')
+    workers = max(1, min(args.workers, len(symbols)))
+
+    event_queue, publish_queue, processes = start_workers(symbols, POOLS, workers, args.queue,
+                                                          min_profit=args.min_profit)
+
+    async def main():
+        pool_state_engine = PoolStateEngine(TOKENS, POOLS, event_queue)
+        await asyncio.gather(*[
+            reconnecting_websocket_loop(
+                partial(stream_binance_usdm_orderbook, symbols, event_queue),
+                tag='binance_stream'
+            ),
+            reconnecting_websocket_loop(
+                partial(stream_okx_usdm_orderbook, symbols, event_queue),
+                tag='okx_stream'
+            ),
+            reconnecting_websocket_loop(
+                partial(stream_new_blocks, WS_RPC_URL, event_queue, False, pool_state_engine),
+                tag='new_blocks_stream'
+            ),
+            reconnecting_websocket_loop(
+                partial(stream_uniswap_v2_events, HTTP_RPC_URL, WS_RPC_URL, TOKENS, POOLS, event_queue, False,
+                        pool_state_engine),
+                tag='uniswap_v2_stream'
+            ),
+            print_opportunities(publish_queue),
+        ])
+
+    try:
+        asyncio.run(main())
+    finally:
+        for process in processes:
+            process.terminate()
+            process.join()
+        event_queue.close()
@@ -1,3 +1,48 @@
+import math
+import bisect
+import numpy as np
+
+from typing import Any, Dict, List, Optional, Tuple
+
+
+def _to_float_arrays(*values):
+    arrays = [np.asarray(v).astype(np.float64) for v in values]
+    return np.broadcast_arrays(*arrays)
+
+
+"""
+A bound on the relative error of the float64 formulas of get_amounts_out/get_amounts_in on int inputs,
+with a wide margin: every input conversion and operation adds at most 2 ** -53
+"""
+FLOAT_ERROR = 2.0 ** -48
+
+
+def _exact_results(results: np.ndarray,
+                   lower: np.ndarray,
+                   upper: np.ndarray,
+                   inputs: List[np.ndarray],
+                   scalar) -> np.ndarray:
+    """
+    The scalar methods truncate a float quotient, so their results are float64 values,
+    and the float64 results are exact where the bounds of the quotient truncate to the same integer.
+    The other elements are re-priced with the scalar method on the original inputs
+
+    :param results: the float64 results, updated in place
+    :param lower, upper: the results at the error bounds of the quotient
+    :param inputs: the broadcast (amounts, reserves_in, reserves_out, fees), in their original dtype
+                   (Python ints of object arrays are kept)
+    """
+    if all(array.dtype.kind == 'f' for array in inputs[:3]):
+        # float amounts and reserves: the float64 formula is the same computation as the scalar method
+        # (the fees are small ints, exact in float64)
+        return results
+    uncertain = ~(np.isfinite(results) & (lower == upper))
+    if uncertain.any():
+        args = zip(*[array[uncertain].tolist() for array in inputs])
+        results[uncertain] = [scalar(*arg) for arg in args]
+    return results
+
+
 class UniswapV2Simulator:
 
     def __init__(self):
@@ -50,6 +95,107 @@ class UniswapV2Simulator:
         denominator = (reserve_out - amount_out) * (1000 - fee)
         return int(numerator / denominator + 1)
 
+    def reserves_to_prices(self,
+                           reserves0: np.ndarray,
+                           reserves1: np.ndarray,
+                           decimals0: np.ndarray,
+                           decimals1: np.ndarray,
+                           token0_in: np.ndarray) -> np.ndarray:
+        """
+        Batch version of reserves_to_price. Inputs are broadcast against each other
+        """
+        reserves0, reserves1, decimals0, decimals1, token0_in = _to_float_arrays(reserves0,
+                                                                                 reserves1,
+                                                                                 decimals0,
+                                                                                 decimals1,
+                                                                                 token0_in)
+        price = reserves1 / reserves0 * 10 ** (decimals0 - decimals1)
+        return np.where(token0_in.astype(bool), price, 1 / price)
+
+    def get_amounts_out(self,
+                        amounts_in: np.ndarray,
+                        reserves_in: np.ndarray,
+                        reserves_out: np.ndarray,
+                        fees: np.ndarray = 3000) -> np.ndarray:
+        """
+        Batch version of get_amount_out. Inputs are broadcast against each other,
+        so a grid of trade sizes across many pools can be priced in one call:
+
+        sim.get_amounts_out(amounts_in[:, None], reserves_in[None, :], reserves_out[None, :], fees[None, :])
+
+        --> shape: (len(amounts_in), number of pools)
+
+        The results are exactly the same as get_amount_out (as float64 values, which get_amount_out's are).
+        Reserves are up to 112 bits, which doesn't fit into int64, so the formula runs in float64 with
+        an error bound, and the elements that could truncate to another integer are re-priced with
+        get_amount_out. On int inputs that's every result above ~2 ** 48 (ex. amounts of 18 decimals tokens),
+        which costs about as much as a get_amount_out loop. Use get_amounts_out_approx to screen a large grid
+        """
+        inputs = np.broadcast_arrays(*[np.asarray(v) for v in (amounts_in, reserves_in, reserves_out, fees)])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            quotients = self._quotients_out(*[array.astype(np.float64) for array in inputs])
+            error = np.abs(quotients) * FLOAT_ERROR
+            return _exact_results(np.trunc(quotients),
+                                  np.trunc(quotients - error),
+                                  np.trunc(quotients + error),
+                                  inputs,
+                                  self.get_amount_out)
+
+    def get_amounts_out_approx(self,
+                               amounts_in: np.ndarray,
+                               reserves_in: np.ndarray,
+                               reserves_out: np.ndarray,
+                               fees: np.ndarray = 3000) -> np.ndarray:
+        """
+        get_amounts_out in float64 only. On int reserves the results can be off in the last digits
+        (relative error ~1e-15): screen candidates with it, and re-price them with get_amount_out
+        """
+        return np.trunc(self._quotients_out(*_to_float_arrays(amounts_in, reserves_in, reserves_out, fees)))
+
+    def _quotients_out(self, amounts_in, reserves_in, reserves_out, fees) -> np.ndarray:
+        fees = fees // 1000
+        amounts_in_with_fee = amounts_in * (1000 - fees)
+        numerator = amounts_in_with_fee * reserves_out
+        denominator = (reserves_in * 1000) + amounts_in_with_fee
+        return numerator / denominator
+
+    def get_amounts_in(self,
+                       amounts_out: np.ndarray,
+                       reserves_in: np.ndarray,
+                       reserves_out: np.ndarray,
+                       fees: np.ndarray = 3000) -> np.ndarray:
+        """
+        Batch version of get_amount_in. Broadcasting and exactness work the same way as get_amounts_out.
+        The error bound grows as amounts_out gets close to reserves_out
+        """
+        inputs = np.broadcast_arrays(*[np.asarray(v) for v in (amounts_out, reserves_in, reserves_out, fees)])
+        amounts_out, reserves_in, reserves_out, fees = [array.astype(np.float64) for array in inputs]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            quotients = self._quotients_in(amounts_out, reserves_in, reserves_out, fees)
+            cancellation = (np.abs(reserves_out) + np.abs(amounts_out)) / np.abs(reserves_out - amounts_out)
+            error = np.abs(quotients) * FLOAT_ERROR * (1 + cancellation)
+            return _exact_results(np.trunc(quotients + 1),
+                                  np.trunc(quotients - error + 1),
+                                  np.trunc(quotients + error + 1),
+                                  inputs,
+                                  self.get_amount_in)
+
+    def get_amounts_in_approx(self,
+                              amounts_out: np.ndarray,
+                              reserves_in: np.ndarray,
+                              reserves_out: np.ndarray,
+                              fees: np.ndarray = 3000) -> np.ndarray:
+        """
+        get_amounts_in in float64 only, see get_amounts_out_approx
+        """
+        return np.trunc(self._quotients_in(*_to_float_arrays(amounts_out, reserves_in, reserves_out, fees)) + 1)
+
+    def _quotients_in(self, amounts_out, reserves_in, reserves_out, fees) -> np.ndarray:
+        fees = fees // 1000
+        numerator = reserves_in * amounts_out * 1000
+        denominator = (reserves_out - amounts_out) * (1000 - fees)
+        return numerator / denominator
+
     def get_max_amount_in(self,
                           reserve0: float,
                           reserve1: float,
@@ -140,6 +286,592 @@ class UniswapV2Simulator:
 
         return optimized_in
 
+    def get_optimal_amount_in(self,
+                              reserve0: float,
+                              reserve1: float,
+                              decimals0: float,
+                              decimals1: float,
+                              fee: float,
+                              token0_in: bool,
+                              cex_price: Optional[float] = None,
+                              cex_fee: float = 0.0,
+                              cex_orderbook: Optional[List[List[Any]]] = None,
+                              max_amount_in: Optional[float] = None) -> Tuple[float, float, float]:
+        """
+        Calculates the profit maximizing amount_in of a CEX-DEX arbitrage:
+
+        1. swap amount_in of token_in for token_out on the DEX pool
+        2. convert token_out back to token_in on the CEX
+
+        With a constant product pool, amount_out = g * x * R_out / (R_in + g * x) where g = 1 - fee,
+        and selling at a CEX rate r (token_in per token_out, after the CEX fee), the profit is:
+
+        profit(x) = r * amount_out(x) - x
+
+        Setting d(profit)/dx = 0 gives the closed form:
+
+        x* = (sqrt(r * g * R_in * R_out) - R_in) / g
+
+        When a CEX orderbook is given, r drops level by level. The profit stays concave,
+        so we walk the levels and solve the closed form per level:
+        the optimum is either inside a level, or at the boundary between two levels
+        (solved with the inverse of amount_out). This replaces the binary search in get_max_amount_in
+        with O(number of CEX levels) math.
+
+        Prices are quoted as the CEX symbol: token0 price in token1 (ex. ETH/USDT: 1850).
+
+        - token0_in=False: buy token0 on the DEX with token1, sell token0 on the CEX --> pass the CEX bids
+        - token0_in=True: sell token0 on the DEX for token1, buy token0 back on the CEX --> pass the CEX asks
+
+        :param cex_price: the CEX price to trade at, used if cex_orderbook is None (infinite depth)
+        :param cex_fee: the CEX taker fee rate: 0.0004 (0.04%)
+        :param cex_orderbook: [[price, quantity], ...] quantity in token0 units, best price first
+        :param max_amount_in: caps amount_in (in token_in units)
+        :return: (amount_in, amount_out, profit) in token units. profit is in token_in units
+        """
+        if token0_in:
+            decimal_in, decimal_out = decimals0, decimals1
+            reserve_in, reserve_out = reserve0, reserve1
+        else:
+            decimal_in, decimal_out = decimals1, decimals0
+            reserve_in, reserve_out = reserve1, reserve0
+
+        gamma = (1000 - fee // 1000) / 1000
+
+        if cex_orderbook is None:
+            cex_orderbook = [[cex_price, math.inf]]
+
+        # CEX levels as: [rate (raw token_in per raw token_out), capacity (raw token_out)]
+        levels = []
+        for price, quantity in cex_orderbook:
+            price, quantity = float(price), float(quantity)
+            if token0_in:
+                rate = (1 - cex_fee) / price
+                capacity = quantity * price
+            else:
+                rate = price * (1 - cex_fee)
+                capacity = quantity
+            levels.append([rate * 10 ** (decimal_in - decimal_out), capacity * 10 ** decimal_out])
+
+        filled = 0
+        optimal_out = None
+
+        for rate, capacity in levels:
+            x = (math.sqrt(rate * gamma * reserve_in * reserve_out) - reserve_in) / gamma
+            y = gamma * x * reserve_out / (reserve_in + gamma * x) if x > 0 else 0
+
+            if y <= filled:
+                # the optimum is at the boundary with the previous level
+                optimal_out = filled
+                break
+
+            if y <= filled + capacity:
+                optimal_out = y
+                break
+
+            filled += capacity
+        else:
+            # we can't sell more than the CEX orderbook depth
+            optimal_out = filled
+
+        if optimal_out <= 0:
+            return 0, 0, 0
+
+        amount_in = reserve_in * optimal_out / (gamma * (reserve_out - optimal_out))
+        if max_amount_in is not None:
+            amount_in = min(amount_in, max_amount_in * 10 ** decimal_in)
+        amount_in = int(amount_in)
+
+        amount_out = self.get_amount_out(amount_in, reserve_in, reserve_out, fee)
+
+        proceeds = 0
+        remaining = amount_out
+        for rate, capacity in levels:
+            filled = min(remaining, capacity)
+            proceeds += filled * rate
+            remaining -= filled
+            if remaining <= 0:
+                break
+
+        profit = proceeds - amount_in
+
+        if profit <= 0:
+            return 0, 0, 0
+
+        return amount_in / 10 ** decimal_in, amount_out / 10 ** decimal_out, profit / 10 ** decimal_in
+
+
+
+"""
+Uniswap V3 math
+
+Ported from Uniswap v3-core libraries: TickMath, SqrtPriceMath, SwapMath, TickBitmap, FullMath.
+Python ints are arbitrary precision, so uint256 overflow checks are emulated where
+the contracts take a different code path on overflow (this changes rounding)
+"""
+MIN_TICK = -887272
+MAX_TICK = 887272
+
+MIN_SQRT_RATIO = 4295128739
+MAX_SQRT_RATIO = 1461446703485210103287273052203988822378723970342
+
+Q96 = 2 ** 96
+MAX_UINT256 = 2 ** 256 - 1
+
+_TICK_RATIOS = [
+    (0x2, 0xfff97272373d413259a46990580e213a),
+    (0x4, 0xfff2e50f5f656932ef12357cf3c7fdcc),
+    (0x8, 0xffe5caca7e10e4e61c3624eaa0941cd0),
+    (0x10, 0xffcb9843d60f6159c9db58835c926644),
+    (0x20, 0xff973b41fa98c081472e6896dfb254c0),
+    (0x40, 0xff2ea16466c96a3843ec78b326b52861),
+    (0x80, 0xfe5dee046a99a2a811c461f1969c3053),
+    (0x100, 0xfcbe86c7900a88aedcffc83b479aa3a4),
+    (0x200, 0xf987a7253ac413176f2b074cf7815e54),
+    (0x400, 0xf3392b0822b70005940c7a398e4b70f3),
+    (0x800, 0xe7159475a2c29b7443b29c7fa6e889d9),
+    (0x1000, 0xd097f3bdfd2022b8845ad8f792aa5825),
+    (0x2000, 0xa9f746462d870fdf8a65dc1f90e061e5),
+    (0x4000, 0x70d869a156d2a1b890bb3df62baf32f7),
+    (0x8000, 0x31be135f97d08fd981231505542fcfa6),
+    (0x10000, 0x9aa508b5b7a84e1c677de54f3e99bc9),
+    (0x20000, 0x5d6af8dedb81196699c329225ee604),
+    (0x40000, 0x2216e584f5fa1ea926041bedfe98),
+    (0x80000, 0x48a170391f7dc42444e8fa2),
+]
+
+
+def _mul_div_rounding_up(a: int, b: int, denominator: int) -> int:
+    return -(-a * b // denominator)
+
+
+def _div_rounding_up(a: int, b: int) -> int:
+    return -(-a // b)
+
+
+def get_sqrt_ratio_at_tick(tick: int) -> int:
+    """
+    Returns sqrt(1.0001 ^ tick) * 2 ^ 96
+    """
+    abs_tick = abs(tick)
+    if abs_tick > MAX_TICK:
+        raise ValueError(f'Tick out of range: {tick}')
+
+    ratio = 0xfffcb933bd6fad37aa2d162d1a594001 if abs_tick & 0x1 else 0x100000000000000000000000000000000
+    for bit, multiplier in _TICK_RATIOS:
+        if abs_tick & bit:
+            ratio = (ratio * multiplier) >> 128
+
+    if tick > 0:
+        ratio = MAX_UINT256 // ratio
+
+    return (ratio >> 32) + (0 if ratio % (1 << 32) == 0 else 1)
+
+
+def get_tick_at_sqrt_ratio(sqrt_price_x96: int) -> int:
+    """
+    Returns the greatest tick such that get_sqrt_ratio_at_tick(tick) <= sqrt_price_x96
+    """
+    if not MIN_SQRT_RATIO <= sqrt_price_x96 < MAX_SQRT_RATIO:
+        raise ValueError(f'Sqrt price out of range: {sqrt_price_x96}')
+
+    # estimate with floats, then correct the estimate with the exact tick math
+    tick = math.floor(2 * math.log(sqrt_price_x96 / Q96) / math.log(1.0001))
+    tick = max(MIN_TICK, min(tick, MAX_TICK - 1))
+
+    while get_sqrt_ratio_at_tick(tick) > sqrt_price_x96:
+        tick -= 1
+    while tick < MAX_TICK and get_sqrt_ratio_at_tick(tick + 1) <= sqrt_price_x96:
+        tick += 1
+
+    return tick
+
+
+def get_amount0_delta(sqrt_ratio_a_x96: int, sqrt_ratio_b_x96: int, liquidity: int, round_up: bool) -> int:
+    if sqrt_ratio_a_x96 > sqrt_ratio_b_x96:
+        sqrt_ratio_a_x96, sqrt_ratio_b_x96 = sqrt_ratio_b_x96, sqrt_ratio_a_x96
+
+    numerator1 = liquidity << 96
+    numerator2 = sqrt_ratio_b_x96 - sqrt_ratio_a_x96
+
+    if round_up:
+        return _div_rounding_up(_mul_div_rounding_up(numerator1, numerator2, sqrt_ratio_b_x96), sqrt_ratio_a_x96)
+    return numerator1 * numerator2 // sqrt_ratio_b_x96 // sqrt_ratio_a_x96
+
+
+def get_amount1_delta(sqrt_ratio_a_x96: int, sqrt_ratio_b_x96: int, liquidity: int, round_up: bool) -> int:
+    if sqrt_ratio_a_x96 > sqrt_ratio_b_x96:
+        sqrt_ratio_a_x96, sqrt_ratio_b_x96 = sqrt_ratio_b_x96, sqrt_ratio_a_x96
+
+    if round_up:
+        return _mul_div_rounding_up(liquidity, sqrt_ratio_b_x96 - sqrt_ratio_a_x96, Q96)
+    return liquidity * (sqrt_ratio_b_x96 - sqrt_ratio_a_x96) // Q96
+
+
+def _get_next_sqrt_price_from_amount0_rounding_up(sqrt_price_x96: int,
+                                                  liquidity: int,
+                                                  amount: int,
+                                                  add: bool) -> int:
+    if amount == 0:
+        return sqrt_price_x96
+
+    numerator1 = liquidity << 96
+    product = amount * sqrt_price_x96
+
+    if add:
+        if product <= MAX_UINT256 and numerator1 + product <= MAX_UINT256:
+            return _mul_div_rounding_up(numerator1, sqrt_price_x96, numerator1 + product)
+        return _div_rounding_up(numerator1, numerator1 // sqrt_price_x96 + amount)
+    else:
+        if product > MAX_UINT256 or numerator1 <= product:
+            raise ValueError('Not enough liquidity')
+        return _mul_div_rounding_up(numerator1, sqrt_price_x96, numerator1 - product)
+
+
+def _get_next_sqrt_price_from_amount1_rounding_down(sqrt_price_x96: int,
+                                                    liquidity: int,
+                                                    amount: int,
+                                                    add: bool) -> int:
+    if add:
+        return sqrt_price_x96 + (amount << 96) // liquidity
+    else:
+        quotient = _div_rounding_up(amount << 96, liquidity)
+        if sqrt_price_x96 <= quotient:
+            raise ValueError('Not enough liquidity')
+        return sqrt_price_x96 - quotient
+
+
+def get_next_sqrt_price_from_input(sqrt_price_x96: int, liquidity: int, amount_in: int, zero_for_one: bool) -> int:
+    if zero_for_one:
+        return _get_next_sqrt_price_from_amount0_rounding_up(sqrt_price_x96, liquidity, amount_in, True)
+    return _get_next_sqrt_price_from_amount1_rounding_down(sqrt_price_x96, liquidity, amount_in, True)
+
+
+def get_next_sqrt_price_from_output(sqrt_price_x96: int, liquidity: int, amount_out: int, zero_for_one: bool) -> int:
+    if zero_for_one:
+        return _get_next_sqrt_price_from_amount1_rounding_down(sqrt_price_x96, liquidity, amount_out, False)
+    return _get_next_sqrt_price_from_amount0_rounding_up(sqrt_price_x96, liquidity, amount_out, False)
+
+
+def compute_swap_step(sqrt_ratio_current_x96: int,
+                      sqrt_ratio_target_x96: int,
+                      liquidity: int,
+                      amount_remaining: int,
+                      fee_pips: int) -> Tuple[int, int, int, int]:
+    """
+    Returns (sqrt_ratio_next_x96, amount_in, amount_out, fee_amount) of a swap within a single tick range.
+    amount_remaining > 0: exact input, amount_remaining < 0: exact output
+    """
+    zero_for_one = sqrt_ratio_current_x96 >= sqrt_ratio_target_x96
+    exact_in = amount_remaining >= 0
+
+    amount_in, amount_out = 0, 0
+
+    if exact_in:
+        amount_remaining_less_fee = amount_remaining * (1000000 - fee_pips) // 1000000
+        if zero_for_one:
+            amount_in = get_amount0_delta(sqrt_ratio_target_x96, sqrt_ratio_current_x96, liquidity, True)
+        else:
+            amount_in = get_amount1_delta(sqrt_ratio_current_x96, sqrt_ratio_target_x96, liquidity, True)
+        if amount_remaining_less_fee >= amount_in:
+            sqrt_ratio_next_x96 = sqrt_ratio_target_x96
+        else:
+            sqrt_ratio_next_x96 = get_next_sqrt_price_from_input(sqrt_ratio_current_x96,
+                                                                 liquidity,
+                                                                 amount_remaining_less_fee,
+                                                                 zero_for_one)
+    else:
+        if zero_for_one:
+            amount_out = get_amount1_delta(sqrt_ratio_target_x96, sqrt_ratio_current_x96, liquidity, False)
+        else:
+            amount_out = get_amount0_delta(sqrt_ratio_current_x96, sqrt_ratio_target_x96, liquidity, False)
+        if -amount_remaining >= amount_out:
+            sqrt_ratio_next_x96 = sqrt_ratio_target_x96
+        else:
+            sqrt_ratio_next_x96 = get_next_sqrt_price_from_output(sqrt_ratio_current_x96,
+                                                                  liquidity,
+                                                                  -amount_remaining,
+                                                                  zero_for_one)
+
+    reached_target = sqrt_ratio_target_x96 == sqrt_ratio_next_x96
+
+    if zero_for_one:
+        if not (reached_target and exact_in):
+            amount_in = get_amount0_delta(sqrt_ratio_next_x96, sqrt_ratio_current_x96, liquidity, True)
+        if not (reached_target and not exact_in):
+            amount_out = get_amount1_delta(sqrt_ratio_next_x96, sqrt_ratio_current_x96, liquidity, False)
+    else:
+        if not (reached_target and exact_in):
+            amount_in = get_amount1_delta(sqrt_ratio_current_x96, sqrt_ratio_next_x96, liquidity, True)
+        if not (reached_target and not exact_in):
+            amount_out = get_amount0_delta(sqrt_ratio_current_x96, sqrt_ratio_next_x96, liquidity, False)
+
+    if not exact_in and amount_out > -amount_remaining:
+        amount_out = -amount_remaining
+
+    if exact_in and sqrt_ratio_next_x96 != sqrt_ratio_target_x96:
+        fee_amount = amount_remaining - amount_in
+    else:
+        fee_amount = _mul_div_rounding_up(amount_in, fee_pips, 1000000 - fee_pips)
+
+    return sqrt_ratio_next_x96, amount_in, amount_out, fee_amount
+
+
+class UniswapV3PoolState:
+    """
+    In-memory state of a Uniswap V3 pool
+
+    ticks: {tick: [liquidity_gross, liquidity_net]} of initialized ticks
+    tick_list: the initialized ticks sorted, for range queries
+    tick_bitmap: {word_position: 256 bit word}, the same layout as UniswapV3Pool.tickBitmap,
+                 used for the next initialized tick lookup during swaps
+    """
+    __slots__ = (
+        'address',
+        'fee',
+        'tick_spacing',
+        'sqrt_price_x96',
+        'tick',
+        'liquidity',
+        'ticks',
+        'tick_list',
+        'tick_bitmap',
+    )
+
+    def __init__(self,
+                 address: str,
+                 fee: int,
+                 tick_spacing: int,
+                 sqrt_price_x96: int,
+                 tick: int,
+                 liquidity: int):
+
+        self.address = address
+        self.fee = fee
+        self.tick_spacing = tick_spacing
+        self.sqrt_price_x96 = sqrt_price_x96
+        self.tick = tick
+        self.liquidity = liquidity
+        self.ticks = {}
+        self.tick_list = []
+        self.tick_bitmap = {}
+
+    def _flip_tick(self, tick: int):
+        compressed = tick // self.tick_spacing
+        word_position, bit_position = compressed >> 8, compressed % 256
+        self.tick_bitmap[word_position] = self.tick_bitmap.get(word_position, 0) ^ (1 << bit_position)
+
+    def update_tick(self, tick: int, liquidity_delta: int, upper: bool):
+        """
+        Applies a liquidity change at a tick boundary of a position (Mint: liquidity_delta > 0, Burn: < 0)
+        """
+        liquidity_gross, liquidity_net = self.ticks.get(tick, [0, 0])
+        liquidity_gross_after = liquidity_gross + liquidity_delta
+        liquidity_net = liquidity_net - liquidity_delta if upper else liquidity_net + liquidity_delta
+
+        if (liquidity_gross == 0) != (liquidity_gross_after == 0):
+            self._flip_tick(tick)
+
+        if liquidity_gross_after == 0:
+            if tick in self.ticks:
+                del self.ticks[tick]
+                del self.tick_list[bisect.bisect_left(self.tick_list, tick)]
+        else:
+            if tick not in self.ticks:
+                bisect.insort(self.tick_list, tick)
+            self.ticks[tick] = [liquidity_gross_after, liquidity_net]
+
+    def set_tick(self, tick: int, liquidity_gross: int, liquidity_net: int):
+        """
+        Loads an initialized tick as read from UniswapV3Pool.ticks(tick)
+        """
+        if liquidity_gross == 0:
+            self.update_tick(tick, -self.ticks.get(tick, [0, 0])[0], False)
+            return
+
+        if tick not in self.ticks:
+            bisect.insort(self.tick_list, tick)
+            self._flip_tick(tick)
+        self.ticks[tick] = [liquidity_gross, liquidity_net]
+
+    def next_initialized_tick_within_one_word(self, tick: int, lte: bool) -> Tuple[int, bool]:
+        compressed = tick // self.tick_spacing
+
+        if lte:
+            word_position, bit_position = compressed >> 8, compressed % 256
+            mask = (1 << bit_position) - 1 + (1 << bit_position)
+            masked = self.tick_bitmap.get(word_position, 0) & mask
+            initialized = masked != 0
+            if initialized:
+                most_significant_bit = masked.bit_length() - 1
+                next_tick = (compressed - (bit_position - most_significant_bit)) * self.tick_spacing
+            else:
+                next_tick = (compressed - bit_position) * self.tick_spacing
+        else:
+            compressed += 1
+            word_position, bit_position = compressed >> 8, compressed % 256
+            mask = ~((1 << bit_position) - 1) & MAX_UINT256
+            masked = self.tick_bitmap.get(word_position, 0) & mask
+            initialized = masked != 0
+            if initialized:
+                least_significant_bit = (masked & -masked).bit_length() - 1
+                next_tick = (compressed + (least_significant_bit - bit_position)) * self.tick_spacing
+            else:
+                next_tick = (compressed + (255 - bit_position)) * self.tick_spacing
+
+        return next_tick, initialized
+
+
+class UniswapV3Simulator:
+    """
+    Local quoter for Uniswap V3 pools
+
+    Holds the state of each pool (sqrtPriceX96, liquidity, tick table) and computes
+    exact swap amounts across tick crossings, the same way UniswapV3Pool.swap does.
+    The state is updated incrementally from the pool's Swap/Mint/Burn events
+    """
+
+    def __init__(self):
+        self.pools = {}
+
+    def add_pool(self,
+                 address: str,
+                 fee: int,
+                 tick_spacing: int,
+                 sqrt_price_x96: int,
+                 tick: int,
+                 liquidity: int,
+                 ticks: Optional[Dict[int, List[int]]] = None) -> UniswapV3PoolState:
+        """
+        :param ticks: {tick: [liquidity_gross, liquidity_net]} of the initialized ticks
+        """
+        pool = UniswapV3PoolState(address.lower(), fee, tick_spacing, sqrt_price_x96, tick, liquidity)
+        for _tick, (liquidity_gross, liquidity_net) in (ticks or {}).items():
+            pool.set_tick(_tick, liquidity_gross, liquidity_net)
+        self.pools[pool.address] = pool
+        return pool
+
+    def apply_swap(self, address: str, sqrt_price_x96: int, liquidity: int, tick: int):
+        """
+        Swap(sender, recipient, amount0, amount1, sqrtPriceX96, liquidity, tick)
+        """
+        pool = self.pools[address.lower()]
+        pool.sqrt_price_x96 = sqrt_price_x96
+        pool.liquidity = liquidity
+        pool.tick = tick
+
+    def apply_mint(self, address: str, tick_lower: int, tick_upper: int, amount: int):
+        """
+        Mint(sender, owner, tickLower, tickUpper, amount, amount0, amount1)
+        """
+        self._modify_position(self.pools[address.lower()], tick_lower, tick_upper, amount)
+
+    def apply_burn(self, address: str, tick_lower: int, tick_upper: int, amount: int):
+        """
+        Burn(owner, tickLower, tickUpper, amount, amount0, amount1)
+        """
+        self._modify_position(self.pools[address.lower()], tick_lower, tick_upper, -amount)
+
+    def _modify_position(self, pool: UniswapV3PoolState, tick_lower: int, tick_upper: int, liquidity_delta: int):
+        if liquidity_delta == 0:
+            return
+
+        pool.update_tick(tick_lower, liquidity_delta, False)
+        pool.update_tick(tick_upper, liquidity_delta, True)
+
+        if tick_lower <= pool.tick < tick_upper:
+            pool.liquidity += liquidity_delta
+
+    def sqrt_price_to_price(self,
+                            sqrt_price_x96: int,
+                            decimals0: float,
+                            decimals1: float,
+                            token0_in: bool) -> float:
+        """
+        Same as UniswapV2Simulator.reserves_to_price, using the pool's sqrtPriceX96
+        """
+        price = (sqrt_price_x96 / Q96) ** 2 * 10 ** (decimals0 - decimals1)
+        return price if token0_in else 1 / price
+
+    def swap(self,
+             address: str,
+             zero_for_one: bool,
+             amount_specified: int,
+             sqrt_price_limit_x96: Optional[int] = None) -> Tuple[int, int, int, int, int]:
+        """
+        Simulates UniswapV3Pool.swap without changing the pool state
+
+        :param amount_specified: > 0: exact input amount, < 0: exact output amount
+        :return: (amount0, amount1, sqrt_price_x96, tick, liquidity) after the swap.
+                 amount0/amount1 are positive if paid into the pool, negative if paid out
+        """
+        pool = self.pools[address.lower()]
+
+        if sqrt_price_limit_x96 is None:
+            sqrt_price_limit_x96 = MIN_SQRT_RATIO + 1 if zero_for_one else MAX_SQRT_RATIO - 1
+
+        exact_input = amount_specified > 0
+
+        amount_specified_remaining = amount_specified
+        amount_calculated = 0
+        sqrt_price_x96 = pool.sqrt_price_x96
+        tick = pool.tick
+        liquidity = pool.liquidity
+
+        while amount_specified_remaining != 0 and sqrt_price_x96 != sqrt_price_limit_x96:
+            sqrt_price_start_x96 = sqrt_price_x96
+
+            tick_next, initialized = pool.next_initialized_tick_within_one_word(tick, zero_for_one)
+            tick_next = max(MIN_TICK, min(tick_next, MAX_TICK))
+
+            sqrt_price_next_x96 = get_sqrt_ratio_at_tick(tick_next)
+
+            if zero_for_one:
+                use_limit = sqrt_price_next_x96 < sqrt_price_limit_x96
+            else:
+                use_limit = sqrt_price_next_x96 > sqrt_price_limit_x96
+            sqrt_price_target_x96 = sqrt_price_limit_x96 if use_limit else sqrt_price_next_x96
+
+            sqrt_price_x96, amount_in, amount_out, fee_amount = compute_swap_step(sqrt_price_x96,
+                                                                                 sqrt_price_target_x96,
+                                                                                 liquidity,
+                                                                                 amount_specified_remaining,
+                                                                                 pool.fee)
+
+            if exact_input:
+                amount_specified_remaining -= amount_in + fee_amount
+                amount_calculated -= amount_out
+            else:
+                amount_specified_remaining += amount_out
+                amount_calculated += amount_in + fee_amount
+
+            if sqrt_price_x96 == sqrt_price_next_x96:
+                if initialized:
+                    liquidity_net = pool.ticks[tick_next][1]
+                    liquidity += -liquidity_net if zero_for_one else liquidity_net
+                tick = tick_next - 1 if zero_for_one else tick_next
+            elif sqrt_price_x96 != sqrt_price_start_x96:
+                tick = get_tick_at_sqrt_ratio(sqrt_price_x96)
+
+        if zero_for_one == exact_input:
+            amount0, amount1 = amount_specified - amount_specified_remaining, amount_calculated
+        else:
+            amount0, amount1 = amount_calculated, amount_specified - amount_specified_remaining
+
+        return amount0, amount1, sqrt_price_x96, tick, liquidity
+
+    def get_amount_out(self, address: str, amount_in: int, zero_for_one: bool) -> int:
+        amount0, amount1, *_ = self.swap(address, zero_for_one, amount_in)
+        return -amount1 if zero_for_one else -amount0
+
+    def get_amount_in(self, address: str, amount_out: int, zero_for_one: bool) -> int:
+        """
+        Returns the amount_in needed for amount_out.
+        If the pool can't provide amount_out within the price range, the amount_in for the available output is returned
+        """
+        amount0, amount1, *_ = self.swap(address, zero_for_one, -amount_out)
+        return amount0 if zero_for_one else amount1
+
 
 if __name__ == '__main__':
     pass
\ No newline at end of file
@@ -4,74 +4,222 @@ import finplot as fplt
 
 import sys
 import zmq
+import asyncio
 import zmq.asyncio
-import json
 import time
 import datetime
+import numpy as np
 import pandas as pd
-from typing import Dict, Any
+from typing import Dict, Any, List, Optional, Tuple
 
 fplt.display_timezone = datetime.timezone.utc
 
 
+"""
+Spreads are published as multipart ZMQ messages: [topic, payload]
+
+- topic: 'ETHUSDT|binance/uniswap' (see spread_topic), so that a Subscriber can subscribe
+         to a symbol ('ETHUSDT|') or a single symbol/venue pair. ZMQ filters topics by prefix on the publisher
+- payload: a batch of SPREAD_DTYPE records (timestamp in ms, spread), packed little-endian back to back
+
+The Publisher buffers the records per topic, and sends a topic's batch when it has batch_size records
+or when flush_interval seconds passed since its last send. A timer sends the batch of a topic that
+stopped receiving records, so the last spreads of a quiet topic are not held back.
+"""
+SPREAD_DTYPE = np.dtype([('ts', '<i8'), ('spread', '<f8')])
+
+DEFAULT_TOPIC = 'spread'
+
+
+def spread_topic(symbol: str, venues: str) -> str:
+    """
+    :param symbol: ETHUSDT
+    :param venues: the venue pair of the spread (ex. binance/uniswap)
+    """
+    return f'{symbol}|{venues}'
+
+
+def encode_spreads(records: List[Tuple[int, float]]) -> bytes:
+    return np.array(records, dtype=SPREAD_DTYPE).tobytes()
+
+
+def decode_spreads(payload: bytes) -> np.ndarray:
+    return np.frombuffer(payload, dtype=SPREAD_DTYPE)
+
+
 class Publisher:
-    
-    def __init__(self, port: int):
+
+    def __init__(self, port: int, batch_size: int = 100, flush_interval: float = 0.1):
+        """
+        :param batch_size: the maximum number of records per message
+        :param flush_interval: a topic's buffered records are sent at most this long after they were
+                               buffered (seconds), by the next send or by a timer. Call flush when done
+        """
         self.port = port
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
         self.context = zmq.asyncio.Context()
         self.socket = self.context.socket(zmq.PUB)
         self.socket.bind(f'tcp://*:{port}')
 
-    async def send(self, data: Dict[str, Any]):
-        await self.socket.send_string(json.dumps(data))
-        
-        
+        # topic --> [(ts, spread), ...]
+        self.buffers = {}
+        self.last_flush = {}
+
+        # topic --> asyncio.TimerHandle of the pending background flush
+        self.timers = {}
+
+    async def send(self, data: Dict[str, Any], topic: str = DEFAULT_TOPIC):
+        """
+        :param data: {'spread': ..., 'ts': unix milliseconds (now if not given)}
+        """
+        ts = data.get('ts')
+        if ts is None:
+            ts = int(time.time() * 1000)
+
+        buffer = self.buffers.get(topic)
+        if buffer is None:
+            buffer = self.buffers[topic] = []
+            self.last_flush[topic] = time.monotonic()
+        buffer.append((ts, data['spread']))
+
+        elapsed = time.monotonic() - self.last_flush[topic]
+        if len(buffer) >= self.batch_size or elapsed >= self.flush_interval:
+            await self._send_batch(topic)
+        elif topic not in self.timers:
+            loop = asyncio.get_running_loop()
+            self.timers[topic] = loop.call_later(self.flush_interval - elapsed, self._flush_later, topic)
+
+    def _flush_later(self, topic: str):
+        del self.timers[topic]
+        asyncio.ensure_future(self._send_batch(topic))
+
+    async def _send_batch(self, topic: str):
+        timer = self.timers.pop(topic, None)
+        if timer is not None:
+            timer.cancel()
+        buffer = self.buffers[topic]
+        self.last_flush[topic] = time.monotonic()
+        if not buffer:
+            return
+        self.buffers[topic] = []
+        await self.socket.send_multipart([topic.encode(), encode_spreads(buffer)])
+
+    async def flush(self):
+        for topic in list(self.buffers):
+            await self._send_batch(topic)
+
+
 class Subscriber:
-    
-    def __init__(self, port: int):
+
+    def __init__(self, port: int, topics: Optional[List[str]] = None):
+        """
+        :param topics: topic prefixes to subscribe to (ex. ['ETHUSDT|']). All topics if None
+        """
         self.port = port
         self.context = zmq.Context()
         self.socket = self.context.socket(zmq.SUB)
         self.socket.connect(f'tcp://localhost:{port}')
-        self.socket.setsockopt_string(zmq.SUBSCRIBE, '')
-        
-    def recv(self):
-        return json.loads(self.socket.recv_string())
+        for topic in topics or ['']:
+            self.socket.setsockopt_string(zmq.SUBSCRIBE, topic)
+
+    def recv(self, flags: int = 0) -> Tuple[str, np.ndarray]:
+        """
+        :return: (topic, SPREAD_DTYPE records)
+        """
+        topic, payload = self.socket.recv_multipart(flags)
+        return topic.decode(), decode_spreads(payload)
+
+    def recv_all(self, timeout: int = 100) -> Dict[str, List[np.ndarray]]:
+        """
+        Waits up to timeout milliseconds for a message, then drains all the messages already received
+
+        :return: {topic: [records, ...]}
+        """
+        batches = {}
+        if not self.socket.poll(timeout):
+            return batches
+        while True:
+            try:
+                topic, records = self.recv(zmq.NOBLOCK)
+            except zmq.Again:
+                break
+            batches.setdefault(topic, []).append(records)
+        return batches
+
+
+class RingBuffer:
+    """
+    A fixed-size buffer of the last capacity records: memory and the cost of to_frame
+    don't grow with the length of the session
+    """
+
+    def __init__(self, capacity: int, dtype: np.dtype = SPREAD_DTYPE):
+        self.capacity = capacity
+        self.data = np.zeros(capacity, dtype=dtype)
+        self.position = 0
+        self.size = 0
+
+    def extend(self, records: np.ndarray):
+        records = records[-self.capacity:]
+        n = len(records)
+        end = self.position + n
+        if end <= self.capacity:
+            self.data[self.position:end] = records
+        else:
+            split = self.capacity - self.position
+            self.data[self.position:] = records[:split]
+            self.data[:n - split] = records[split:]
+        self.position = end % self.capacity
+        self.size = min(self.size + n, self.capacity)
+
+    def view(self) -> np.ndarray:
+        """
+        The records in order, oldest first
+        """
+        if self.size < self.capacity:
+            return self.data[:self.size]
+        return np.concatenate([self.data[self.position:], self.data[:self.position]])
+
+    def to_frame(self) -> pd.DataFrame:
+        records = self.view()
+        return pd.DataFrame({'Date': pd.to_datetime(records['ts'], unit='ms'), 'Spread': records['spread']})
 
 
 class Worker(QThread):
-    timeout = pyqtSignal(pd.DataFrame)
+    # topic, new records
+    received = pyqtSignal(str, object)
 
-    def __init__(self, port: int):
+    def __init__(self, port: int, topics: Optional[List[str]] = None):
         super().__init__()
-        
-        self.data = []
-        self.subscriber = Subscriber(port)
 
-    def run(self):
-        i = 0
-        
-        while True:
-            data = self.subscriber.recv()
-            self.data.append([i, data['spread']])
-            i += 1
+        self.subscriber = Subscriber(port, topics)
 
-            df = pd.DataFrame(self.data, columns=['Date', 'Spread'])
-            self.timeout.emit(df)
-            time.sleep(0.1)
+    def run(self):
+        while not self.isInterruptionRequested():
+            for topic, batches in self.subscriber.recv_all().items():
+                self.received.emit(topic, np.concatenate(batches))
 
 
 class ChartWindow(QMainWindow):
-    
-    def __init__(self, port: int):
+
+    def __init__(self, port: int, topics: Optional[List[str]] = None, capacity: int = 10000):
+        """
+        :param topics: topic prefixes to chart (ex. ['ETHUSDT|']). All topics if None
+        :param capacity: the number of points kept per topic
+        """
         super().__init__()
 
-        self.df = None
-        self.plot = None
+        self.capacity = capacity
+
+        # topic --> RingBuffer, plot
+        self.buffers = {}
+        self.plots = {}
+        self.dirty = set()
 
         # thread
-        self.w = Worker(port)
-        self.w.timeout.connect(self.update_data)
+        self.w = Worker(port, topics)
+        self.w.received.connect(self.update_data)
         self.w.start()
 
         # timer: update chart every 0.5 second
@@ -92,42 +240,53 @@ class ChartWindow(QMainWindow):
         now = datetime.datetime.now()
         self.statusBar().showMessage(str(now))
 
-        if self.df is not None:
-            if self.plot is None:
-                self.plot = fplt.plot(self.df[['Date', 'Spread']])
+        # only the topics that received records since the last update are redrawn
+        for topic in self.dirty:
+            df = self.buffers[topic].to_frame()
+            if topic not in self.plots:
+                self.plots[topic] = fplt.plot(df[['Date', 'Spread']], ax=self.ax, legend=topic)
                 fplt.show(qt_exec=False)
             else:
-                self.plot.update_data(self.df[['Date', 'Spread']])
+                self.plots[topic].update_data(df[['Date', 'Spread']])
+        self.dirty.clear()
+
+    @pyqtSlot(str, object)
+    def update_data(self, topic: str, records: np.ndarray):
+        if topic not in self.buffers:
+            self.buffers[topic] = RingBuffer(self.capacity)
+        self.buffers[topic].extend(records)
+        self.dirty.add(topic)
+
+    def closeEvent(self, event):
+        self.w.requestInterruption()
+        self.w.wait()
+        super().closeEvent(event)
+
 
-    @pyqtSlot(pd.DataFrame)
-    def update_data(self, df):
-        self.df = df
-        
-        
 # Sample publisher function for test
 def send_data(port: int):
-    import asyncio
-    
+    import random
+
     async def _send():
         pub = Publisher(port)
-        i = 0
+        topics = [spread_topic('ETHUSDT', 'binance/uniswap'), spread_topic('ETHUSDT', 'okx/sushiswap')]
         while True:
-            await pub.send({'spread': i})
-            i += 1
-            time.sleep(0.5)
-            
+            for topic in topics:
+                await pub.send({'spread': random.gauss(0, 0.1)}, topic)
+            await asyncio.sleep(0.01)
+
     asyncio.run(_send())
 
 
 if __name__ == "__main__":
     from multiprocessing import Process
-    
+
     port = 9999
-    
+
     # p = Process(target=send_data, args=(port,))
     # p.start()
-    
+
     app = QApplication(sys.argv)
     window = ChartWindow(port)
     window.show()
-    app.exec()
\ No newline at end of file
+    app.exec()
@@ -1,30 +1,283 @@
+import time
 import random
 import asyncio
+import contextvars
 import websockets
 
-from typing import Any, Callable, Dict
+from decimal import Decimal
+from typing import Any, Callable, Dict, Iterable, Optional, Type
 
 
-async def reconnecting_websocket_loop(stream_fn: Callable, tag: str):
+class StaleFeedError(Exception):
+    """
+    Raised by reconnecting_websocket_loop when a stream didn't receive a message for stale_timeout seconds
+    """
+    pass
+
+
+class RetryPolicy:
+    """
+    How reconnecting_websocket_loop restarts a stream after an exception
+
+    The n-th consecutive failure waits min(max_delay, base_delay * 2 ** n) seconds,
+    with a random jitter of up to half the delay so that streams don't reconnect in lockstep.
+    The failure count is reset once the stream receives a message again.
+    """
+
+    def __init__(self,
+                 retry: bool = True,
+                 base_delay: float = 1,
+                 max_delay: float = 60,
+                 max_retries: Optional[int] = None):
+        """
+        :param retry: if False, the stream is stopped on this exception
+        :param max_retries: the stream is stopped after this many consecutive failures (no limit if None)
+        """
+        self.retry = retry
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_retries = max_retries
+
+    def should_retry(self, failures: int) -> bool:
+        return self.retry and (self.max_retries is None or failures <= self.max_retries)
+
+    def delay(self, failures: int) -> float:
+        delay = min(self.max_delay, self.base_delay * 2 ** (failures - 1))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+
+"""
+Retry policies are looked up by the exception's class, the most specific class first (in MRO order).
+Connection errors, timeouts and stale feeds are retried quickly,
+other errors are retried with a longer backoff so that a bug doesn't flood the exchange with reconnects
+"""
+DEFAULT_RETRY_POLICIES = {
+    websockets.ConnectionClosed: RetryPolicy(base_delay=1, max_delay=30),
+    OSError: RetryPolicy(base_delay=1, max_delay=30),
+    asyncio.TimeoutError: RetryPolicy(base_delay=0.5, max_delay=30),
+    StaleFeedError: RetryPolicy(base_delay=0.5, max_delay=30),
+    Exception: RetryPolicy(base_delay=5, max_delay=300),
+}
+
+
+class StreamStats:
+    """
+    Health counters of a stream run by reconnecting_websocket_loop
+    """
+    __slots__ = (
+        'tag',
+        'messages',
+        'reconnects',
+        'errors',
+        'downtime',
+        'started_at',
+        'last_message_at',
+        'disconnected_at',
+        'last_latency',
+        'last_error',
+        '_previous_start',
+        '_previous_messages',
+        '_window_start',
+        '_window_messages',
+    )
+
+    RATE_WINDOW = 10
+
+    def __init__(self, tag: str):
+        now = time.monotonic()
+        self.tag = tag
+        self.messages = 0
+        self.reconnects = 0
+        self.errors = {}
+        self.downtime = 0.0
+        self.started_at = now
+        self.last_message_at = None
+        self.disconnected_at = now
+        self.last_latency = None
+        self.last_error = None
+        self._previous_start = None
+        self._previous_messages = 0
+        self._window_start = now
+        self._window_messages = 0
+
+    def record_message(self, latency: Optional[float] = None):
+        now = time.monotonic()
+        self.messages += 1
+        self.last_message_at = now
+        if latency is not None:
+            self.last_latency = latency
+
+        if self.disconnected_at is not None:
+            self.downtime += now - self.disconnected_at
+            self.disconnected_at = None
+
+        self._window_messages += 1
+        if now - self._window_start >= self.RATE_WINDOW:
+            self._previous_start = self._window_start
+            self._previous_messages = self._window_messages
+            self._window_start = now
+            self._window_messages = 0
+
+    @property
+    def message_rate(self) -> float:
+        """
+        Messages per second over the last full RATE_WINDOW and the window in progress,
+        so it's up to date before the first window ends, and goes down while no message arrives
+        """
+        start = self._window_start if self._previous_start is None else self._previous_start
+        elapsed = time.monotonic() - start
+        if elapsed <= 0:
+            return 0.0
+        return (self._previous_messages + self._window_messages) / elapsed
+
+    def record_error(self, e: Exception):
+        now = time.monotonic()
+        name = e.__class__.__name__
+        self.errors[name] = self.errors.get(name, 0) + 1
+        self.last_error = repr(e)
+        if self.disconnected_at is None:
+            self.disconnected_at = now
+
+    def message_age(self, since: float) -> float:
+        """
+        Seconds since the last message, or since `since` if no message was received after it
+        """
+        last = max(self.last_message_at or since, since)
+        return time.monotonic() - last
+
+    def to_dict(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        downtime = self.downtime
+        if self.disconnected_at is not None:
+            downtime += now - self.disconnected_at
+        return {
+            'tag': self.tag,
+            'messages': self.messages,
+            'message_rate': self.message_rate,
+            'reconnects': self.reconnects,
+            'errors': dict(self.errors),
+            'downtime': downtime,
+            'uptime': now - self.started_at - downtime,
+            'last_message_age': None if self.last_message_at is None else now - self.last_message_at,
+            'last_latency': self.last_latency,
+            'last_error': self.last_error,
+        }
+
+
+# tag --> StreamStats of all streams run by reconnecting_websocket_loop
+STREAM_STATS = {}
+
+_current_stream = contextvars.ContextVar('current_stream', default=None)
+
+
+def record_message(latency: Optional[float] = None):
+    """
+    Called by the streams for every message received.
+    Counts the message for the stream that reconnecting_websocket_loop is running in this context
+
+    :param latency: seconds between the exchange/node timestamp of the message and now, if known
+    """
+    stats = _current_stream.get()
+    if stats is not None:
+        stats.record_message(latency)
+
+
+def get_stream_stats() -> Dict[str, Dict[str, Any]]:
+    return {tag: stats.to_dict() for tag, stats in STREAM_STATS.items()}
+
+
+async def log_stream_stats(interval: float = 60):
     while True:
-        try:
-            await stream_fn()
+        await asyncio.sleep(interval)
+        for stats in get_stream_stats().values():
+            print(stats)
 
-        except (websockets.ConnectionClosedError, websockets.ConnectionClosedOK) as e:
-            print(f'{tag} websocket connection closed: {e}')
-            print('Reconnecting...')
-            await asyncio.sleep(2)
 
-        except Exception as e:
-            print(f'An error has occurred with {tag} websocket: {e}')
+def _retry_policy(e: Exception, retry_policies: Dict[Type[Exception], RetryPolicy]) -> Optional[RetryPolicy]:
+    for cls in type(e).__mro__:
+        if cls in retry_policies:
+            return retry_policies[cls]
+    return None
+
+
+async def _run_with_watchdog(stream_fn: Callable, stats: StreamStats, stale_timeout: Optional[float]):
+    task = asyncio.ensure_future(stream_fn())
+    if stale_timeout is None:
+        return await task
+
+    started_at = time.monotonic()
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=min(stale_timeout / 4, 1))
+            if done:
+                return task.result()
+            if stats.message_age(started_at) > stale_timeout:
+                raise StaleFeedError(f'{stats.tag} received no message for {stale_timeout}s')
+    finally:
+        if not task.done():
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+
+async def reconnecting_websocket_loop(stream_fn: Callable,
+                                      tag: str,
+                                      retry_policies: Optional[Dict[Type[Exception], RetryPolicy]] = None,
+                                      stale_timeout: Optional[float] = None):
+    """
+    Runs stream_fn, and restarts it with exponential backoff and jitter when it fails
+
+    :param retry_policies: {exception class: RetryPolicy}, merged over DEFAULT_RETRY_POLICIES.
+                           Exceptions without a policy stop the stream
+    :param stale_timeout: restart the stream if it didn't call record_message for this many seconds.
+                          Disabled if None
+    """
+    policies = dict(DEFAULT_RETRY_POLICIES)
+    policies.update(retry_policies or {})
+
+    stats = STREAM_STATS[tag] = StreamStats(tag)
+    _current_stream.set(stats)
+
+    failures = 0
+
+    while True:
+        messages = stats.messages
+
+        try:
+            await _run_with_watchdog(stream_fn, stats, stale_timeout)
+            print(f'{tag} stream ended')
             break
 
+        except Exception as e:
+            stats.record_error(e)
+
+            if stats.messages > messages:
+                failures = 0
+            failures += 1
+
+            policy = _retry_policy(e, policies)
+            if policy is None or not policy.should_retry(failures):
+                print(f'An error has occurred with {tag} websocket: {e!r}. Stopping')
+                break
+
+            delay = policy.delay(failures)
+            print(f'An error has occurred with {tag} websocket: {e!r}')
+            print(f'Reconnecting in {delay:.2f}s (failure #{failures})...')
+            stats.reconnects += 1
+            await asyncio.sleep(delay)
+
 
 def calculate_next_block_base_fee(block: Dict[str, Any]):
     base_fee = int(block['baseFeePerGas'], base=16)
     gas_used = int(block['gasUsed'], base=16)
     gas_limit = int(block['gasLimit'], base=16)
 
+    return next_block_base_fee(base_fee, gas_used, gas_limit)
+
+
+def next_block_base_fee(base_fee: int, gas_used: int, gas_limit: int):
+    """
+    Same as calculate_next_block_base_fee, for blocks that are already decoded to integers
+    """
     target_gas_used = gas_limit / 2
     target_gas_used = 1 if target_gas_used == 0 else target_gas_used
 
@@ -36,3 +289,27 @@ def calculate_next_block_base_fee(block: Dict[str, Any]):
             ((base_fee * (target_gas_used - gas_used)) / target_gas_used) / 8
 
     return int(new_base_fee + random.randint(0, 9))
+
+
+def to_fixed(value: str, decimals: int) -> int:
+    """
+    Converts a decimal string (ex. '1850.12') to an integer scaled by 10 ** decimals
+    without constructing a Decimal. Digits below the scale are truncated
+    """
+    integer, _, fraction = value.partition('.')
+    fraction = (fraction + '0' * decimals)[:decimals]
+    return int(integer + fraction)
+
+
+def decimal_places(values: Iterable[Decimal]) -> int:
+    """
+    The smallest decimals such that every value scaled by 10 ** decimals is an integer
+    """
+    return max([-value.as_tuple().exponent for value in values] + [0])
+
+
+def from_fixed(value: int, decimals: int) -> Decimal:
+    """
+    Converts a fixed-point integer back to Decimal. Use this at the display/publish edge only
+    """
+    return Decimal(value).scaleb(-decimals)